@@ -0,0 +1,293 @@
+"""Benchmark the fetch and process pipeline against a local fake Magento and
+webhook server, reporting throughput, latency, peak memory and the requests
+made as JSON so that runs can be compared across changes."""
+
+import argparse
+import asyncio
+from collections import Counter
+from contextlib import nullcontext
+import functools
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+from threading import Lock
+import time
+
+from MockMagentoServer import ALERT_PATH, EMAIL_PATH, ORDERS_PATH, MockMagentoServer
+import OrderEmailResender
+
+# Where the store is said to be when replaying a recording instead.
+REPLAY_URL = "http://replay.invalid"
+# The metrics counting each order the pipeline has finished with, whether it
+# was resent, refused a resend, escalated or failed.
+OUTCOME_METRICS = (
+    "orders_resent",
+    "orders_resend_refused",
+    "orders_escalated",
+    "orders_failed",
+)
+
+
+def _percentile(values, percent) -> float:
+    """Return the nearest-rank percentile of the values, or 0 if empty."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    rank = max(0, min(len(values) - 1, round(percent / 100 * len(values)) - 1))
+    return values[rank]
+
+
+def _count_outcomes() -> int:
+    """Return the number of orders the pipeline has finished with so far."""
+    with OrderEmailResender._metrics_lock:
+        return sum(
+            value
+            for (name, _), value in OrderEmailResender._metric_values.items()
+            if name in OUTCOME_METRICS
+        )
+
+
+def _peak_rss_mb() -> float:
+    """Return the peak resident set size of this process in megabytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes.
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def _git_revision():
+    """Return the short git revision being benchmarked, if known."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _build_config(server_url, args):
+    """Build a config pointing OrderEmailResender at the fake server."""
+    return OrderEmailResender.Config(
+        max_email_attempts=args.max_email_attempts,
+        comment_prefix=args.comment_prefix,
+        web_domain=server_url,
+        web_orders_api_endpoint=ORDERS_PATH,
+        web_order_api_endpoint=ORDERS_PATH + "/",
+        alert_webhook_url=server_url + ALERT_PATH,
+        email_webhook_url=server_url + EMAIL_PATH,
+        web_order_comment_field="order_comment",
+        web_headers={"Authorization": "Bearer benchmark"},
+        order_page_size=args.page_size or None,
+        server_side_filter=args.server_side_filter,
+        webhook_batching=args.batch_webhooks,
+        magento_bulk_resend=args.bulk_resend,
+        magento_bulk_poll_secs=0.1,
+        max_concurrency=args.workers,
+        engine=args.engine,
+        magento_retry_backoff_secs=args.retry_backoff,
+        record_file=args.record,
+        replay_file=args.replay,
+        replay_speed=args.replay_speed,
+    )
+
+
+def run_benchmark(args) -> dict:
+    """Run the pipeline once against a fresh fake server, or a recording,
+    and return the results."""
+    server = None
+    if not args.replay:
+        server = MockMagentoServer(
+            order_count=args.orders,
+            history_length=args.history,
+            latency=args.latency_ms / 1000,
+            error_rate=args.error_rate,
+            sent_ratio=args.sent_ratio,
+            escalate_ratio=args.escalate_ratio,
+            comment_prefix=args.comment_prefix,
+            max_email_attempts=args.max_email_attempts,
+            seed=args.seed,
+        )
+    with server or nullcontext():
+        config = _build_config(server.url if server else REPLAY_URL, args)
+        if args.verbose:
+            OrderEmailResender.setup_logging(config)
+
+        request_latencies = []
+        order_latencies = []
+        latencies_lock = Lock()
+
+        def timed(function, latencies):
+            def record(start):
+                elapsed = time.perf_counter() - start
+                with latencies_lock:
+                    latencies.append(elapsed)
+
+            if asyncio.iscoroutinefunction(function):
+
+                @functools.wraps(function)
+                async def async_wrapper(*args, **kwargs):
+                    start = time.perf_counter()
+                    try:
+                        return await function(*args, **kwargs)
+                    finally:
+                        record(start)
+
+                return async_wrapper
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    record(start)
+
+            return wrapper
+
+        # Replayed requests are counted by their URL template.
+        request_counts = server.request_counts if server else Counter()
+        next_replay_record = OrderEmailResender._next_replay_record
+
+        def count_replayed(method, url, params=None):
+            record = next_replay_record(method, url, params)
+            request_counts[record["template"]] += 1
+            return record
+
+        OrderEmailResender._next_replay_record = count_replayed
+
+        suffix = "_async" if args.engine == "async" else ""
+        for name, latencies in [
+            ("_http_request", request_latencies),
+            ("_process_order", order_latencies),
+        ]:
+            setattr(
+                OrderEmailResender,
+                name + suffix,
+                timed(getattr(OrderEmailResender, name + suffix), latencies),
+            )
+
+        fetched = 0
+        failed = 0
+        outcomes_before = _count_outcomes()
+        start = time.perf_counter()
+        try:
+            if args.engine == "async":
+                with OrderEmailResender.use_config(config):
+                    fetched, failed = asyncio.run(_run_async(args))
+            else:
+                fetched, failed = _run_threads(args, config)
+        except OrderEmailResender.NoOrdersFound:
+            pass
+        elapsed = time.perf_counter() - start
+        processed = _count_outcomes() - outcomes_before
+        OrderEmailResender.close_recording()
+
+    return {
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "parameters": {
+            name: value
+            for name, value in vars(args).items()
+            if name not in ("output", "verbose")
+        },
+        "elapsed_secs": round(elapsed, 3),
+        "orders_fetched": fetched,
+        "orders_processed": processed,
+        "orders_failed": failed,
+        "throughput_orders_per_sec": round(processed / elapsed, 1) if elapsed else 0,
+        "order_latency_ms": {
+            "p50": round(_percentile(order_latencies, 50) * 1000, 2),
+            "p99": round(_percentile(order_latencies, 99) * 1000, 2),
+        },
+        "request_latency_ms": {
+            "p50": round(_percentile(request_latencies, 50) * 1000, 2),
+            "p99": round(_percentile(request_latencies, 99) * 1000, 2),
+        },
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+        "requests": dict(sorted(request_counts.items())),
+        "requests_total": sum(request_counts.values()),
+    }
+
+
+def _run_threads(args, config):
+    """Fetch and process the orders with the threaded engine, returning the
+    number of orders fetched and failed."""
+    fetched = 0
+    if args.page_size:
+        orders = OrderEmailResender.fetch_unsent_orders_paged(config=config)
+    else:
+        orders = OrderEmailResender.fetch_unsent_orders(config=config)
+
+    def count_fetched(orders):
+        nonlocal fetched
+        for order in orders:
+            fetched += 1
+            yield order
+
+    failed = OrderEmailResender.process_orders(
+        count_fetched(orders), config=config
+    )
+    return fetched, failed
+
+
+async def _run_async(args):
+    """Fetch and process the orders with the async engine, returning the
+    number of orders fetched and failed."""
+    fetched = 0
+    async with OrderEmailResender.create_async_session() as session:
+        if args.page_size:
+            orders = OrderEmailResender.fetch_unsent_orders_paged_async(session)
+        else:
+            orders = await OrderEmailResender.fetch_unsent_orders_async(session)
+
+        async def count_fetched(orders):
+            nonlocal fetched
+            async for order in OrderEmailResender._iterate_async(orders):
+                fetched += 1
+                yield order
+
+        failed = await OrderEmailResender.process_orders_async(
+            session, count_fetched(orders)
+        )
+    return fetched, failed
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--orders", type=int, default=1000, help="orders in the fake store")
+    parser.add_argument("--history", type=int, default=3, help="status history comments per order")
+    parser.add_argument("--latency-ms", type=float, default=10, help="delay added to every response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of responses which are 503s")
+    parser.add_argument("--sent-ratio", type=float, default=0.5, help="share of orders already sent")
+    parser.add_argument("--escalate-ratio", type=float, default=0.1, help="share of unsent orders out of resend attempts")
+    parser.add_argument("--page-size", type=int, default=100, help="order page size, 0 to fetch in one request")
+    parser.add_argument("--workers", type=int, default=8, help="orders processed concurrently")
+    parser.add_argument("--engine", choices=OrderEmailResender.ENGINES, default="threads")
+    parser.add_argument("--server-side-filter", action="store_true", help="let the fake server filter orders")
+    parser.add_argument("--batch-webhooks", action="store_true", help="batch escalation webhooks")
+    parser.add_argument("--bulk-resend", action="store_true", help="resend through the async bulk API")
+    parser.add_argument("--retry-backoff", type=float, default=0.01, help="Magento retry backoff in seconds")
+    parser.add_argument("--max-email-attempts", type=int, default=3)
+    parser.add_argument("--comment-prefix", default="Order email resend attempted.")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the fake store and errors")
+    parser.add_argument("--record", help="record the fake server's responses to this file")
+    parser.add_argument("--replay", help="replay this recording instead of running a fake server")
+    parser.add_argument("--replay-speed", type=float, default=1, help="replay speed multiplier, 0 for no delays")
+    parser.add_argument("--output", help="append the results as a JSON line to this file")
+    parser.add_argument("--verbose", action="store_true", help="log each order to stdout and the log file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = run_benchmark(args)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "a") as output_file:
+            output_file.write(json.dumps(results, sort_keys=True) + "\n")
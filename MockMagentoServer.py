@@ -0,0 +1,295 @@
+"""A local fake of the Magento REST API and the alert/email webhooks, for
+benchmarking OrderEmailResender against real HTTP without touching a live
+store."""
+
+from collections import Counter
+from faker import Faker
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+from threading import Lock, Thread
+import time
+from urllib.parse import parse_qs, urlsplit
+import uuid
+
+ORDERS_PATH = "/rest/default/V1/orders"
+BULK_RESEND_PATH = "/rest/default/async/bulk/V1/orders/byId/emails"
+BULK_STATUS_PATH = "/rest/default/V1/bulk/"
+ALERT_PATH = "/webhooks/alert"
+EMAIL_PATH = "/webhooks/email"
+
+
+class MockMagentoServer:
+    """Serve a fake store of orders over HTTP on localhost.
+
+    Every response is delayed by `latency` seconds and a random `error_rate`
+    of requests fail with a 503. A share of the orders have already had their
+    email sent, or are in a skipped status, and `escalate_ratio` of them have
+    already used up their resend attempts."""
+
+    def __init__(
+        self,
+        order_count=1000,
+        history_length=3,
+        latency=0.0,
+        error_rate=0.0,
+        sent_ratio=0.5,
+        skipped_ratio=0.1,
+        escalate_ratio=0.1,
+        comment_prefix="Order email resend attempted.",
+        max_email_attempts=3,
+        seed=1,
+    ):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.comment_prefix = comment_prefix
+        self.request_counts = Counter()
+        self._random = random.Random(seed)
+        self._lock = Lock()
+        self.orders = [
+            self._build_order(
+                entity_id,
+                history_length,
+                sent_ratio,
+                skipped_ratio,
+                escalate_ratio,
+                max_email_attempts,
+            )
+            for entity_id in range(1, order_count + 1)
+        ]
+        self._orders_by_id = {order["entity_id"]: order for order in self.orders}
+        # The operation statuses of each bulk, which complete straight away.
+        self.bulks = {}
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        """The base URL of the server."""
+        return "http://127.0.0.1:" + str(self._server.server_address[1])
+
+    def start(self) -> "MockMagentoServer":
+        """Start serving from a background thread."""
+        self._thread = Thread(
+            target=self._server.serve_forever, name="mock-magento", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Stop serving and close the socket."""
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _build_order(
+        self,
+        entity_id,
+        history_length,
+        sent_ratio,
+        skipped_ratio,
+        escalate_ratio,
+        max_email_attempts,
+    ) -> dict:
+        """Build the summary of an order as returned by the order search."""
+        roll = self._random.random()
+        order = {
+            "entity_id": entity_id,
+            "increment_id": str(600_000_000 + entity_id),
+            "status": "processing",
+            "updated_at": "2024-05-01 10:00:00",
+            "status_histories": [
+                {"comment": "Captured amount of £1,234.56 online."}
+                for _ in range(history_length)
+            ],
+        }
+        if roll < sent_ratio:
+            order["email_sent"] = 1
+        elif roll < sent_ratio + skipped_ratio:
+            order["status"] = self._random.choice(
+                ["canceled", "pending_payment"]
+            )
+        elif self._random.random() < escalate_ratio:
+            order["status_histories"] += [
+                {"comment": self.comment_prefix + f" Attempt #{attempt}"}
+                for attempt in range(1, max_email_attempts + 1)
+            ]
+        return order
+
+    def _build_full_order(self, order) -> dict:
+        """Build the full order entity, the same each time for an order."""
+        fake = Faker("en_GB")
+        fake.seed_instance(order["entity_id"])
+        company = fake.company()
+
+        def address():
+            return {
+                "city": fake.city(),
+                "company": company,
+                "email": fake.email(),
+                "firstname": fake.first_name(),
+                "lastname": fake.last_name(),
+                "postcode": fake.postcode(),
+                "street": [fake.street_address()],
+                "telephone": fake.phone_number(),
+            }
+
+        return {
+            "entity_id": order["entity_id"],
+            "increment_id": order["increment_id"],
+            "customer_name": company,
+            "billing_address": address(),
+            "payment": {"method": "checkmo"},
+            "items": [
+                {
+                    "sku": fake.bothify("SKU-####"),
+                    "name": fake.catch_phrase(),
+                    "qty_ordered": fake.random_int(1, 10),
+                    "price": 9.99,
+                    "row_total": 19.98,
+                }
+                for _ in range(fake.random_int(1, 20))
+            ],
+            "extension_attributes": {
+                "shipping_assignments": [
+                    {
+                        "shipping": {
+                            "address": address(),
+                            "method": "flatrate_flatrate",
+                            "total": {"shipping_amount": 5.0},
+                        }
+                    }
+                ]
+            },
+            "subtotal": 19.98,
+            "grand_total": 24.98,
+            "status_histories": order["status_histories"],
+            "order_comment": fake.sentence(),
+        }
+
+    def _search_orders(self, query) -> dict:
+        """Answer an order search, applying the email_sent/status filters, an
+        entity_id "gt" filter and the page size and current page like Magento
+        does."""
+        criteria = {key: values[0] for key, values in query.items()}
+        orders = self.orders
+        if "nin" in criteria.values():
+            orders = [
+                order
+                for order in orders
+                if not order.get("email_sent")
+                and order["status"] not in ("canceled", "pending_payment")
+            ]
+        for key, value in criteria.items():
+            if key.endswith("[condition_type]") and value == "gt":
+                after = int(criteria[key.replace("[condition_type]", "[value]")])
+                orders = [order for order in orders if order["entity_id"] > after]
+        page_size = int(criteria.get("searchCriteria[pageSize]", 0))
+        if page_size:
+            # Magento gives the last page again for pages beyond the end.
+            last_page = max(1, -(-len(orders) // page_size))
+            page = min(int(criteria.get("searchCriteria[currentPage]", 1)), last_page)
+            items = orders[(page - 1) * page_size : page * page_size]
+        else:
+            items = orders
+        return {"items": items, "total_count": len(orders)}
+
+    def _resend_in_bulk(self, body) -> dict:
+        """Accept a bulk of order email resends, resending the emails of the
+        orders which exist and rejecting the rest."""
+        bulk_uuid = str(uuid.uuid4())
+        request_items = []
+        operations = []
+        for operation_id, operation in enumerate(json.loads(body)):
+            order = self._orders_by_id.get(operation.get("id"))
+            if order is None:
+                request_items.append({"id": operation_id, "status": "rejected"})
+                continue
+            with self._lock:
+                order["status_histories"].append({"comment": self.comment_prefix})
+                order["email_sent"] = 1
+            request_items.append({"id": operation_id, "status": "accepted"})
+            operations.append({"id": operation_id, "status": 1})
+        with self._lock:
+            self.bulks[bulk_uuid] = operations
+        return {"bulk_uuid": bulk_uuid, "request_items": request_items}
+
+    def _route(self, method, path, query, body):
+        """Route a request to a status code and JSON response."""
+        if method == "GET" and path == ORDERS_PATH:
+            return "search_orders", 200, self._search_orders(query)
+        if method == "POST" and path == BULK_RESEND_PATH:
+            return "bulk_resend", 202, self._resend_in_bulk(body)
+        if method == "GET" and path.startswith(BULK_STATUS_PATH):
+            bulk_uuid = path[len(BULK_STATUS_PATH) :].split("/")[0]
+            if bulk_uuid not in self.bulks:
+                return "unknown", 404, {"message": "Bulk not found."}
+            return "bulk_status", 200, {
+                "bulk_id": bulk_uuid,
+                "operations_list": self.bulks[bulk_uuid],
+            }
+        if path in (ALERT_PATH, EMAIL_PATH) and method == "POST":
+            return path.rsplit("/", 1)[-1] + "_webhook", 200, {"message": "success"}
+        if path.startswith(ORDERS_PATH + "/"):
+            parts = path[len(ORDERS_PATH) + 1 :].split("/")
+            order = self._orders_by_id.get(int(parts[0])) if parts[0].isdigit() else None
+            if order is None:
+                return "unknown", 404, {"message": "Order not found."}
+            if method == "GET" and len(parts) == 1:
+                return "get_order", 200, self._build_full_order(order)
+            if method == "POST" and parts[1:] == ["emails"]:
+                with self._lock:
+                    order["status_histories"].append(
+                        {"comment": self.comment_prefix}
+                    )
+                    # Magento marks the email sent once it has sent it.
+                    order["email_sent"] = 1
+                return "resend_email", 200, "true"
+        return "unknown", 404, {"message": "Not found."}
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately, so don't let Nagle
+            # hold the body back waiting for an ACK.
+            disable_nagle_algorithm = True
+
+            def _respond(self, method):
+                url = urlsplit(self.path)
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                route, status, payload = server._route(
+                    method, url.path, parse_qs(url.query), body
+                )
+                with server._lock:
+                    server.request_counts[route] += 1
+                    failed = server._random.random() < server.error_rate
+                if server.latency:
+                    time.sleep(server.latency)
+                if failed:
+                    status, payload = 503, {"message": "Service Unavailable"}
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self._respond("GET")
+
+            def do_POST(self):
+                self._respond("POST")
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -1,99 +1,1410 @@
+import argparse
+import asyncio
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from contextlib import contextmanager, nullcontext
+import contextvars
+import copy
+import cProfile
+import dataclasses
+from datetime import timedelta
+import functools
+import gzip
+import hmac
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import atexit
 import json
 from dotenv import load_dotenv
 import logging
+from logging.handlers import (
+    QueueHandler,
+    QueueListener,
+    RotatingFileHandler,
+    TimedRotatingFileHandler,
+)
 import pendulum
 import os
+import pstats
+import queue
+import random
+import re
+import signal
+import socket
+import sqlite3
 import sys
+import time
+from threading import BoundedSemaphore, Event, Lock, Thread, get_ident
+from urllib.parse import parse_qsl, urlencode, urlsplit
+import zlib
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError, NewConnectionError
 
-load_dotenv()
+try:
+    import aiohttp
+except ImportError:
+    # Only needed by the async engine, see ENGINE in sample.env.
+    aiohttp = None
+try:
+    import redis
+except ImportError:
+    # Only needed to keep leases in Redis, see LEASE_BACKEND in sample.env.
+    redis = None
 
 LOG_FORMAT = (
-    "ts=%(asctime)s level=%(levelname)s logger=%(name)s "
+    "ts=%(asctime)s level=%(levelname)s logger=%(name)s store=%(store)s "
     'pid=%(process)d thread=%(threadName)s msg="%(message)s"'
 )
 
 formatter = logging.Formatter(LOG_FORMAT, datefmt="%Y-%m-%dT%H:%M:%S%z")
 
-stream_handler = logging.StreamHandler(sys.stdout)
-stream_handler.setFormatter(formatter)
+# Named rather than __name__, which is "__main__" when run as a script.
+logger = logging.getLogger("OrderEmailResender")
+# The handlers added to the root logger by setup_logging(), and the
+# background writer when logging through a queue.
+_log_handlers = []
+_log_listener = None
+
+# TIMINGS & TIMES
+TIMEZONE = pendulum.timezone("Europe/London")
+# The window to search for unsent orders, worked out each cycle (or on first
+# use) by refresh_sync_period() rather than when the module is imported.
+time_now = None
+SYNC_PERIOD_TIME = None
+SYNC_PERIOD_TIME_STR = None
+_dst_compensated = False
+
+# FILTERING
+# Orders in these statuses never need their email resending.
+SKIPPED_ORDER_STATUSES = ["canceled", "pending_payment"]
+
+
+class ConfigError(ValueError):
+    """Raised when a setting is missing or invalid."""
+
+
+@dataclasses.dataclass(frozen=True)
+class Config:
+    """The settings for a run, each read from the environment variable of
+    the same name in upper case (see sample.env) and validated once. Pass a
+    config to use_config(), or as `config` to the entry points, to run with
+    other settings, for example several configs in one process."""
+
+    # The number of resend attempts before escalating to sales, and the
+    # prefix of the order comments recording each attempt.
+    max_email_attempts: int
+    comment_prefix: str
+
+    # WEB VARIABLES
+    web_domain: str
+    web_orders_api_endpoint: str
+    web_order_api_endpoint: str
+    alert_webhook_url: str
+    email_webhook_url: str
+    web_order_comment_field: str
+    # Sent with every Magento request, from WEB_AUTH_HEADER_VALUE and the
+    # WEB_SECRET_NAME and WEB_SECRET_PASS pair.
+    web_headers: dict = dataclasses.field(default_factory=dict)
+    # The item fields to include in the sales payload, or all of them if
+    # empty. Comma separated in SALES_ITEM_FIELDS.
+    sales_item_fields: tuple = ()
+
+    # STORES
+    # The names of the stores to poll at once, comma separated in STORES.
+    # Each store's settings can be overridden by STORE_<NAME>_<SETTING>
+    # variables, see for_store(). A store's name tags its logs and metrics.
+    stores: tuple = ()
+    store: str = ""
+
+    # TIMINGS
+    order_age_mins: int = 60
+    # Optionally double check the local DST calculation against the Time API.
+    dst_verify_remote: bool = False
+    dst_cache_file: str = "dst_cache.json"
+
+    # FILTERING
+    # When true, Magento filters out sent and skipped orders before responding.
+    server_side_filter: bool = False
+
+    # INCREMENTAL POLLING
+    # When true, only orders updated since the last successful cycle (less the
+    # lookback, to catch late updates), or resent and still pending in the
+    # state store, are fetched. Needs STATE_STORE_FILE.
+    incremental_polling: bool = False
+    watermark_file: str = "watermark.json"
+    watermark_lookback_mins: int = 10
+
+    # STATE STORE
+    # A SQLite file recording resend attempts and outcomes per order, so that
+    # the order comments don't need fetching. Leave unset to count from
+    # comments. Reconciling reseeds attempt counts from the order comments
+    # even if the store exists.
+    state_store_file: str | None = None
+    state_store_reconcile: bool = False
+
+    # ORDER CACHE
+    # Full orders fetched for sales escalations are cached by entity ID and
+    # last update, up to ORDER_CACHE_SIZE orders for ORDER_CACHE_TTL_SECS, and
+    # optionally persisted to ORDER_CACHE_FILE between runs.
+    order_cache_size: int = 256
+    order_cache_ttl_secs: float = 3600
+    order_cache_file: str | None = None
+
+    # WEBHOOK BATCHING
+    # When true, escalated orders are sent to the alert and email webhooks in
+    # batches of up to WEBHOOK_BATCH_SIZE, or after WEBHOOK_BATCH_MAX_SECS,
+    # with any left over sent at the end of the cycle.
+    webhook_batching: bool = False
+    webhook_batch_size: int = 50
+    webhook_batch_max_secs: float = 30
+
+    # OUTBOX
+    # An append-only journal of the resends and escalations intended and done
+    # for each order, replayed on startup so actions are neither lost nor
+    # repeated when the process dies part way through. Leave unset to disable.
+    # Records older than OUTBOX_RETENTION_DAYS are dropped, done or not.
+    outbox_file: str | None = None
+    outbox_fsync_batch: int = 20
+    outbox_retention_days: float = 7
+
+    # PAGING
+    # When set, orders are fetched and processed a page at a time.
+    order_page_size: int | None = None
+
+    # DAEMON
+    # How often to poll Magento when running as a daemon, plus up to
+    # DAEMON_JITTER_SECS of random delay so instances don't poll in lockstep.
+    daemon_poll_secs: float = 60
+    daemon_jitter_secs: float = 5
+
+    # RECEIVER
+    # When RECEIVER_PORT is set the daemon also listens for order-placed and
+    # email-sent events, checking each placed order once it is
+    # RECEIVER_CHECK_DELAY_SECS old, so polling is only needed as an
+    # occasional sweep. Events must carry RECEIVER_TOKEN as a bearer token
+    # when it is set.
+    receiver_host: str = "127.0.0.1"
+    receiver_port: int = 0
+    receiver_token: str | None = None
+    receiver_check_delay_secs: float = 600
+
+    # SHARDING
+    # With SHARD_COUNT above 1, several instances can run at once. Orders
+    # are split into shards by a hash of their entity ID and each instance
+    # leases its share of the shards, and each order it processes, for
+    # LEASE_TTL_SECS. Leases are renewed every cycle, so the TTL must be
+    # longer than the poll interval plus a cycle, and a stopped instance's
+    # shards are taken over once its leases lapse. The "sqlite" backend keeps
+    # leases in LEASE_FILE, shared by instances on one host, the "redis"
+    # backend at LEASE_REDIS_URL, which needs redis installed. WORKER_ID
+    # defaults to the host name and process ID.
+    shard_count: int = 1
+    worker_id: str | None = None
+    lease_backend: str = "sqlite"
+    lease_file: str = "leases.db"
+    lease_redis_url: str | None = None
+    lease_ttl_secs: float = 300
+
+    # CONCURRENCY
+    # The number of orders to process at once and the most requests to make
+    # to any one host (Magento or a webhook) at the same time. The "threads"
+    # engine processes orders in a thread pool, the "async" engine as asyncio
+    # tasks on one thread, which needs aiohttp installed.
+    max_concurrency: int = 1
+    max_concurrency_per_host: int = 4
+    engine: str = "threads"
+
+    # HTTP
+    # Connection pools are kept per host, HTTP_POOL_CONNECTIONS hosts at a
+    # time with up to HTTP_POOL_MAXSIZE kept-alive connections to each. The
+    # timeout is from HTTP_CONNECT_TIMEOUT and HTTP_READ_TIMEOUT.
+    http_pool_connections: int = 10
+    http_pool_maxsize: int = 10
+    http_timeout: tuple = (5.0, 30.0)
+
+    # RESILIENCE
+    # Magento requests are retried up to MAGENTO_MAX_RETRIES times on
+    # throttling, server errors and connection failures with jittered
+    # exponential backoff.
+    magento_max_retries: int = 3
+    magento_retry_backoff_secs: float = 0.5
+    magento_retry_max_backoff_secs: float = 30
+    # Token bucket allowing MAGENTO_RATE_LIMIT requests per second on average
+    # with bursts of up to MAGENTO_RATE_BURST. A limit of 0 disables it.
+    magento_rate_limit: float = 0
+    magento_rate_burst: float = 10
+    # After MAGENTO_CIRCUIT_THRESHOLD failures in a row Magento isn't called
+    # for MAGENTO_CIRCUIT_RESET_SECS. A threshold of 0 disables the breaker.
+    magento_circuit_threshold: int = 5
+    magento_circuit_reset_secs: float = 60
+
+    # BULK RESENDS
+    # When true, the resends of a cycle are submitted to Magento's async bulk
+    # API in chunks of MAGENTO_BULK_CHUNK_SIZE, and their results collected
+    # by polling the bulk status every MAGENTO_BULK_POLL_SECS for up to
+    # MAGENTO_BULK_TIMEOUT_SECS. Needs Magento's async consumers running.
+    magento_bulk_resend: bool = False
+    magento_bulk_chunk_size: int = 100
+    magento_bulk_poll_secs: float = 2
+    magento_bulk_timeout_secs: float = 300
+
+    # METRICS
+    # Served on METRICS_PORT at /metrics in daemon mode, and written to
+    # METRICS_TEXTFILE after each cycle for a textfile collector to pick up.
+    metrics_host: str = "127.0.0.1"
+    metrics_port: int = 0
+    metrics_textfile: str | None = None
+
+    # PROFILING
+    # When set, each cycle is profiled, writing a cProfile .prof file (for
+    # snakeviz or pstats) and a Chrome trace of its phases and requests (for
+    # chrome://tracing or Perfetto) to PROFILE_DIR.
+    profile_dir: str | None = None
+
+    # RECORD & REPLAY
+    # With RECORD_FILE set, every Magento and webhook response is appended
+    # to it as gzipped JSON lines, leaving out the headers and replacing the
+    # store's domain and webhook URLs with placeholders. With REPLAY_FILE
+    # set, requests are answered from such a recording instead of the
+    # network, each after its recorded response time divided by REPLAY_SPEED
+    # (0 answers straight away).
+    record_file: str | None = None
+    replay_file: str | None = None
+    replay_speed: float = 1
+
+    # LOGGING
+    # LOG_LEVEL sets the verbosity, and LOG_ORDERS how each order is logged
+    # before it is processed: "compact" logs its key fields, "full" the whole
+    # order and "none" nothing, leaving just its outcome.
+    log_file: str = "order_email_resender.log"
+    log_level: str = "INFO"
+    log_orders: str = "compact"
+    # When true, records are written to stdout and the log file by a
+    # background thread, off the path of the orders being processed.
+    log_queue: bool = False
+    # The log file is rotated once it reaches LOG_MAX_BYTES, or every
+    # LOG_ROTATE_WHEN (as for TimedRotatingFileHandler, such as "midnight"),
+    # keeping LOG_BACKUP_COUNT old files. Both unset disables rotation.
+    log_max_bytes: int = 0
+    log_rotate_when: str | None = None
+    log_backup_count: int = 7
 
-file_handler = logging.FileHandler("order_email_resender.log")
-file_handler.setFormatter(formatter)
+    def __post_init__(self):
+        for name, minimum in _SETTING_MINIMUMS.items():
+            value = getattr(self, name)
+            if value is not None and value < minimum:
+                raise ConfigError(
+                    f"{name.upper()} must be at least {minimum}, not {value}"
+                )
+        if self.engine not in ENGINES:
+            raise ConfigError(
+                "ENGINE must be one of " + ", ".join(ENGINES)
+                + ", not " + self.engine
+            )
+        if self.engine == "async" and aiohttp is None:
+            raise ConfigError("ENGINE=async needs aiohttp to be installed")
+        if self.lease_backend not in LEASE_BACKENDS:
+            raise ConfigError(
+                "LEASE_BACKEND must be one of " + ", ".join(LEASE_BACKENDS)
+                + ", not " + self.lease_backend
+            )
+        if self.lease_backend == "redis" and self.shard_count > 1:
+            if redis is None:
+                raise ConfigError("LEASE_BACKEND=redis needs redis to be installed")
+            if not self.lease_redis_url:
+                raise ConfigError("LEASE_BACKEND=redis needs LEASE_REDIS_URL")
+        if not isinstance(logging.getLevelName(self.log_level.upper()), int):
+            raise ConfigError("LOG_LEVEL is not a logging level: " + self.log_level)
+        if self.log_orders not in ORDER_LOG_DETAILS:
+            raise ConfigError(
+                "LOG_ORDERS must be one of " + ", ".join(ORDER_LOG_DETAILS)
+                + ", not " + self.log_orders
+            )
+        if self.log_rotate_when and self.log_rotate_when.upper() not in (
+            LOG_ROTATE_INTERVALS
+        ):
+            raise ConfigError(
+                "LOG_ROTATE_WHEN must be one of " + ", ".join(LOG_ROTATE_INTERVALS)
+            )
+        if self.incremental_polling and not self.state_store_file:
+            raise ConfigError("INCREMENTAL_POLLING needs STATE_STORE_FILE")
+        if self.record_file and self.replay_file:
+            raise ConfigError("Only one of RECORD_FILE and REPLAY_FILE can be set")
+        if self.log_rotate_when and self.log_max_bytes:
+            raise ConfigError(
+                "Only one of LOG_MAX_BYTES and LOG_ROTATE_WHEN can be set"
+            )
+
+    @classmethod
+    def from_env(cls, environ=None) -> "Config":
+        """Read and validate the settings from the environment, raising
+        ConfigError for the first one which is missing or invalid. Empty
+        variables are treated as unset."""
+        if environ is None:
+            environ = os.environ
+        settings = {}
+        for field in dataclasses.fields(cls):
+            if field.name in ("web_headers", "http_timeout"):
+                continue
+            name = field.name.upper()
+            if environ.get(name):
+                settings[field.name] = _parse_setting(
+                    name, environ[name], field.type
+                )
+            elif (
+                field.default is dataclasses.MISSING
+                and field.default_factory is dataclasses.MISSING
+            ):
+                raise ConfigError(name + " must be set")
+        settings["web_headers"] = _parse_web_headers(environ)
+        settings["http_timeout"] = tuple(
+            _parse_setting(name, environ.get(name) or str(default), float)
+            for name, default in zip(
+                ("HTTP_CONNECT_TIMEOUT", "HTTP_READ_TIMEOUT"),
+                cls.http_timeout,
+            )
+        )
+        # A page size of 0 turns paging off.
+        settings["order_page_size"] = settings.get("order_page_size") or None
+        return cls(**settings)
+
+    def for_store(self, name, environ=None) -> "Config":
+        """Get the config of one of the stores: this config with the settings
+        overridden by any STORE_<NAME>_<SETTING> environment variables. The
+        settings shared by the whole process can't be overridden, and each
+        store keeps its own watermark file unless one is given."""
+        if environ is None:
+            environ = os.environ
+        prefix = "STORE_" + name.upper() + "_"
+        overrides = {
+            key[len(prefix) :]: value
+            for key, value in environ.items()
+            if key.startswith(prefix) and value
+        }
+        settings = {"store": name, "stores": ()}
+        for field in dataclasses.fields(self):
+            setting = field.name.upper()
+            if setting not in overrides:
+                continue
+            if field.name in PROCESS_SETTINGS:
+                raise ConfigError(
+                    prefix + setting + " can't be set, it is shared by all stores"
+                )
+            settings[field.name] = _parse_setting(
+                prefix + setting, overrides[setting], field.type
+            )
+        settings["web_headers"] = _parse_web_headers(
+            overrides, self.web_headers
+        )
+        if "watermark_file" not in settings:
+            root, extension = os.path.splitext(self.watermark_file)
+            settings["watermark_file"] = root + "." + name + extension
+        return dataclasses.replace(self, **settings)
+
+    @functools.cached_property
+    def store_configs(self) -> list:
+        """The config of each of the stores, or just this config if it
+        doesn't list any."""
+        if not self.stores:
+            return [self]
+        if len(set(self.stores)) != len(self.stores):
+            raise ConfigError("STORES must not list a store twice")
+        return [self.for_store(name) for name in self.stores]
+
+    @functools.cached_property
+    def sales_payload_fields(self) -> dict:
+        """Where each field of the sales payload is found in the full order,
+        including the configured order comment field."""
+        return dict(
+            SALES_PAYLOAD_PATHS, order_comment=(self.web_order_comment_field,)
+        )
+
+    @functools.cached_property
+    def sales_order_fields(self) -> str:
+        """The 'fields' projection requesting only the sales payload."""
+        return _build_fields_projection(
+            self.sales_payload_fields, self.sales_item_fields
+        )
 
-MAX_EMAIL_ATTEMPTS = int(os.getenv("MAX_EMAIL_ATTEMPTS"))
-COMMENT_PREFIX = str(os.getenv("COMMENT_PREFIX"))
 
-# WEB VARIABLES
-WEB_DOMAIN = os.getenv("WEB_DOMAIN")
-WEB_HEADERS = {
-    "Authorization": os.getenv("WEB_AUTH_HEADER_VALUE"),
-    os.getenv("WEB_SECRET_NAME"): os.getenv("WEB_SECRET_PASS"),
+# Settings shared by every store polled by the process, which can't be set
+# per store.
+PROCESS_SETTINGS = frozenset(
+    [
+        "web_headers",
+        "stores",
+        "store",
+        "dst_verify_remote",
+        "dst_cache_file",
+        "state_store_file",
+        "state_store_reconcile",
+        "order_cache_size",
+        "order_cache_ttl_secs",
+        "order_cache_file",
+        "outbox_file",
+        "outbox_fsync_batch",
+        "outbox_retention_days",
+        "daemon_poll_secs",
+        "daemon_jitter_secs",
+        "receiver_host",
+        "receiver_port",
+        "receiver_token",
+        "shard_count",
+        "worker_id",
+        "lease_backend",
+        "lease_file",
+        "lease_redis_url",
+        "lease_ttl_secs",
+        "max_concurrency_per_host",
+        "engine",
+        "http_pool_connections",
+        "http_pool_maxsize",
+        "http_timeout",
+        "metrics_host",
+        "metrics_port",
+        "metrics_textfile",
+        "profile_dir",
+        "record_file",
+        "replay_file",
+        "replay_speed",
+        "log_file",
+        "log_level",
+        "log_queue",
+        "log_max_bytes",
+        "log_rotate_when",
+        "log_backup_count",
+    ]
+)
+# The ways orders can be processed concurrently, see Config.engine.
+ENGINES = ("threads", "async")
+# The class keeping leases for each LEASE_BACKEND, by name so that they can be
+# defined further down.
+LEASE_BACKENDS = {"sqlite": "SQLiteLeases", "redis": "RedisLeases"}
+# How much of each order is logged, see Config.log_orders.
+ORDER_LOG_DETAILS = ("none", "compact", "full")
+# The intervals the log file can be rotated every, see Config.log_rotate_when.
+LOG_ROTATE_INTERVALS = ("S", "M", "H", "D", "MIDNIGHT") + tuple(
+    "W" + str(day) for day in range(7)
+)
+# The lowest valid value of each numeric setting.
+_SETTING_MINIMUMS = {
+    "max_email_attempts": 1,
+    "order_age_mins": 0,
+    "watermark_lookback_mins": 0,
+    "order_cache_size": 0,
+    "webhook_batch_size": 1,
+    "outbox_fsync_batch": 1,
+    "order_page_size": 1,
+    "receiver_check_delay_secs": 0,
+    "shard_count": 1,
+    "lease_ttl_secs": 1,
+    "max_concurrency": 1,
+    "max_concurrency_per_host": 1,
+    "http_pool_connections": 1,
+    "http_pool_maxsize": 1,
+    "magento_max_retries": 0,
+    "magento_rate_limit": 0,
+    "magento_circuit_threshold": 0,
+    "magento_bulk_chunk_size": 1,
+    "magento_bulk_poll_secs": 0,
+    "magento_bulk_timeout_secs": 0,
+    "replay_speed": 0,
+    "log_max_bytes": 0,
+    "log_backup_count": 0,
 }
+# Settings which can still be read as module constants, for example
+# OrderEmailResender.MAX_EMAIL_ATTEMPTS, giving the current config's value.
+_CONFIG_ATTRIBUTES = frozenset(
+    [field.name for field in dataclasses.fields(Config)]
+    + ["sales_payload_fields", "sales_order_fields"]
+)
+_default_config = None
+_default_config_lock = Lock()
+_active_config = contextvars.ContextVar("config", default=None)
 
-# TIMINGS & TIMES
-TIMEZONE = pendulum.timezone("Europe/London")
-time_now = pendulum.now(tz=TIMEZONE)
-ORDER_AGE_MINS = os.getenv("ORDER_AGE_MINS")
-SYNC_PERIOD_TIME = time_now.subtract(minutes=int(ORDER_AGE_MINS))
-SYNC_PERIOD_TIME_STR = SYNC_PERIOD_TIME.to_datetime_string()
 
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-logger.addHandler(stream_handler)
-logger.addHandler(file_handler)
+def _parse_setting(name, value, kind):
+    """Parse the value of an environment variable as the kind of setting."""
+    try:
+        if kind is bool:
+            if value.lower() not in ("true", "false"):
+                raise ValueError(value)
+            return value.lower() == "true"
+        if kind in (int, int | None):
+            return int(value)
+        if kind is float:
+            return float(value)
+        if kind is tuple:
+            return tuple(part for part in value.split(",") if part)
+        return value
+    except ValueError:
+        kind_name = "true or false" if kind is bool else "a number"
+        raise ConfigError(f"{name} must be {kind_name}, not {value!r}") from None
+
+
+def _parse_web_headers(environ, headers=None) -> dict:
+    """Build the Magento request headers from WEB_AUTH_HEADER_VALUE and the
+    WEB_SECRET_NAME and WEB_SECRET_PASS pair, on top of any headers given."""
+    headers = dict(headers or {})
+    if environ.get("WEB_AUTH_HEADER_VALUE"):
+        headers["Authorization"] = environ["WEB_AUTH_HEADER_VALUE"]
+    if environ.get("WEB_SECRET_NAME"):
+        headers[environ["WEB_SECRET_NAME"]] = environ.get("WEB_SECRET_PASS")
+    return headers
+
+
+def get_config() -> Config:
+    """Get the config in use: the one given to use_config() in this context,
+    or otherwise the one loaded from the environment (and .env) on first
+    use."""
+    global _default_config
+    config = _active_config.get()
+    if config is not None:
+        return config
+    if _default_config is None:
+        with _default_config_lock:
+            if _default_config is None:
+                load_dotenv()
+                _default_config = Config.from_env()
+    return _default_config
+
+
+@contextmanager
+def use_config(config):
+    """Use the config for everything run in this context, including the
+    orders processed in its thread pool."""
+    token = _active_config.set(config)
+    try:
+        yield config
+    finally:
+        _active_config.reset(token)
+
+
+def _configurable(function):
+    """Let the function be passed the `config` to use, for itself and all it
+    calls, instead of the one in use."""
+
+    @functools.wraps(function)
+    def wrapper(*args, config=None, **kwargs):
+        if config is None:
+            return function(*args, **kwargs)
+        with use_config(config):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def _check_shared_settings(handle, opened_with) -> None:
+    """Raise ConfigError if the config in use differs from the settings a
+    handle shared by the whole process was opened with, rather than quietly
+    using the other config's handle."""
+    config = get_config()
+    for name, value in opened_with.items():
+        if getattr(config, name) != value:
+            raise ConfigError(
+                f"{name.upper()} can't be {getattr(config, name)!r}, the "
+                f"{handle} is already open with {value!r}"
+            )
+
+
+def __getattr__(name):
+    if name.isupper() and name.lower() in _CONFIG_ATTRIBUTES:
+        return getattr(get_config(), name.lower())
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+class _StoreLogFilter(logging.Filter):
+    """Tag each log record with the store being polled when it was made."""
+
+    def filter(self, record):
+        config = _active_config.get() or _default_config
+        record.store = (config.store if config else "") or "default"
+        return True
+
+
+class _LocalQueueHandler(QueueHandler):
+    """Queue records for the listener in this process as they are, so that
+    formatting them is left to its thread too."""
+
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(config=None) -> None:
+    """Log to stdout and the (optionally rotated) log file, tagged with the
+    store, either directly or through a queue and background writer. This
+    is done once, when running as a script, rather than on import."""
+    global _log_listener
+    if _log_handlers:
+        return
+    if config is None:
+        config = get_config()
+    handlers = [logging.StreamHandler(sys.stdout), _build_log_file_handler(config)]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    if config.log_queue:
+        log_queue = queue.SimpleQueue()
+        _log_listener = QueueListener(log_queue, *handlers)
+        _log_listener.start()
+        atexit.register(stop_logging)
+        handlers = [_LocalQueueHandler(log_queue)]
+    root_logger = logging.getLogger()
+    root_logger.setLevel(config.log_level.upper())
+    for handler in handlers:
+        # The store is only known in the thread logging the record.
+        handler.addFilter(_StoreLogFilter())
+        root_logger.addHandler(handler)
+        _log_handlers.append(handler)
+
+
+def _build_log_file_handler(config) -> logging.Handler:
+    """Build the handler for the log file, rotating it if configured to."""
+    if config.log_rotate_when:
+        return TimedRotatingFileHandler(
+            config.log_file,
+            when=config.log_rotate_when,
+            backupCount=config.log_backup_count,
+        )
+    if config.log_max_bytes:
+        return RotatingFileHandler(
+            config.log_file,
+            maxBytes=config.log_max_bytes,
+            backupCount=config.log_backup_count,
+        )
+    return logging.FileHandler(config.log_file)
+
+
+def stop_logging() -> None:
+    """Write out any queued records and remove the handlers added by
+    setup_logging(), closing the log file."""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        for handler in _log_listener.handlers:
+            handler.close()
+        _log_listener = None
+    root_logger = logging.getLogger()
+    while _log_handlers:
+        handler = _log_handlers.pop()
+        root_logger.removeHandler(handler)
+        handler.close()
+
+
+def _log_order(order) -> None:
+    """Log an order before it is processed, in as much detail as LOG_ORDERS
+    asks for. The compact record is only formatted if it is written."""
+    details = get_config().log_orders
+    if details == "full":
+        logger.info(order)
+    elif details == "compact":
+        logger.info(
+            "Processing order entity_id=%s increment_id=%s status=%s"
+            " updated_at=%s comment_attempts=%s",
+            order.get("entity_id"),
+            order.get("increment_id"),
+            order.get("status"),
+            order.get("updated_at"),
+            _comment_attempts(order),
+        )
+
+
+# STATE STORE
+_state_store = None
+# The settings the state store was opened with.
+_state_store_settings = None
+_state_store_reconciling = False
+# Whether each store is being reconciled, as stores added to an existing
+# state store have no orders in it yet.
+_state_store_stores_reconciling = {}
+_state_store_lock = Lock()
+
+# ORDER CACHE
+_full_order_cache = OrderedDict()
+_full_order_cache_loaded = False
+# The settings the order cache was loaded with.
+_full_order_cache_settings = None
+_full_order_cache_lock = Lock()
+
+# WEBHOOK BATCHING
+# The escalations waiting to be sent, and when each batch was started, by
+# store.
+_escalation_batches = {}
+_escalation_batch_started = {}
+# The escalations in batches which couldn't be sent, not yet counted as
+# failed by the cycle, by store.
+_escalation_batch_failures = {}
+_escalation_batch_lock = Lock()
+
+# BULK RESENDS
+# The resends waiting to be submitted in bulk, by store.
+_bulk_resends = {}
+_bulk_resends_lock = Lock()
+# Magento's bulk operation statuses, see Magento\Framework\Bulk\OperationInterface.
+BULK_OPERATION_COMPLETE = 1
+BULK_OPERATION_OPEN = 4
+BULK_OPERATION_REJECTED = 5
+
+# OUTBOX
+_outbox = None
+# The settings the outbox was opened with.
+_outbox_settings = None
+_outbox_done = {}
+_outbox_pending = {}
+_outbox_unsynced = 0
+_outbox_replayed = set()
+_outbox_lock = Lock()
+
+# PAGING
+DEFAULT_ORDER_PAGE_SIZE = 100
+
+# DAEMON
+_cycle_lock = Lock()
+
+# RECEIVER
+RECEIVER_EVENTS = {
+    "/events/order-placed": "order_placed",
+    "/events/email-sent": "email_sent",
+}
+# How often the daemon looks for orders due to be checked.
+ORDER_CHECK_INTERVAL_SECS = 1
+# When each order is due to be checked, by store and entity ID.
+_order_checks = {}
+_order_checks_lock = Lock()
+
+# SHARDING
+_lease_backend = None
+# The settings the lease backend was opened with.
+_lease_backend_settings = None
+_lease_backend_lock = Lock()
+# The shards leased by this instance this cycle.
+_owned_shards = set()
+
+# CONCURRENCY
+_host_semaphores = {}
+_host_semaphores_lock = Lock()
+
+# ASYNC ENGINE
+# The event loop, and the session on it, the daemon keeps between cycles so
+# that connections stay open. None outside the daemon.
+_async_runner = None
+_async_session = None
+
+# HTTP
+# Every session shares the one adapter, and so the connection pools.
+_http_adapter = None
+_http_sessions = {}
+_http_sessions_lock = Lock()
+
+# RESILIENCE
+# Kept per Magento domain so one store's outage doesn't stop the others.
+# Each rate limit token bucket is (tokens, updated), full on first use.
+_magento_tokens = {}
+_magento_rate_lock = Lock()
+_magento_failures = {}
+_magento_circuit_opened_at = {}
+_magento_circuit_lock = Lock()
+
+# PROFILING
+# While a cycle is being profiled, the profilers of the worker threads it
+# starts and its trace events, in Chrome's trace event format, timed from
+# when it started.
+_profilers = None
+_trace_events = None
+_trace_started = 0.0
+_profiling_lock = Lock()
+# Path segments which are IDs, replaced to give each request's URL template.
+_URL_ID_PATTERN = re.compile(r"/(?:\d+|[0-9a-f]{8}-[0-9a-f-]{27})(?=/|$)")
+
+# RECORD & REPLAY
+_recording = None
+_recording_lock = Lock()
+# The recorded responses not yet replayed, oldest first, by request key, and
+# the last response recorded from each URL template, for requests which
+# weren't recorded themselves.
+_replay_responses = None
+_replay_fallbacks = None
+_replay_lock = Lock()
+# Search criteria values which are times, left out of the request key as
+# they move with the time window.
+_TIME_VALUE_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}")
+
+# METRICS
+METRICS_PREFIX = "order_email_resender_"
+METRICS = {
+    "orders_fetched": ("counter", "Orders fetched from Magento."),
+    "orders_skipped": ("counter", "Orders skipped, by reason."),
+    "orders_processed": ("counter", "Orders which needed resending."),
+    "orders_resent": ("counter", "Orders Magento was asked to resend."),
+    "orders_resend_refused": (
+        "counter",
+        "Orders Magento didn't agree to resend.",
+    ),
+    "orders_escalated": ("counter", "Orders manually sent to sales."),
+    "orders_failed": ("counter", "Orders which failed to be processed."),
+    "order_events_received": ("counter", "Order events received, by event."),
+    "shards_owned": ("gauge", "Shards leased by this instance."),
+    "phase_seconds": ("histogram", "Time spent in each phase of a run."),
+    "last_cycle_timestamp": ("gauge", "When the last cycle finished."),
+}
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+_metric_values = {}
+_metrics_lock = Lock()
+
+
+class NoOrdersFound(SystemExit):
+    """Raised when there are no orders to process, ending a one-shot run."""
+
+
+class MagentoUnavailable(requests.RequestException):
+    """Raised instead of calling Magento while the circuit breaker is open."""
+
+
+def _metric_key(name, labels) -> tuple:
+    """Key a metric by its name and labels, adding the store being polled."""
+    store = get_config().store
+    if store:
+        labels = dict(labels, store=store)
+    return (name, tuple(sorted(labels.items())))
+
+
+def _increment_metric(name, amount=1, **labels) -> None:
+    """Add to a counter metric."""
+    key = _metric_key(name, labels)
+    with _metrics_lock:
+        _metric_values[key] = _metric_values.get(key, 0) + amount
+
+
+def _set_metric(name, value, **labels) -> None:
+    """Set a gauge metric."""
+    key = _metric_key(name, labels)
+    with _metrics_lock:
+        _metric_values[key] = value
+
+
+def _observe_metric(name, value, **labels) -> None:
+    """Record a value in a histogram metric."""
+    key = _metric_key(name, labels)
+    with _metrics_lock:
+        if key not in _metric_values:
+            _metric_values[key] = [[0] * len(METRICS_BUCKETS), 0, 0.0]
+        buckets, _, _ = histogram = _metric_values[key]
+        for i, bound in enumerate(METRICS_BUCKETS):
+            if value <= bound:
+                buckets[i] += 1
+        histogram[1] += 1
+        histogram[2] += value
+
+
+@contextmanager
+def _time_phase(phase):
+    """Time a phase of the run into the phase latency histogram."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _observe_metric(
+            "phase_seconds", time.perf_counter() - started, phase=phase
+        )
+        if _trace_events is not None:
+            _add_trace_event(phase, "phase", started)
+
+
+def _timed(phase):
+    """Decorate a function to time each call as a phase of the run."""
+
+    def decorator(function):
+        if asyncio.iscoroutinefunction(function):
+
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with _time_phase(phase):
+                    return await function(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with _time_phase(phase):
+                return function(*args, **kwargs)
+
+        return wrapper
 
+    return decorator
 
+
+@contextmanager
+def _profile_cycle():
+    """Profile the cycle on every thread it runs on and trace its phases and
+    requests, writing cycle-<time>-<pid>.prof and .trace.json files to
+    PROFILE_DIR afterwards."""
+    global _profilers, _trace_events, _trace_started
+    config = get_config()
+    profiler = cProfile.Profile()
+    with _profiling_lock:
+        _profilers = []
+        _trace_events = []
+        _trace_started = time.perf_counter()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        with _profiling_lock:
+            profilers, _profilers = _profilers, None
+            trace_events, _trace_events = _trace_events, None
+        stats = pstats.Stats(profiler)
+        for thread_profiler in profilers:
+            stats.add(thread_profiler)
+        os.makedirs(config.profile_dir, exist_ok=True)
+        path = os.path.join(
+            config.profile_dir,
+            "cycle-" + time.strftime("%Y%m%dT%H%M%S") + "-" + str(os.getpid()),
+        )
+        stats.dump_stats(path + ".prof")
+        with open(path + ".trace.json", "w") as trace_file:
+            json.dump(
+                {"traceEvents": trace_events, "displayTimeUnit": "ms"},
+                trace_file,
+            )
+        logger.info("Cycle profile written to " + path + ".prof")
+
+
+def _start_worker_thread(config) -> None:
+    """Set up a worker thread to run with the config, profiling it along
+    with the rest of the cycle if the cycle is being profiled."""
+    _active_config.set(config)
+    with _profiling_lock:
+        if _profilers is None:
+            return
+        profiler = cProfile.Profile()
+        _profilers.append(profiler)
+    profiler.enable()
+
+
+def _add_trace_event(name, category, started, **args) -> None:
+    """Add an event lasting from started (a perf_counter() time) until now to
+    the cycle's trace."""
+    ended = time.perf_counter()
+    event = {
+        "name": name,
+        "cat": category,
+        "ph": "X",
+        "ts": round((started - _trace_started) * 1e6),
+        "dur": round((ended - started) * 1e6),
+        "pid": os.getpid(),
+        "tid": get_ident(),
+        "args": args,
+    }
+    with _profiling_lock:
+        if _trace_events is not None:
+            _trace_events.append(event)
+
+
+def _url_template(url) -> str:
+    """Get the URL's host and path with any IDs replaced, leaving out the
+    query, so requests to the same endpoint are traced under one name."""
+    url = urlsplit(url)
+    return url.netloc + _URL_ID_PATTERN.sub("/{id}", url.path)
+
+
+def _trace_request(send, method, url, **kwargs) -> requests.Response:
+    """Send a request with the session method, adding it to the cycle's trace
+    with its status, size and time to first byte."""
+    started = time.perf_counter()
+    response = None
+    try:
+        response = send(url, **kwargs)
+        return response
+    finally:
+        args = {}
+        if response is not None:
+            args = {
+                "status": response.status_code,
+                "bytes": len(response.content),
+                "ttfb_ms": response.elapsed.total_seconds() * 1000,
+            }
+        _add_trace_event(
+            method.upper() + " " + _url_template(url), "http", started, **args
+        )
+
+
+def render_metrics() -> str:
+    """Render the metrics in the Prometheus text exposition format."""
+
+    def format_labels(labels, **extra):
+        labels = list(labels) + list(extra.items())
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+    with _metrics_lock:
+        values = {
+            key: copy.deepcopy(value) for key, value in _metric_values.items()
+        }
+    lines = []
+    for name, (metric_type, help_text) in METRICS.items():
+        full_name = METRICS_PREFIX + name
+        lines.append(f"# HELP {full_name} {help_text}")
+        lines.append(f"# TYPE {full_name} {metric_type}")
+        for (key_name, labels), value in sorted(values.items()):
+            if key_name != name:
+                continue
+            if metric_type != "histogram":
+                lines.append(f"{full_name}{format_labels(labels)} {value}")
+                continue
+            buckets, count, total = value
+            for bound, bucket_count in zip(METRICS_BUCKETS, buckets):
+                lines.append(
+                    f"{full_name}_bucket{format_labels(labels, le=bound)}"
+                    f" {bucket_count}"
+                )
+            lines.append(
+                f"{full_name}_bucket{format_labels(labels, le='+Inf')} {count}"
+            )
+            lines.append(f"{full_name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{full_name}_count{format_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics_textfile() -> None:
+    """Atomically write the metrics for a textfile collector to pick up."""
+    metrics_textfile = get_config().metrics_textfile
+    if not metrics_textfile:
+        return
+    temp_file = metrics_textfile + ".tmp"
+    with open(temp_file, "w") as metrics_file:
+        metrics_file.write(render_metrics())
+    os.replace(temp_file, metrics_textfile)
+
+
+def start_metrics_server(port=None) -> ThreadingHTTPServer:
+    """Serve the metrics over HTTP at /metrics from a background thread."""
+    config = get_config()
+    if port is None:
+        port = config.metrics_port
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = render_metrics().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((config.metrics_host, port), MetricsHandler)
+    Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info("Serving metrics on port " + str(server.server_address[1]))
+    return server
+
+
+def refresh_sync_period() -> None:
+    """Recompute the time window to search for unsent orders from the current
+    time. The daylight savings compensation must be reapplied afterwards."""
+    global time_now, SYNC_PERIOD_TIME, SYNC_PERIOD_TIME_STR, _dst_compensated
+    time_now = pendulum.now(tz=TIMEZONE)
+    _dst_compensated = False
+    SYNC_PERIOD_TIME = time_now.subtract(minutes=get_config().order_age_mins)
+    SYNC_PERIOD_TIME_STR = SYNC_PERIOD_TIME.to_datetime_string()
+
+
+def _sync_period_time_str() -> str:
+    """Get the start of the search window for the config in use, from the
+    current time and DST compensation shared by every store."""
+    if time_now is None:
+        refresh_sync_period()
+    sync_period_time = time_now.subtract(minutes=get_config().order_age_mins)
+    if _dst_compensated:
+        sync_period_time = sync_period_time.subtract(hours=1)
+    return sync_period_time.to_datetime_string()
+
+
+@_timed("dst_lookup")
 def check_daylight_savings_time():
-    """Fetch the Time API to determine whether daylight savings is in effect.
-    This is required because of a Magento API bug which doesn't account for BST
-    and so we need to manually compensate when clocks go forward."""
-    global SYNC_PERIOD_TIME_STR
-    headers = {"accept": "application/json"}
-    time_response = requests.get(
-        "https://timeapi.io/api/timezone/zone?timeZone=Europe%2FLondon",
-        headers=headers,
-    )
-    response_json = time_response.json()
-    # The JSON response object should have a 'isDayLightSavingActive' property.
-    if "isDayLightSavingActive" in response_json:
-        active_DST = True if response_json["isDayLightSavingActive"] else False
-    else:
-        # Assume DST as this will cover a larger time period.
-        active_DST = True
+    """Determine whether daylight savings is in effect from the local timezone
+    data. This is required because of a Magento API bug which doesn't account
+    for BST and so we need to manually compensate when clocks go forward."""
+    global SYNC_PERIOD_TIME_STR, _dst_compensated
+    if time_now is None:
+        refresh_sync_period()
+    active_DST = time_now.is_dst()
+    if get_config().dst_verify_remote:
+        remote_DST = _fetch_remote_daylight_savings_time()
+        if remote_DST is not None and remote_DST != active_DST:
+            logger.warning(
+                "Local DST (" + str(active_DST) + ") disagrees with the "
+                "Time API (" + str(remote_DST) + ")"
+            )
+            # Assume DST as this will cover a larger time period.
+            active_DST = True
+    _dst_compensated = active_DST
     if active_DST:
         SYNC_PERIOD_TIME_STR = SYNC_PERIOD_TIME.subtract(
             hours=1
         ).to_datetime_string()
 
 
-def fetch_unsent_orders() -> list:
-    """Build and send a request to Magento to fetch unsent orders."""
-    WEB_ORDER_FIELDS = (
-        "items["
-        + "entity_id,increment_id,email_sent,status,status_histories[comment]"
-        + "]"
-        + ",errors,message,code,trace,parameters,total_count"
-    )
-    WEB_ORDER_EP = WEB_DOMAIN + os.getenv("WEB_ORDERS_API_ENDPOINT")
-    # Two 'filter_groups' which combine to form an AND relationship in the criteria.
+def _fetch_remote_daylight_savings_time():
+    """Fetch the Time API to verify whether daylight savings is in effect,
+    caching the answer on disk for the rest of the day. Returns None when the
+    Time API can't give an answer."""
+    dst_cache_file = get_config().dst_cache_file
+    today = pendulum.now(tz=TIMEZONE).to_date_string()
+    try:
+        with open(dst_cache_file) as cache_file:
+            cache = json.load(cache_file)
+        if cache["date"] == today:
+            return cache["isDayLightSavingActive"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    headers = {"accept": "application/json"}
+    try:
+        time_response = _external_request(
+            "get",
+            "https://timeapi.io/api/timezone/zone?timeZone=Europe%2FLondon",
+            headers=headers,
+        )
+        response_json = time_response.json()
+    except (requests.RequestException, ValueError) as e:
+        logger.warning("Time API unavailable: " + repr(e))
+        return None
+    # The JSON response object should have a 'isDayLightSavingActive' property.
+    if "isDayLightSavingActive" not in response_json:
+        return None
+    active_DST = True if response_json["isDayLightSavingActive"] else False
+    try:
+        with open(dst_cache_file, "w") as cache_file:
+            json.dump(
+                {"date": today, "isDayLightSavingActive": active_DST},
+                cache_file,
+            )
+    except OSError as e:
+        logger.warning("Could not cache DST lookup: " + repr(e))
+    return active_DST
+
+
+WEB_ORDER_FIELDS = (
+    "items["
+    + "entity_id,increment_id,email_sent,status,updated_at,"
+    + "status_histories[comment]"
+    + "]"
+    + ",errors,message,code,trace,parameters,total_count"
+)
+# Without the comment history, for when the state store counts attempts.
+WEB_ORDER_FIELDS_WITHOUT_HISTORIES = (
+    "items["
+    + "entity_id,increment_id,email_sent,status,updated_at"
+    + "]"
+    + ",errors,message,code,trace,parameters,total_count"
+)
+
+
+class Order(Mapping):
+    """An order from the search, parsed once as it is fetched. Only the
+    fields the pipeline uses are kept, and the comment history is reduced
+    to the number of resend attempts it records (None if it wasn't fetched)
+    so the comments themselves can be freed straight away. Orders can still
+    be read like the dicts they came from, as can the outbox's orders."""
+
+    __slots__ = (
+        "entity_id",
+        "increment_id",
+        "status",
+        "email_sent",
+        "updated_at",
+        "comment_attempts",
+    )
+    FIELDS = __slots__[:-1]
+
+    def __init__(
+        self,
+        entity_id=None,
+        increment_id=None,
+        status=None,
+        email_sent=None,
+        updated_at=None,
+        comment_attempts=None,
+    ):
+        self.entity_id = entity_id
+        self.increment_id = increment_id
+        self.status = status
+        self.email_sent = email_sent
+        self.updated_at = updated_at
+        self.comment_attempts = comment_attempts
+
+    @classmethod
+    def from_json(cls, item, comment_prefix=None) -> "Order":
+        """Parse an order from the search, counting its resend attempts in
+        one pass over its comments. Missing fields are left as None, for
+        the order to fail on its own when processed."""
+        histories = item.get("status_histories")
+        if histories is None:
+            comment_attempts = None
+        else:
+            if comment_prefix is None:
+                comment_prefix = get_config().comment_prefix
+            comment_attempts = sum(
+                1
+                for history in histories
+                if (history.get("comment") or "").startswith(comment_prefix)
+            )
+        return cls(
+            item.get("entity_id"),
+            item.get("increment_id"),
+            item.get("status"),
+            item.get("email_sent"),
+            item.get("updated_at"),
+            comment_attempts,
+        )
+
+    def __getitem__(self, field):
+        if field in Order.FIELDS:
+            value = getattr(self, field)
+            if value is not None:
+                return value
+        raise KeyError(field)
+
+    def __iter__(self):
+        return (field for field in Order.FIELDS if getattr(self, field) is not None)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return "Order(" + ", ".join(
+            field + "=" + repr(getattr(self, field)) for field in Order.__slots__
+        ) + ")"
+
+
+def _parse_orders(items) -> list:
+    """Parse the orders from a page of search results."""
+    comment_prefix = get_config().comment_prefix
+    return [Order.from_json(item, comment_prefix) for item in items]
+
+
+def _build_order_criteria(
+    page_size=None, after_entity_id=None, watermark=None, entity_ids=None
+) -> dict:
+    """Build the Magento searchCriteria query parameters for unsent orders,
+    optionally restricted to a page of results: the first page_size orders
+    after the after_entity_id. With a watermark only orders updated since it
+    (less the lookback), or still pending, are searched for, with entity IDs
+    only those orders, otherwise orders created within the sync period are."""
+    config = get_config()
+    pending_filter = None
+    if entity_ids is not None:
+        window_field = "entity_id"
+        window_start = ",".join(str(entity_id) for entity_id in entity_ids)
+    elif watermark is not None:
+        window_field = "updated_at"
+        window_start = (
+            pendulum.parse(watermark["updated_at"])
+            .subtract(minutes=config.watermark_lookback_mins)
+            .to_datetime_string()
+        )
+        pending_filter = _pending_order_filter()
+    else:
+        window_field = "created_at"
+        window_start = _sync_period_time_str()
+    # 'filter_groups' combine to form an AND relationship in the criteria.
     order_criteria_parameters = {
-        "searchCriteria[filter_groups][0][filters][0][field]": "created_at",
-        "searchCriteria[filter_groups][0][filters][0][value]": SYNC_PERIOD_TIME_STR,
-        "searchCriteria[filter_groups][0][filters][0][condition_type]": "gteq",
-        # "searchCriteria[filter_groups][1][filters][0][field]": "email_sent",
-        # "searchCriteria[filter_groups][1][filters][0][value]": 0,
-        # "searchCriteria[filter_groups][1][filters][0][condition_type]": "eq",
-        "fields": WEB_ORDER_FIELDS,
+        "searchCriteria[filter_groups][0][filters][0][field]": window_field,
+        "searchCriteria[filter_groups][0][filters][0][value]": window_start,
+        "searchCriteria[filter_groups][0][filters][0][condition_type]": (
+            "in" if entity_ids is not None else "gteq"
+        ),
+        "fields": (
+            WEB_ORDER_FIELDS
+            if _needs_status_histories()
+            else WEB_ORDER_FIELDS_WITHOUT_HISTORIES
+        ),
     }
-    # logger.info("Headers: " + str(WEB_HEADERS))
-    # logger.info("EP: " + str(WEB_ORDER_EP))
-    raw_order_response = requests.get(
-        WEB_ORDER_EP, headers=WEB_HEADERS, params=order_criteria_parameters
+    if pending_filter is not None:
+        # Filters within a group are OR'd, so pending orders are fetched
+        # again whether or not they have been updated since the watermark.
+        field, value, condition_type = pending_filter
+        order_criteria_parameters.update(
+            {
+                "searchCriteria[filter_groups][0][filters][1][field]": field,
+                "searchCriteria[filter_groups][0][filters][1][value]": value,
+                "searchCriteria[filter_groups][0][filters][1][condition_type]": (
+                    condition_type
+                ),
+            }
+        )
+    if config.server_side_filter:
+        # Filters within a group are OR'd, so an unsent order is one where
+        # 'email_sent' is either 0 or has never been set (NULL).
+        order_criteria_parameters.update(
+            {
+                "searchCriteria[filter_groups][1][filters][0][field]": "email_sent",
+                "searchCriteria[filter_groups][1][filters][0][value]": 0,
+                "searchCriteria[filter_groups][1][filters][0][condition_type]": "eq",
+                "searchCriteria[filter_groups][1][filters][1][field]": "email_sent",
+                "searchCriteria[filter_groups][1][filters][1][value]": 1,
+                "searchCriteria[filter_groups][1][filters][1][condition_type]": "null",
+                "searchCriteria[filter_groups][2][filters][0][field]": "status",
+                "searchCriteria[filter_groups][2][filters][0][value]": ",".join(
+                    SKIPPED_ORDER_STATUSES
+                ),
+                "searchCriteria[filter_groups][2][filters][0][condition_type]": "nin",
+            }
+        )
+    if page_size is not None:
+        # Pages are walked by entity ID rather than by page number, as orders
+        # drop out of the results once they are resent and would shift any
+        # later page back over orders not yet seen.
+        order_criteria_parameters.update(
+            {
+                "searchCriteria[sortOrders][0][field]": "entity_id",
+                "searchCriteria[sortOrders][0][direction]": "ASC",
+                "searchCriteria[pageSize]": page_size,
+                "searchCriteria[currentPage]": 1,
+            }
+        )
+    if after_entity_id is not None:
+        group = "searchCriteria[filter_groups][" + str(
+            3 if config.server_side_filter else 1
+        ) + "][filters][0]"
+        order_criteria_parameters.update(
+            {
+                group + "[field]": "entity_id",
+                group + "[value]": after_entity_id,
+                group + "[condition_type]": "gt",
+            }
+        )
+    return order_criteria_parameters
+
+
+def _pending_order_filter():
+    """Get the (field, value, condition_type) filter matching the orders an
+    incremental poll must fetch again, as resending an order's email doesn't
+    always change its 'updated_at': the orders in the state store resent
+    within the sync period and not yet escalated. None if there are none."""
+    entity_ids = get_pending_entity_ids()
+    if not entity_ids:
+        return None
+    return (
+        "entity_id",
+        ",".join(str(entity_id) for entity_id in entity_ids),
+        "in",
     )
-    # logger.info("Raw order response from Magento: " + str(raw_order_response))
-    # logger.info("Content: " + str(raw_order_response.content))
-    json_response = raw_order_response.json()
+
+
+def _check_order_response(json_response) -> None:
+    """Log and exit if the order search response holds no orders to process."""
     if "total_count" not in json_response:
         if "errors" in json_response and (len(json_response["errors"]) > 0):
             logger.info("Errors" + json.dumps(json_response["errors"]))
@@ -101,152 +1412,2674 @@ def fetch_unsent_orders() -> list:
         elif "message" in json_response:
             logger.info("Message" + json.dumps(json_response["message"]))
         elif "items" in json_response and json_response["items"]:
-            logger.info("No orders found since" + SYNC_PERIOD_TIME_STR)
+            logger.info("No orders found since" + _sync_period_time_str())
         else:
             logger.info(
                 "Something happened where the response didn't contain 'total_count' but 'items' wasn't NULL."
             )
         logger.info("Exiting")
-        sys.exit(0)
+        raise NoOrdersFound(0)
     elif json_response["total_count"] == 0:
-        logger.info("No orders found since" + SYNC_PERIOD_TIME_STR)
+        logger.info("No orders found since" + _sync_period_time_str())
         logger.info("Exiting")
-        sys.exit(0)
+        raise NoOrdersFound(0)
     else:
         logger.info(
             "Found "
             + str(json_response["total_count"])
             + " orders since "
-            + SYNC_PERIOD_TIME_STR
+            + _sync_period_time_str()
         )
-    return list(json_response["items"])
 
 
-def process_orders(orders: list) -> None:
-    """Process each unsent order by either attempting a recorded resend or
-    manually sending the details to sales and alerting admin. Either way, log
-    the outcome."""
-    for order in orders:
-        if "email_sent" in order:
-            continue
-        if order["status"] in ["canceled", "pending_payment"]:
-            continue
-        logger.info(order)
-        attempts = _check_resend_attempts(order)
-        order_outcome = f"Order {order['increment_id']} "
-        if attempts >= MAX_EMAIL_ATTEMPTS:
-            _alert_admin(order)
-            _email_order_to_sales(order)
-            order_outcome += "exceeded resend attempts in Magento and has been manually sent to sales."
-        else:
-            sent = _resend_order_with_magento(order)
-            if sent:
-                order_outcome += f"has been sent for a resend attempt. "
-            else:
-                order_outcome += f"should have been resent with Magento but something went wrong. "
-            order_outcome += f"This is attempt number {attempts + 1}"
-        _log_order_outcome(order_outcome)
+@_configurable
+def fetch_unsent_orders(watermark=None) -> list:
+    """Build and send a request to Magento to fetch unsent orders."""
+    config = get_config()
+    WEB_ORDER_EP = config.web_domain + config.web_orders_api_endpoint
+    order_criteria_parameters = _build_order_criteria(watermark=watermark)
+    # logger.info("EP: " + str(WEB_ORDER_EP))
+    with _time_phase("fetch_unsent_orders"):
+        raw_order_response = _magento_request(
+            "get", WEB_ORDER_EP, params=order_criteria_parameters
+        )
+    # logger.info("Raw order response from Magento: " + str(raw_order_response))
+    # logger.info("Content: " + str(raw_order_response.content))
+    json_response = raw_order_response.json()
+    _check_order_response(json_response)
+    _increment_metric("orders_fetched", len(json_response["items"]))
+    return _parse_orders(json_response["items"])
 
 
-def _check_resend_attempts(order) -> int:
-    """Check the order's comments to parse how many attempts have been made
-    to resend the order email already."""
-    if "status_histories" not in order:
-        return 0
-    order_comments = order["status_histories"]
-    if len(order_comments) == 0:
-        return 0
-    attempts = sum(
-        1
-        for n in order_comments
-        if n["comment"] and n["comment"].startswith(COMMENT_PREFIX)
-    )
-    return attempts
+def fetch_unsent_orders_paged(page_size=None, watermark=None, config=None):
+    """Fetch unsent orders from Magento one page at a time, yielding each
+    order as soon as its page arrives so processing can start on the first
+    page while later pages are still to be requested."""
+    if config is None:
+        config = get_config()
+    if page_size is None:
+        page_size = config.order_page_size or DEFAULT_ORDER_PAGE_SIZE
+    if page_size < 1:
+        raise ValueError("Page size must be at least 1")
+    return _fetch_order_pages(config, page_size, watermark)
 
 
-def _alert_admin(order) -> None:
-    """Alert the admin that an order has reached the maximum number of resend
-    retries and will be manually sent to the sales inbox."""
-    ALERT_WEBHOOK_URL = os.getenv("ALERT_WEBHOOK_URL")
-    if "entity_id" not in order:
-        raise ValueError("Invalid order object")
-    if "increment_id" not in order:
-        raise ValueError("Invalid order object")
+def _fetch_order_pages(config, page_size, watermark):
+    """Yield the orders from each page in turn. The config is only used
+    while fetching, as the caller's context is in use between pages."""
+    WEB_ORDER_EP = config.web_domain + config.web_orders_api_endpoint
+    after_entity_id = None
+    while True:
+        with use_config(config), _time_phase("fetch_unsent_orders"):
+            raw_order_response = _magento_request(
+                "get",
+                WEB_ORDER_EP,
+                params=_build_order_criteria(
+                    page_size, after_entity_id, watermark
+                ),
+            )
+            json_response = raw_order_response.json()
+            if after_entity_id is None:
+                _check_order_response(json_response)
+            items = _parse_orders(json_response.get("items") or [])
+        _increment_metric("orders_fetched", len(items))
+        # Let the page's JSON go before its orders are processed.
+        total_count = json_response.get("total_count", 0)
+        del json_response
+        after_entity_id = _next_page_after(items, page_size, total_count)
+        yield from items
+        if after_entity_id is None:
+            return
 
-    order_id = order["entity_id"]
-    incr_id = order["increment_id"]
-    payload = {
-        "entity_id": order_id,
-        "increment_id": incr_id,
-        "message": f"Order {incr_id} ({order_id})"
-        + " could not be sent by Magento and has been manually sent to sales.",
-    }
-    requests.post(ALERT_WEBHOOK_URL, json=payload)
 
+def _next_page_after(items, page_size, total_count):
+    """Get the entity ID the page after this one starts after, or None if
+    this is the last page. The total counts the orders from this page on."""
+    if len(items) < page_size or total_count <= len(items):
+        return None
+    return items[-1].get("entity_id")
 
-def _email_order_to_sales(order) -> None:
-    """Email the order details to the sales inbox manually."""
-    if "entity_id" not in order:
-        raise ValueError("No entity ID present on order.")
-    WEB_ORDER_API_ENDPOINT = os.getenv("WEB_DOMAIN") + os.getenv(
-        "WEB_ORDER_API_ENDPOINT"
-    )
-    EMAIL_WEBHOOK_URL = os.getenv("EMAIL_WEBHOOK_URL")
-    get_order_url = WEB_ORDER_API_ENDPOINT + str(order["entity_id"])
-    api_response = requests.get(get_order_url)
-    if api_response.status_code != 200:
-        raise api_response.raise_for_status()
-    full_order = api_response.json()
-    # Using the first instance of shipping assignment which
-    # works for FFD's business logic.
-    order_payload = {
-        "customer_name": full_order["customer_name"],
-        "increment_id": full_order["increment_id"],
-        "billing_address": full_order["billing_address"],
-        "shipping_address": full_order["extension_attributes"][
-            "shipping_assignments"
-        ][0]["shipping"]["address"],
-        "payment_method": full_order["payment"]["method"],
-        "shipping_method": full_order["extension_attributes"][
-            "shipping_assignments"
-        ][0]["shipping"]["method"],
-        "items": full_order["items"],
-        "shipping_cost": full_order["extension_attributes"][
-            "shipping_assignments"
-        ][0]["shipping"]["total"],
-        "subtotal": full_order["subtotal"],
-        "grand_total": full_order["grand_total"],
-        "order_comment": full_order[os.getenv("WEB_ORDER_COMMENT_FIELD")],
-    }
-    webhook_response = requests.post(EMAIL_WEBHOOK_URL, json=order_payload)
-    if webhook_response.status_code != 200:
-        raise webhook_response.raise_for_status()
 
+@_configurable
+def process_orders(orders: list, max_workers=None) -> int:
+    """Process each unsent order by either attempting a recorded resend or
+    manually sending the details to sales and alerting admin. Either way, log
+    the outcome. With more than one worker, orders are processed concurrently
+    in a bounded thread pool. Returns the number of orders which failed."""
+    failed = _process_all_orders(orders, max_workers)
+    failed += flush_bulk_resends()
+    # Send whatever escalations are still waiting to be batched.
+    flush_escalations()
+    return failed + _take_escalation_failures()
 
-def _resend_order_with_magento(order) -> bool:
+
+def _process_all_orders(orders, max_workers=None) -> int:
+    """Process the orders in turn or in the thread pool, returning the
+    number of orders which failed."""
+    config = get_config()
+    if max_workers is None:
+        max_workers = config.max_concurrency
+    orders = (order for order in orders if _order_needs_processing(order))
+    if max_workers <= 1:
+        failed = 0
+        for order in orders:
+            try:
+                _process_order(order)
+            except Exception as e:
+                _log_order_failure(order, e)
+                failed += 1
+        return failed
+    with ThreadPoolExecutor(
+        max_workers=max_workers,
+        thread_name_prefix="order",
+        initializer=_start_worker_thread,
+        initargs=(config,),
+    ) as executor:
+        # Only keep a couple of orders queued per worker so that a paged
+        # fetch isn't drained into memory ahead of the workers.
+        in_flight = {}
+        failed = 0
+        for order in orders:
+            if len(in_flight) >= max_workers * 2:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    failed += _check_order_future(future, in_flight.pop(future))
+            in_flight[executor.submit(_process_order, order)] = order
+        for future in as_completed(in_flight):
+            failed += _check_order_future(future, in_flight[future])
+    return failed
+
+
+def _order_needs_processing(order) -> bool:
+    """Check whether the order still needs its email sending."""
+    if order.get("email_sent"):
+        _increment_metric("orders_skipped", reason="email_sent")
+        return False
+    if order["status"] in SKIPPED_ORDER_STATUSES:
+        _increment_metric("orders_skipped", reason="status")
+        return False
+    if get_config().shard_count > 1 and not _lease_order(order):
+        _increment_metric("orders_skipped", reason="leased")
+        return False
+    _increment_metric("orders_processed")
+    return True
+
+
+def _process_order(order) -> None:
+    """Resend or escalate a single unsent order and log the outcome."""
+    config = get_config()
+    _log_order(order)
+    attempts = _check_resend_attempts(order)
+    if attempts >= config.max_email_attempts and config.webhook_batching:
+        # The outcome is logged once the batch has been sent.
+        _queue_escalation(order)
+        return
+    elif attempts >= config.max_email_attempts:
+        _run_outbox_action("alert", order)
+        _run_outbox_action("email_sales", order)
+        outcome = "escalated"
+    elif config.magento_bulk_resend:
+        # The outcome is logged once the bulk resend has finished.
+        _queue_bulk_resend(order, attempts)
+        return
+    else:
+        sent = _run_outbox_action("resend", order, attempts + 1)
+        outcome = "resent" if sent else "resend_failed"
+    _finish_order(order, attempts, outcome)
+
+
+def _finish_order(order, attempts, outcome) -> None:
+    """Record, count and log the outcome of an order: "escalated" to sales,
+    or "resent" or "resend_failed" by Magento."""
+    # The order has been dealt with, so it doesn't need checking again.
+    cancel_order_check(order.get("entity_id"))
+    order_outcome = f"Order {order['increment_id']} "
+    if outcome == "escalated":
+        _increment_metric("orders_escalated")
+        _record_order_outcome(order, "escalated", escalated=True)
+        order_outcome += "exceeded resend attempts in Magento and has been manually sent to sales."
+    else:
+        sent = outcome == "resent"
+        _record_order_outcome(order, outcome, resent=True)
+        _increment_metric("orders_resent" if sent else "orders_resend_refused")
+        if sent:
+            order_outcome += f"has been sent for a resend attempt. "
+        else:
+            order_outcome += f"should have been resent with Magento but something went wrong. "
+        order_outcome += f"This is attempt number {attempts + 1}"
+    _log_order_outcome(order_outcome)
+
+
+def _check_order_future(future, order) -> bool:
+    """Log the outcome of an order which failed while being processed
+    concurrently. Returns whether the order failed."""
+    error = future.exception()
+    if error is None:
+        return False
+    _log_order_failure(order, error)
+    return True
+
+
+def _log_order_failure(order, error) -> None:
+    """Log the outcome of an order which failed, so one failure doesn't stop
+    the other orders."""
+    _increment_metric("orders_failed")
+    _log_order_outcome(
+        f"Order {order.get('increment_id')} could not be processed: {error!r}"
+    )
+
+
+@contextmanager
+def _host_limit(url):
+    """Limit the number of concurrent requests made to the URL's host."""
+    host = urlsplit(url).netloc
+    with _host_semaphores_lock:
+        if host not in _host_semaphores:
+            _host_semaphores[host] = BoundedSemaphore(
+                get_config().max_concurrency_per_host
+            )
+        semaphore = _host_semaphores[host]
+    with semaphore:
+        yield
+
+
+def get_http_session(name) -> requests.Session:
+    """Get the shared, connection pooling session for either "magento"
+    requests, which carry the config's web headers, or "external" requests
+    such as the webhooks, which don't. Connections are kept alive between
+    requests. Configs with different headers, such as each store's, get
+    their own session but share the connection pools."""
+    global _http_adapter
+    config = get_config()
+    headers = config.web_headers if name == "magento" else {}
+    key = (name, tuple(sorted(headers.items(), key=str)))
+    with _http_sessions_lock:
+        if key not in _http_sessions:
+            if _http_adapter is None:
+                _http_adapter = HTTPAdapter(
+                    pool_connections=config.http_pool_connections,
+                    pool_maxsize=config.http_pool_maxsize,
+                )
+            session = requests.Session()
+            session.mount("https://", _http_adapter)
+            session.mount("http://", _http_adapter)
+            session.headers.update(headers)
+            _http_sessions[key] = session
+        return _http_sessions[key]
+
+
+def _http_request(session, method, url, **kwargs) -> requests.Response:
+    """Send a request through the session, bounded by the per-host limit and
+    the default timeout."""
+    config = get_config()
+    kwargs.setdefault("timeout", config.http_timeout)
+    if config.replay_file:
+        return _replay_request(method, url, kwargs.get("params"))
+    with _host_limit(url):
+        if _trace_events is not None:
+            response = _trace_request(getattr(session, method), method, url, **kwargs)
+        else:
+            response = getattr(session, method)(url, **kwargs)
+    if config.record_file:
+        _record_response(
+            method,
+            url,
+            kwargs.get("params"),
+            response,
+            response.elapsed.total_seconds(),
+        )
+    return response
+
+
+def _magento_request(method, url, **kwargs) -> requests.Response:
+    """Send an authenticated request to the Magento API, rate limited and
+    retried with jittered exponential backoff on throttling, server errors and
+    connection failures, though only where a retry is safe, see
+    _can_retry_error(). Raises MagentoUnavailable while the circuit breaker
+    is open."""
+    max_retries = get_config().magento_max_retries
+    session = get_http_session("magento")
+    for attempt in range(max_retries + 1):
+        _check_magento_circuit()
+        _take_magento_token()
+        last_attempt = attempt == max_retries
+        try:
+            response = _http_request(session, method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            _record_magento_result(False)
+            if last_attempt or not _can_retry_error(method, e):
+                raise
+            logger.warning("Magento request failed: " + repr(e))
+            time.sleep(_retry_delay(attempt))
+            continue
+        if response.status_code != 429 and response.status_code < 500:
+            _record_magento_result(True)
+            return response
+        _record_magento_result(False)
+        if last_attempt or not _can_retry_response(method, response):
+            return response
+        logger.warning(
+            "Magento responded " + str(response.status_code) + ", retrying"
+        )
+        time.sleep(_retry_delay(attempt, response))
+    return response
+
+
+def _can_retry_error(method, error) -> bool:
+    """Check whether a request which failed can be retried. Reads always
+    can, but other requests, like a resend, may have been carried out by
+    Magento before failing, so are only retried if they never got there."""
+    if method.lower() == "get":
+        return True
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if aiohttp is not None and isinstance(
+        error, (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError)
+    ):
+        return True
+    # requests wraps failures to connect in a MaxRetryError, and failures
+    # once connected in the error itself.
+    cause = error.args[0] if error.args else None
+    return isinstance(cause, MaxRetryError) and isinstance(
+        cause.reason, NewConnectionError
+    )
+
+
+def _can_retry_response(method, response) -> bool:
+    """Check whether a request Magento responded to with throttling or a
+    server error can be retried. Throttled requests weren't carried out, but
+    of the others only reads can be repeated safely, unless Magento says
+    with a 503 and Retry-After that it is unavailable."""
+    if method.lower() == "get" or response.status_code == 429:
+        return True
+    headers = getattr(response, "headers", None) or {}
+    return response.status_code == 503 and "Retry-After" in headers
+
+
+def _retry_delay(attempt, response=None) -> float:
+    """Get how long to wait before retrying, honouring Retry-After."""
+    config = get_config()
+    max_backoff = config.magento_retry_max_backoff_secs
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return min(float(headers["Retry-After"]), max_backoff)
+    except (KeyError, ValueError):
+        pass
+    backoff = min(config.magento_retry_backoff_secs * 2**attempt, max_backoff)
+    # Full jitter so that concurrent workers don't retry in lockstep.
+    return random.uniform(0, backoff)
+
+
+def _take_magento_token() -> None:
+    """Wait for a token from the Magento rate limit's token bucket."""
+    while True:
+        wait_secs = _try_take_magento_token()
+        if not wait_secs:
+            return
+        time.sleep(wait_secs)
+
+
+def _try_take_magento_token() -> float:
+    """Take a token from the Magento rate limit's token bucket if there is
+    one, returning 0, or else return how long to wait for the next one."""
+    config = get_config()
+    rate_limit = config.magento_rate_limit
+    if rate_limit <= 0:
+        return 0
+    with _magento_rate_lock:
+        now = time.monotonic()
+        tokens, updated = _magento_tokens.get(
+            config.web_domain, (config.magento_rate_burst, now)
+        )
+        tokens = min(
+            config.magento_rate_burst, tokens + (now - updated) * rate_limit
+        )
+        if tokens >= 1:
+            _magento_tokens[config.web_domain] = (tokens - 1, now)
+            return 0
+        _magento_tokens[config.web_domain] = (tokens, now)
+        return (1 - tokens) / rate_limit
+
+
+def _check_magento_circuit() -> None:
+    """Raise MagentoUnavailable if the circuit breaker is open. Once the
+    reset time has passed requests are let through again to test Magento."""
+    config = get_config()
+    with _magento_circuit_lock:
+        opened_at = _magento_circuit_opened_at.get(config.web_domain)
+        if opened_at is None:
+            return
+        if time.monotonic() - opened_at < config.magento_circuit_reset_secs:
+            raise MagentoUnavailable(
+                "Magento circuit breaker is open after "
+                + str(_magento_failures.get(config.web_domain, 0))
+                + " failures"
+            )
+
+
+def _record_magento_result(success) -> None:
+    """Close the circuit breaker on success, or open it after too many
+    consecutive failures."""
+    config = get_config()
+    domain = config.web_domain
+    with _magento_circuit_lock:
+        if success:
+            _magento_failures.pop(domain, None)
+            _magento_circuit_opened_at.pop(domain, None)
+            return
+        _magento_failures[domain] = _magento_failures.get(domain, 0) + 1
+        if _magento_failures[domain] >= config.magento_circuit_threshold > 0:
+            if domain not in _magento_circuit_opened_at:
+                logger.warning("Opening the Magento circuit breaker")
+            _magento_circuit_opened_at[domain] = time.monotonic()
+
+
+def reset_magento_circuit() -> None:
+    """Close the circuit breakers and refill the rate limits' token buckets
+    of every Magento domain."""
+    with _magento_circuit_lock:
+        _magento_failures.clear()
+        _magento_circuit_opened_at.clear()
+    with _magento_rate_lock:
+        _magento_tokens.clear()
+
+
+def _external_request(method, url, **kwargs) -> requests.Response:
+    """Send a request to a service outside Magento, like a webhook."""
+    return _http_request(get_http_session("external"), method, url, **kwargs)
+
+
+def _redact_url(url) -> str:
+    """Replace the store's domain and webhook URLs in the URL with
+    placeholders, so that a recording holds no secrets kept in them and can
+    be replayed against other settings."""
+    config = get_config()
+    for setting in ("alert_webhook_url", "email_webhook_url", "web_domain"):
+        value = getattr(config, setting)
+        if value and url.startswith(value):
+            return "{" + setting + "}" + url[len(value) :]
+    return url
+
+
+def _replay_key(method, url, params=None) -> str:
+    """Get the key a request is recorded and replayed under: its method,
+    redacted URL and query parameters, leaving out any times in them."""
+    url = urlsplit(_redact_url(url))
+    parameters = parse_qsl(url.query) + list((params or {}).items())
+    query = sorted(
+        (name, "*" if _TIME_VALUE_PATTERN.match(str(value)) else str(value))
+        for name, value in parameters
+    )
+    return method.upper() + " " + url.path + "?" + urlencode(query)
+
+
+def _record_response(method, url, params, response, secs) -> None:
+    """Append the response to the request to RECORD_FILE. Each cycle is
+    written as its own gzip member, see close_recording()."""
+    global _recording
+    record_file = get_config().record_file
+    record = {
+        "key": _replay_key(method, url, params),
+        "template": method.upper() + " " + _url_template(_redact_url(url)),
+        "status": response.status_code,
+        "secs": round(secs, 4),
+        "body": response.content.decode(errors="replace"),
+    }
+    with _recording_lock:
+        if _recording is None:
+            _recording = gzip.open(record_file, "at", encoding="utf-8")
+        _recording.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+
+def close_recording() -> None:
+    """Finish the recording's current gzip member, so that it can be read
+    while later cycles carry on appending to it."""
+    global _recording
+    with _recording_lock:
+        if _recording is not None:
+            _recording.close()
+            _recording = None
+
+
+def _next_replay_record(method, url, params=None) -> dict:
+    """Take the next recorded response to the request, or the last one
+    recorded from its URL template if it wasn't recorded, loading REPLAY_FILE
+    on first use. Raises ConnectionError if there is neither, as if the
+    request had failed."""
+    global _replay_responses, _replay_fallbacks
+    key = _replay_key(method, url, params)
+    with _replay_lock:
+        if _replay_responses is None:
+            _replay_responses = {}
+            _replay_fallbacks = {}
+            with gzip.open(get_config().replay_file, "rt", encoding="utf-8") as replay:
+                for line in replay:
+                    record = json.loads(line)
+                    _replay_responses.setdefault(record["key"], deque()).append(
+                        record
+                    )
+                    _replay_fallbacks[record["template"]] = record
+        if _replay_responses.get(key):
+            return _replay_responses[key].popleft()
+    template = method.upper() + " " + _url_template(_redact_url(url))
+    if template in _replay_fallbacks:
+        return _replay_fallbacks[template]
+    raise requests.ConnectionError("No recorded response to " + key)
+
+
+def _replay_delay(record) -> float:
+    """Get how long to take answering the recorded response."""
+    speed = get_config().replay_speed
+    return record["secs"] / speed if speed else 0
+
+
+def _replay_request(method, url, params=None) -> requests.Response:
+    """Answer the request from the recording."""
+    record = _next_replay_record(method, url, params)
+    time.sleep(_replay_delay(record))
+    response = requests.Response()
+    response.status_code = record["status"]
+    response._content = record["body"].encode()
+    response.encoding = "utf-8"
+    response.url = url
+    response.elapsed = timedelta(seconds=record["secs"])
+    return response
+
+
+def reset_replay() -> None:
+    """Forget the responses replayed so far, so the recording is replayed
+    from the start again."""
+    global _replay_responses, _replay_fallbacks
+    with _replay_lock:
+        _replay_responses = None
+        _replay_fallbacks = None
+
+
+def _check_resend_attempts(order) -> int:
+    """Check how many attempts have been made to resend the order email
+    already, from the state store if there is one or otherwise from the
+    order's comments."""
+    comment_attempts = _comment_attempts(order)
+    if not get_config().state_store_file:
+        return comment_attempts or 0
+    attempts = get_stored_resend_attempts(order["entity_id"])
+    if attempts is None or (
+        _is_reconciling_store() and comment_attempts is not None
+    ):
+        # Seed the store from Magento's comments for orders it hasn't seen.
+        attempts = max(attempts or 0, comment_attempts or 0)
+        _store_resend_attempts(order, attempts)
+    return attempts
+
+
+def _comment_attempts(order):
+    """Get the resend attempts recorded in the order's comments, counted
+    when an Order is parsed, or None if its comments weren't fetched."""
+    if isinstance(order, Order):
+        return order.comment_attempts
+    if "status_histories" not in order:
+        return None
+    return _count_comment_attempts(order)
+
+
+def _count_comment_attempts(order) -> int:
+    """Check the order's comments to parse how many attempts have been made
+    to resend the order email already."""
+    if "status_histories" not in order:
+        return 0
+    order_comments = order["status_histories"]
+    if len(order_comments) == 0:
+        return 0
+    comment_prefix = get_config().comment_prefix
+    attempts = sum(
+        1
+        for n in order_comments
+        if n["comment"] and n["comment"].startswith(comment_prefix)
+    )
+    return attempts
+
+
+def get_state_store() -> sqlite3.Connection:
+    """Open the SQLite state store, creating it if needed. If the store file
+    is missing (or STATE_STORE_RECONCILE is set) the store is reconciled with
+    Magento's order comments this run."""
+    global _state_store, _state_store_reconciling, _state_store_settings
+    config = get_config()
+    with _state_store_lock:
+        if _state_store is not None:
+            _check_shared_settings("state store", _state_store_settings)
+        else:
+            _state_store_reconciling = config.state_store_reconcile
+            if not os.path.exists(config.state_store_file):
+                logger.info("State store missing, reconciling from comments")
+                _state_store_reconciling = True
+            connection = sqlite3.connect(
+                config.state_store_file, check_same_thread=False
+            )
+            with connection:
+                connection.execute(
+                    """CREATE TABLE IF NOT EXISTS orders (
+                        store TEXT NOT NULL DEFAULT '',
+                        entity_id INTEGER NOT NULL,
+                        increment_id TEXT,
+                        resend_attempts INTEGER NOT NULL DEFAULT 0,
+                        last_attempt_at TEXT,
+                        last_outcome TEXT,
+                        escalated_at TEXT,
+                        PRIMARY KEY (store, entity_id)
+                    )"""
+                )
+            _state_store = connection
+            _state_store_settings = {"state_store_file": config.state_store_file}
+        return _state_store
+
+
+def close_state_store() -> None:
+    """Close the state store so it is reopened on next use."""
+    global _state_store, _state_store_reconciling, _state_store_settings
+    with _state_store_lock:
+        if _state_store is not None:
+            _state_store.close()
+        _state_store = None
+        _state_store_settings = None
+        _state_store_reconciling = False
+        _state_store_stores_reconciling.clear()
+
+
+def _needs_status_histories() -> bool:
+    """Check whether order comments are needed to count resend attempts."""
+    if not get_config().state_store_file:
+        return True
+    return _is_reconciling_store()
+
+
+def _is_reconciling_store() -> bool:
+    """Check whether the state store is being reconciled with the order
+    comments of the store in use, either because the whole state store is
+    or because it has no orders from the store yet."""
+    connection = get_state_store()
+    store = get_config().store
+    with _state_store_lock:
+        if _state_store_reconciling:
+            return True
+        if store not in _state_store_stores_reconciling:
+            row = connection.execute(
+                "SELECT 1 FROM orders WHERE store = ? LIMIT 1", (store,)
+            ).fetchone()
+            if row is None:
+                logger.info("Store new to the state store, reconciling")
+            _state_store_stores_reconciling[store] = row is None
+        return _state_store_stores_reconciling[store]
+
+
+def get_stored_resend_attempts(entity_id):
+    """Get the number of resend attempts recorded for the order, or None if
+    the order isn't in the state store."""
+    store = get_state_store()
+    with _state_store_lock:
+        row = store.execute(
+            "SELECT resend_attempts FROM orders"
+            " WHERE store = ? AND entity_id = ?",
+            (get_config().store, entity_id),
+        ).fetchone()
+    return None if row is None else row[0]
+
+
+def get_pending_entity_ids() -> list:
+    """Get the entity IDs of the orders of the store in use which have been
+    resent within the sync period but not escalated, so may still be unsent."""
+    if time_now is None:
+        refresh_sync_period()
+    config = get_config()
+    since = time_now.subtract(minutes=config.order_age_mins)
+    store = get_state_store()
+    with _state_store_lock:
+        rows = store.execute(
+            "SELECT entity_id FROM orders"
+            " WHERE store = ? AND escalated_at IS NULL"
+            " AND resend_attempts > 0"
+            " AND julianday(last_attempt_at) >= julianday(?)"
+            " ORDER BY entity_id",
+            (config.store, since.to_iso8601_string()),
+        ).fetchall()
+    return [row[0] for row in rows]
+
+
+def _store_resend_attempts(order, attempts) -> None:
+    """Set the number of resend attempts recorded for the order."""
+    store = get_state_store()
+    with _state_store_lock, store:
+        store.execute(
+            """INSERT INTO orders (
+                store, entity_id, increment_id, resend_attempts
+            )
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (store, entity_id) DO UPDATE
+            SET resend_attempts = excluded.resend_attempts""",
+            (
+                get_config().store,
+                order["entity_id"],
+                order.get("increment_id"),
+                attempts,
+            ),
+        )
+
+
+def _record_order_outcome(order, outcome, resent=False, escalated=False):
+    """Record the outcome of processing the order in the state store, counting
+    a resend attempt or marking the order as escalated."""
+    if not get_config().state_store_file:
+        return
+    now = pendulum.now(tz=TIMEZONE).to_iso8601_string()
+    store = get_state_store()
+    with _state_store_lock, store:
+        store.execute(
+            """INSERT INTO orders (
+                store, entity_id, increment_id, resend_attempts,
+                last_attempt_at, last_outcome, escalated_at
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (store, entity_id) DO UPDATE
+            SET resend_attempts = resend_attempts + excluded.resend_attempts,
+                last_attempt_at = excluded.last_attempt_at,
+                last_outcome = excluded.last_outcome,
+                escalated_at = COALESCE(excluded.escalated_at, escalated_at)""",
+            (
+                get_config().store,
+                order["entity_id"],
+                order.get("increment_id"),
+                1 if resent else 0,
+                now,
+                outcome,
+                now if escalated else None,
+            ),
+        )
+
+
+# The functions run for each kind of outbox action, by name so that they can
+# be looked up at replay time.
+OUTBOX_ACTIONS = {
+    "resend": "_resend_order_with_magento",
+    "alert": "_alert_admin",
+    "email_sales": "_email_order_to_sales",
+}
+# The order fields kept in the outbox, enough to replay any action.
+OUTBOX_ORDER_FIELDS = ("entity_id", "increment_id", "updated_at")
+
+
+def _outbox_key(action, order, attempt=None) -> str:
+    """Key an action so it is only ever carried out once. Each resend attempt
+    is its own action, escalations only happen once per order. Orders from
+    named stores are keyed by store too."""
+    key = str(order["entity_id"]) + ":" + action
+    store = get_config().store
+    if store:
+        key = store + ":" + key
+    if attempt is not None:
+        key += ":" + str(attempt)
+    return key
+
+
+def _run_outbox_action(action, order, attempt=None):
+    """Run the action for the order unless the outbox shows it has already
+    been done, recording the intent beforehand and the result afterwards."""
+    if not get_config().outbox_file:
+        return globals()[OUTBOX_ACTIONS[action]](order)
+    key = _outbox_key(action, order, attempt)
+    if _outbox_is_done(key):
+        logger.info(
+            f"Order {order.get('increment_id')} {action} already done, skipping"
+        )
+        return _outbox_done[key]
+    _write_outbox_record(key, action, order, "intended")
+    result = globals()[OUTBOX_ACTIONS[action]](order)
+    _write_outbox_record(key, action, order, "done", result)
+    return result
+
+
+def _outbox_is_done(key) -> bool:
+    """Check whether the outbox shows the action has been done."""
+    if not get_config().outbox_file:
+        return False
+    _open_outbox()
+    with _outbox_lock:
+        return key in _outbox_done
+
+
+def _write_outbox_record(key, action, order, state, result=None) -> None:
+    """Append a record to the outbox. Records are written through to the OS
+    straight away, so they survive the process dying, and fsynced in batches
+    of OUTBOX_FSYNC_BATCH so that they also survive the machine going down."""
+    global _outbox_unsynced
+    config = get_config()
+    if not config.outbox_file:
+        return
+    outbox = _open_outbox()
+    record = {
+        "key": key,
+        "store": config.store,
+        "action": action,
+        "state": state,
+        "order": {
+            field: order[field] for field in OUTBOX_ORDER_FIELDS if field in order
+        },
+        "result": result,
+        "at": time.time(),
+    }
+    with _outbox_lock:
+        outbox.write(json.dumps(record) + "\n")
+        outbox.flush()
+        if state == "done":
+            _outbox_done[key] = result
+            _outbox_pending.pop(key, None)
+        else:
+            _outbox_pending[key] = record
+        _outbox_unsynced += 1
+        if _outbox_unsynced >= config.outbox_fsync_batch:
+            os.fsync(outbox.fileno())
+            _outbox_unsynced = 0
+
+
+def flush_outbox() -> None:
+    """Fsync any outbox records written since the last fsync."""
+    global _outbox_unsynced
+    with _outbox_lock:
+        if _outbox is not None and _outbox_unsynced:
+            os.fsync(_outbox.fileno())
+            _outbox_unsynced = 0
+
+
+def _open_outbox():
+    """Open the outbox for appending, first loading which actions are done or
+    still pending and compacting away actions older than the retention
+    period."""
+    global _outbox, _outbox_settings
+    config = get_config()
+    outbox_file = config.outbox_file
+    with _outbox_lock:
+        if _outbox is not None:
+            _check_shared_settings("outbox", _outbox_settings)
+            return _outbox
+        records = {}
+        try:
+            with open(outbox_file) as outbox:
+                for line in outbox:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A partly written record from a crash.
+                        continue
+                    if (
+                        record["key"] not in records
+                        or records[record["key"]]["state"] != "done"
+                    ):
+                        records[record["key"]] = record
+        except OSError:
+            pass
+        expired = time.time() - config.outbox_retention_days * 24 * 60 * 60
+        records = {
+            key: record
+            for key, record in records.items()
+            if record["at"] >= expired
+        }
+        temp_file = outbox_file + ".tmp"
+        with open(temp_file, "w") as outbox:
+            for record in records.values():
+                outbox.write(json.dumps(record) + "\n")
+            outbox.flush()
+            os.fsync(outbox.fileno())
+        os.replace(temp_file, outbox_file)
+        for key, record in records.items():
+            if record["state"] == "done":
+                _outbox_done[key] = record["result"]
+            else:
+                _outbox_pending[key] = record
+        _outbox = open(outbox_file, "a")
+        _outbox_settings = {"outbox_file": outbox_file}
+        return _outbox
+
+
+@_configurable
+def replay_outbox() -> int:
+    """Carry out the store's actions which were intended but not recorded as
+    done when the process last stopped, recording and logging each order's
+    outcome as usual. A resend may have reached Magento before the process
+    stopped, so resends are only replayed for orders Magento still shows as
+    unsent. Returns the number of actions replayed."""
+    config = get_config()
+    if not config.outbox_file:
+        return 0
+    _open_outbox()
+    with _outbox_lock:
+        _outbox_replayed.add(config.store)
+        pending = [
+            record
+            for record in _outbox_pending.values()
+            if record.get("store", "") == config.store
+        ]
+    unsent = _unsent_resend_orders(pending)
+    replayed = 0
+    escalated = {}
+    for record in pending:
+        order = record["order"]
+        action = record["action"]
+        if action == "resend" and unsent is None:
+            # Left pending for the next poll to resend if still unsent.
+            continue
+        if action == "resend" and order["entity_id"] not in unsent:
+            logger.info(
+                f"Order {order.get('increment_id')} no longer unsent, not"
+                " replaying resend"
+            )
+            _write_outbox_record(record["key"], action, order, "done")
+            continue
+        logger.info(f"Order {order.get('increment_id')} replaying {action}")
+        try:
+            result = globals()[OUTBOX_ACTIONS[action]](order)
+        except Exception as e:
+            _log_order_failure(order, e)
+            continue
+        _write_outbox_record(record["key"], action, order, "done", result)
+        replayed += 1
+        if action == "resend":
+            _finish_order(
+                order,
+                _outbox_attempt(record["key"]) - 1,
+                "resent" if result else "resend_failed",
+            )
+        elif _escalation_done(order):
+            escalated[order["entity_id"]] = order
+    for order in escalated.values():
+        _finish_order(order, None, "escalated")
+    flush_outbox()
+    return replayed
+
+
+def _unsent_resend_orders(records):
+    """Fetch the orders of the resend records which Magento shows as still
+    needing their email sending, by entity ID, or None if they can't be
+    fetched."""
+    entity_ids = sorted(
+        {
+            record["order"]["entity_id"]
+            for record in records
+            if record["action"] == "resend"
+        }
+    )
+    if not entity_ids:
+        return {}
+    try:
+        orders = fetch_orders_by_id(entity_ids)
+    except Exception as e:
+        logger.error("Could not check resends to replay: " + repr(e))
+        return None
+    return {
+        order["entity_id"]: order
+        for order in orders
+        if not order.get("email_sent")
+        and order["status"] not in SKIPPED_ORDER_STATUSES
+    }
+
+
+def _outbox_attempt(key) -> int:
+    """Get the resend attempt an outbox key is for."""
+    return int(key.rsplit(":", 1)[1])
+
+
+def close_outbox() -> None:
+    """Fsync and close the outbox so it is reloaded on next use."""
+    global _outbox, _outbox_settings
+    flush_outbox()
+    with _outbox_lock:
+        if _outbox is not None:
+            _outbox.close()
+        _outbox = None
+        _outbox_settings = None
+        _outbox_replayed.clear()
+        _outbox_done.clear()
+        _outbox_pending.clear()
+
+
+class SQLiteLeases:
+    """Leases kept in a SQLite file, for instances running on one host."""
+
+    def __init__(self, config):
+        self._connection = sqlite3.connect(
+            config.lease_file,
+            timeout=30,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        self._lock = Lock()
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            """CREATE TABLE IF NOT EXISTS leases (
+                key TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )"""
+        )
+
+    def acquire(self, key, owner, ttl) -> bool:
+        """Take the lease, or renew it if already held by the owner. Returns
+        whether the owner now holds it."""
+        now = time.time()
+        with self._lock:
+            cursor = self._connection.execute(
+                """INSERT INTO leases (key, owner, expires_at)
+                VALUES (?, ?, ?)
+                ON CONFLICT (key) DO UPDATE
+                SET owner = excluded.owner, expires_at = excluded.expires_at
+                WHERE leases.owner = excluded.owner OR leases.expires_at <= ?""",
+                (key, owner, now + ttl, now),
+            )
+        return cursor.rowcount == 1
+
+    def release(self, key, owner) -> None:
+        """Give up the lease if the owner holds it."""
+        with self._lock:
+            self._connection.execute(
+                "DELETE FROM leases WHERE key = ? AND owner = ?", (key, owner)
+            )
+
+    def holders(self, prefix) -> dict:
+        """Get the owner of each lease held with a key starting with the
+        prefix."""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT key, owner FROM leases"
+                " WHERE substr(key, 1, ?) = ? AND expires_at > ?",
+                (len(prefix), prefix, time.time()),
+            ).fetchall()
+        return dict(rows)
+
+    def close(self) -> None:
+        self._connection.close()
+
+
+class RedisLeases:
+    """Leases kept in Redis, for instances running on several hosts."""
+
+    # Keys are namespaced so the Redis database can be shared.
+    KEY_PREFIX = "order_email_resender:lease:"
+    ACQUIRE_SCRIPT = """
+        if redis.call("GET", KEYS[1]) == ARGV[1] then
+            return redis.call("PEXPIRE", KEYS[1], ARGV[2])
+        end
+        return redis.call("SET", KEYS[1], ARGV[1], "NX", "PX", ARGV[2]) and 1 or 0
+    """
+    RELEASE_SCRIPT = """
+        if redis.call("GET", KEYS[1]) == ARGV[1] then
+            return redis.call("DEL", KEYS[1])
+        end
+        return 0
+    """
+
+    def __init__(self, config):
+        self._client = redis.Redis.from_url(
+            config.lease_redis_url, decode_responses=True
+        )
+        self._acquire = self._client.register_script(self.ACQUIRE_SCRIPT)
+        self._release = self._client.register_script(self.RELEASE_SCRIPT)
+
+    def acquire(self, key, owner, ttl) -> bool:
+        """Take the lease, or renew it if already held by the owner. Returns
+        whether the owner now holds it."""
+        return bool(
+            self._acquire(
+                keys=[self.KEY_PREFIX + key], args=[owner, int(ttl * 1000)]
+            )
+        )
+
+    def release(self, key, owner) -> None:
+        """Give up the lease if the owner holds it."""
+        self._release(keys=[self.KEY_PREFIX + key], args=[owner])
+
+    def holders(self, prefix) -> dict:
+        """Get the owner of each lease held with a key starting with the
+        prefix."""
+        keys = list(self._client.scan_iter(match=self.KEY_PREFIX + prefix + "*"))
+        owners = self._client.mget(keys) if keys else []
+        return {
+            key[len(self.KEY_PREFIX) :]: owner
+            for key, owner in zip(keys, owners)
+            if owner is not None
+        }
+
+    def close(self) -> None:
+        self._client.close()
+
+
+def get_lease_backend():
+    """Open the LEASE_BACKEND leases are kept in."""
+    global _lease_backend, _lease_backend_settings
+    config = get_config()
+    with _lease_backend_lock:
+        if _lease_backend is not None:
+            _check_shared_settings("lease backend", _lease_backend_settings)
+        else:
+            _lease_backend = globals()[LEASE_BACKENDS[config.lease_backend]](
+                config
+            )
+            _lease_backend_settings = {
+                "lease_backend": config.lease_backend,
+                "lease_file": config.lease_file,
+                "lease_redis_url": config.lease_redis_url,
+            }
+        return _lease_backend
+
+
+def _worker_id() -> str:
+    """Get the name this instance holds leases under."""
+    return get_config().worker_id or socket.gethostname() + "-" + str(os.getpid())
+
+
+def claim_shards() -> set:
+    """Renew this instance's leases on its share of the shards, dividing them
+    between the running instances. Shards beyond its share are released for
+    newly started instances, and unleased shards, including those of stopped
+    instances, are taken up to it. Returns the shards now held."""
+    global _owned_shards
+    config = get_config()
+    leases = get_lease_backend()
+    worker = _worker_id()
+    ttl = config.lease_ttl_secs
+    # Instances hold a lease of their own to be counted as running.
+    leases.acquire("worker:" + worker, worker, ttl)
+    share = -(-config.shard_count // max(1, len(leases.holders("worker:"))))
+    holders = leases.holders("shard:")
+    owned = set()
+    for shard in range(config.shard_count):
+        key = "shard:" + str(shard)
+        if holders.get(key) != worker:
+            continue
+        if len(owned) < share and leases.acquire(key, worker, ttl):
+            owned.add(shard)
+        else:
+            leases.release(key, worker)
+    for shard in range(config.shard_count):
+        if len(owned) >= share:
+            break
+        key = "shard:" + str(shard)
+        if key not in holders and leases.acquire(key, worker, ttl):
+            owned.add(shard)
+    _owned_shards = owned
+    _set_metric("shards_owned", len(owned))
+    logger.info(
+        "Holding shards " + ", ".join(map(str, sorted(owned)))
+        + " of " + str(config.shard_count)
+    )
+    return owned
+
+
+def release_shards() -> None:
+    """Give up this instance's leases so that the other instances take over
+    its shards straight away, and close the lease backend."""
+    global _lease_backend, _lease_backend_settings, _owned_shards
+    worker = _worker_id()
+    with _lease_backend_lock:
+        if _lease_backend is None:
+            return
+        for shard in _owned_shards:
+            _lease_backend.release("shard:" + str(shard), worker)
+        _lease_backend.release("worker:" + worker, worker)
+        _lease_backend.close()
+        _lease_backend = None
+        _lease_backend_settings = None
+    _owned_shards = set()
+    _set_metric("shards_owned", 0)
+
+
+def _order_shard(order) -> int:
+    """Get the shard of the order. CRC32 rather than hash() so that every
+    instance agrees."""
+    return zlib.crc32(str(order["entity_id"]).encode()) % get_config().shard_count
+
+
+def _owns_order(order) -> bool:
+    """Check whether the order is in one of the shards this instance holds."""
+    if _order_shard(order) in _owned_shards:
+        return True
+    _increment_metric("orders_skipped", reason="shard")
+    return False
+
+
+def _lease_order(order) -> bool:
+    """Lease the order for processing, unless another instance has it, such
+    as when a shard has just changed hands. The lease is left to lapse so the
+    order isn't taken again straight away."""
+    worker = _worker_id()
+    key = "order:" + get_config().store + ":" + str(order["entity_id"])
+    return get_lease_backend().acquire(key, worker, get_config().lease_ttl_secs)
+
+
+@_timed("alert_admin")
+def _alert_admin(order) -> None:
+    """Alert the admin that an order has reached the maximum number of resend
+    retries and will be manually sent to the sales inbox."""
+    ALERT_WEBHOOK_URL = get_config().alert_webhook_url
+    if "entity_id" not in order:
+        raise ValueError("Invalid order object")
+    if "increment_id" not in order:
+        raise ValueError("Invalid order object")
+
+    payload = _build_alert_payload(order)
+    _external_request("post", ALERT_WEBHOOK_URL, json=payload)
+
+
+def _build_alert_payload(order) -> dict:
+    """Build the admin alert for a single escalated order."""
+    order_id = order["entity_id"]
+    incr_id = order["increment_id"]
+    return {
+        "entity_id": order_id,
+        "increment_id": incr_id,
+        "message": f"Order {incr_id} ({order_id})"
+        + " could not be sent by Magento and has been manually sent to sales.",
+    }
+
+
+# Where each field of the sales payload is found in the full order. Using the
+# first instance of shipping assignment which works for FFD's business logic.
+# The order comment is in the configured WEB_ORDER_COMMENT_FIELD, see
+# Config.sales_payload_fields.
+SALES_PAYLOAD_PATHS = {
+    "customer_name": ("customer_name",),
+    "increment_id": ("increment_id",),
+    "billing_address": ("billing_address",),
+    "shipping_address": (
+        "extension_attributes",
+        "shipping_assignments",
+        0,
+        "shipping",
+        "address",
+    ),
+    "payment_method": ("payment", "method"),
+    "shipping_method": (
+        "extension_attributes",
+        "shipping_assignments",
+        0,
+        "shipping",
+        "method",
+    ),
+    "items": ("items",),
+    "shipping_cost": (
+        "extension_attributes",
+        "shipping_assignments",
+        0,
+        "shipping",
+        "total",
+    ),
+    "subtotal": ("subtotal",),
+    "grand_total": ("grand_total",),
+}
+
+
+def _build_fields_projection(field_map, item_fields=None) -> str:
+    """Build a Magento 'fields' projection which requests only the fields
+    needed to fill in the field map."""
+    tree = {}
+    for path in field_map.values():
+        node = tree
+        for key in path:
+            # List indexes aren't part of the projection.
+            if isinstance(key, str):
+                node = node.setdefault(key, {})
+        if path == ("items",) and item_fields:
+            node.update({field: {} for field in item_fields})
+
+    def render(node):
+        return ",".join(
+            key + ("[" + render(child) + "]" if child else "")
+            for key, child in node.items()
+        )
+
+    return render(tree)
+
+
+def _build_sales_payload(full_order) -> dict:
+    """Build the sales payload from the full order using the field map."""
+    order_payload = {}
+    for payload_field, path in get_config().sales_payload_fields.items():
+        value = full_order
+        for key in path:
+            value = value[key]
+        order_payload[payload_field] = value
+    return order_payload
+
+
+@_timed("email_order_to_sales")
+def _email_order_to_sales(order) -> None:
+    """Email the order details to the sales inbox manually."""
+    if "entity_id" not in order:
+        raise ValueError("No entity ID present on order.")
+    EMAIL_WEBHOOK_URL = get_config().email_webhook_url
+    order_payload = _fetch_sales_payload(order)
+    webhook_response = _external_request(
+        "post", EMAIL_WEBHOOK_URL, json=order_payload
+    )
+    if webhook_response.status_code != 200:
+        raise webhook_response.raise_for_status()
+
+
+def _fetch_sales_payload(order) -> dict:
+    """Fetch the full order from Magento (or the cache) and build the payload
+    to email to sales."""
+    config = get_config()
+    WEB_ORDER_API_ENDPOINT = config.web_domain + config.web_order_api_endpoint
+    cache_key = _order_cache_key(order)
+    full_order = _get_cached_full_order(cache_key)
+    if full_order is None:
+        get_order_url = WEB_ORDER_API_ENDPOINT + str(order["entity_id"])
+        api_response = _magento_request(
+            "get", get_order_url, params={"fields": config.sales_order_fields}
+        )
+        if api_response.status_code != 200:
+            raise api_response.raise_for_status()
+        full_order = api_response.json()
+        _cache_full_order(cache_key, full_order)
+    return _build_sales_payload(full_order)
+
+
+def _queue_escalation(order) -> None:
+    """Queue an escalated order to be sent to sales and admin in the next
+    batch, sending the batch once it is full or has waited long enough."""
+    if _escalation_done(order):
+        return
+    if _add_to_escalation_batch(order, _fetch_sales_payload(order)):
+        flush_escalations()
+
+
+def _escalation_done(order) -> bool:
+    """Check whether the order has already been escalated, according to the
+    outbox."""
+    if "entity_id" not in order or "increment_id" not in order:
+        raise ValueError("Invalid order object")
+    keys = [_outbox_key(action, order) for action in ("alert", "email_sales")]
+    if all(_outbox_is_done(key) for key in keys):
+        logger.info(f"Order {order['increment_id']} has already been escalated")
+        return True
+    return False
+
+
+def _add_to_escalation_batch(order, order_payload) -> bool:
+    """Add an escalated order to the store's batch, returning whether the
+    batch is now due to be sent."""
+    config = get_config()
+    for action in ("alert", "email_sales"):
+        _write_outbox_record(
+            _outbox_key(action, order), action, order, "intended"
+        )
+    with _escalation_batch_lock:
+        batch = _escalation_batches.setdefault(config.store, [])
+        if not batch:
+            _escalation_batch_started[config.store] = time.monotonic()
+        batch.append((order, order_payload))
+        batch_full = len(batch) >= config.webhook_batch_size or (
+            time.monotonic() - _escalation_batch_started[config.store]
+            >= config.webhook_batch_max_secs
+        )
+    return batch_full
+
+
+@_configurable
+def flush_escalations() -> int:
+    """Send the store's queued escalations as one digest alert to admin and
+    one batch of orders to sales. Returns the number of orders sent. If the
+    batch can't be sent, every order in it is logged as failed."""
+    config = get_config()
+    with _escalation_batch_lock:
+        batch = _escalation_batches.pop(config.store, [])
+    if not batch:
+        return 0
+    ALERT_WEBHOOK_URL = config.alert_webhook_url
+    EMAIL_WEBHOOK_URL = config.email_webhook_url
+    try:
+        alert_payloads = [_build_alert_payload(order) for order, _ in batch]
+        digest = _build_escalation_digest(alert_payloads)
+        _post_batch(ALERT_WEBHOOK_URL, digest, alert_payloads)
+        order_payloads = [order_payload for _, order_payload in batch]
+        _post_batch(
+            EMAIL_WEBHOOK_URL, {"orders": order_payloads}, order_payloads
+        )
+    except Exception as e:
+        _fail_escalation_batch(batch, e)
+        return 0
+    _finish_escalation_batch(batch)
+    return len(batch)
+
+
+def _build_escalation_digest(alert_payloads) -> dict:
+    """Build the one admin alert covering a batch of escalated orders."""
+    return {
+        "orders": [
+            {
+                "entity_id": alert["entity_id"],
+                "increment_id": alert["increment_id"],
+            }
+            for alert in alert_payloads
+        ],
+        "message": f"{len(alert_payloads)} orders could not be sent by Magento"
+        + " and have been manually sent to sales: "
+        + ", ".join(str(alert["increment_id"]) for alert in alert_payloads),
+    }
+
+
+def _finish_escalation_batch(batch) -> None:
+    """Record a sent batch of escalations as done in the outbox, and record
+    and log each order's outcome."""
+    for order, _ in batch:
+        for action in ("alert", "email_sales"):
+            _write_outbox_record(
+                _outbox_key(action, order), action, order, "done"
+            )
+    flush_outbox()
+    logger.info("Sent a batch of " + str(len(batch)) + " escalated orders")
+    for order, _ in batch:
+        # Attempts are only logged for resends.
+        _finish_order(order, None, "escalated")
+
+
+def _fail_escalation_batch(batch, error) -> None:
+    """Log every order in a batch which couldn't be sent as failed, to be
+    counted by the cycle, which may have queued them from other threads."""
+    for order, _ in batch:
+        _log_order_failure(order, error)
+    store = get_config().store
+    with _escalation_batch_lock:
+        _escalation_batch_failures[store] = (
+            _escalation_batch_failures.get(store, 0) + len(batch)
+        )
+
+
+def _take_escalation_failures() -> int:
+    """Get the number of the store's escalations which couldn't be sent since
+    last asked, so the cycle counts them as failed."""
+    with _escalation_batch_lock:
+        return _escalation_batch_failures.pop(get_config().store, 0)
+
+
+def _post_batch(url, batch_payload, payloads) -> None:
+    """Post a batch to a webhook, falling back to posting each payload on its
+    own when the receiver rejects the batch as a client error."""
+    webhook_response = _external_request("post", url, json=batch_payload)
+    if webhook_response.status_code == 200:
+        return
+    if not 400 <= webhook_response.status_code < 500:
+        raise webhook_response.raise_for_status()
+    logger.info(
+        "Batch rejected by " + url + " with status "
+        + str(webhook_response.status_code) + ", sending orders one by one"
+    )
+    for payload in payloads:
+        webhook_response = _external_request("post", url, json=payload)
+        if webhook_response.status_code != 200:
+            raise webhook_response.raise_for_status()
+
+
+def _order_cache_key(order) -> str:
+    """Key full orders by entity ID and last update so that a changed order
+    is fetched again, and by store for orders from named stores."""
+    key = str(order["entity_id"]) + "@" + str(order.get("updated_at"))
+    store = get_config().store
+    return store + ":" + key if store else key
+
+
+def _get_cached_full_order(key):
+    """Get a full order from the cache if it is there and hasn't expired."""
+    config = get_config()
+    if config.order_cache_size < 1:
+        return None
+    with _full_order_cache_lock:
+        _load_order_cache()
+        if key not in _full_order_cache:
+            return None
+        cached_at, full_order = _full_order_cache[key]
+        if time.time() - cached_at > config.order_cache_ttl_secs:
+            del _full_order_cache[key]
+            return None
+        _full_order_cache.move_to_end(key)
+        return full_order
+
+
+def _cache_full_order(key, full_order) -> None:
+    """Cache a full order, evicting the least recently used orders once the
+    cache is full."""
+    cache_size = get_config().order_cache_size
+    if cache_size < 1:
+        return
+    with _full_order_cache_lock:
+        _load_order_cache()
+        _full_order_cache[key] = (time.time(), full_order)
+        _full_order_cache.move_to_end(key)
+        while len(_full_order_cache) > cache_size:
+            _full_order_cache.popitem(last=False)
+
+
+def _load_order_cache() -> None:
+    """Load the unexpired orders persisted by a previous run, once. The cache
+    lock must be held."""
+    global _full_order_cache_loaded, _full_order_cache_settings
+    if _full_order_cache_loaded:
+        _check_shared_settings("order cache", _full_order_cache_settings)
+        return
+    _full_order_cache_loaded = True
+    config = get_config()
+    _full_order_cache_settings = {"order_cache_file": config.order_cache_file}
+    if not config.order_cache_file:
+        return
+    try:
+        with open(config.order_cache_file) as cache_file:
+            entries = json.load(cache_file)
+    except (OSError, ValueError):
+        return
+    now = time.time()
+    for key, cached_at, full_order in entries[-config.order_cache_size :]:
+        if now - cached_at <= config.order_cache_ttl_secs:
+            _full_order_cache[key] = (cached_at, full_order)
+
+
+def save_order_cache() -> None:
+    """Persist the order cache so the next run can reuse it."""
+    order_cache_file = get_config().order_cache_file
+    if not order_cache_file:
+        return
+    with _full_order_cache_lock:
+        if _full_order_cache_loaded:
+            _check_shared_settings("order cache", _full_order_cache_settings)
+        entries = [
+            [key, cached_at, full_order]
+            for key, (cached_at, full_order) in _full_order_cache.items()
+        ]
+    temp_file = order_cache_file + ".tmp"
+    with open(temp_file, "w") as cache_file:
+        json.dump(entries, cache_file)
+    os.replace(temp_file, order_cache_file)
+
+
+def clear_order_cache() -> None:
+    """Empty the in-memory order cache."""
+    global _full_order_cache_loaded, _full_order_cache_settings
+    with _full_order_cache_lock:
+        _full_order_cache.clear()
+        _full_order_cache_loaded = False
+        _full_order_cache_settings = None
+
+
+@_timed("resend_order_with_magento")
+def _resend_order_with_magento(order) -> bool:
     """Using the Magento API, request for the order email to be resent."""
     if "entity_id" not in order:
         raise ValueError("No entity ID present on order")
     order_entity_id = order["entity_id"]
+    config = get_config()
     WEB_ORDER_EMAIL_API_ENDPOINT = (
-        os.getenv("WEB_DOMAIN")
-        + os.getenv("WEB_ORDER_API_ENDPOINT")
+        config.web_domain
+        + config.web_order_api_endpoint
         + str(order_entity_id)
         + "/emails"
     )
-    response = requests.post(WEB_ORDER_EMAIL_API_ENDPOINT, headers=WEB_HEADERS)
-    logger.info("Magento resending email: " + str(response))
+    response = _magento_request("post", WEB_ORDER_EMAIL_API_ENDPOINT)
+    logger.info("Magento resending email: %s", response)
     if response.status_code != 200:
         response.raise_for_status()
     return response.json() == "true"
 
 
+def _queue_bulk_resend(order, attempts) -> None:
+    """Queue the order's next resend attempt to be submitted in bulk, unless
+    the outbox shows it has already been made."""
+    config = get_config()
+    if "entity_id" not in order:
+        raise ValueError("No entity ID present on order")
+    key = _outbox_key("resend", order, attempts + 1)
+    if _outbox_is_done(key):
+        logger.info(
+            f"Order {order.get('increment_id')} resend already done, skipping"
+        )
+        sent = _outbox_done[key]
+        _finish_order(order, attempts, "resent" if sent else "resend_failed")
+        return
+    _write_outbox_record(key, "resend", order, "intended")
+    with _bulk_resends_lock:
+        _bulk_resends.setdefault(config.store, []).append((order, attempts))
+
+
+@_configurable
+def flush_bulk_resends() -> int:
+    """Submit the store's queued resends to Magento's async bulk API in
+    chunks, then wait for each order's result and record and log it like a
+    single resend. Returns the number of orders which couldn't be
+    submitted."""
+    config = get_config()
+    with _bulk_resends_lock:
+        queued = _bulk_resends.pop(config.store, [])
+    if not queued:
+        return 0
+    failed = 0
+    bulks = []
+    chunk_size = config.magento_bulk_chunk_size
+    with _time_phase("bulk_resend"):
+        for start in range(0, len(queued), chunk_size):
+            chunk = queued[start : start + chunk_size]
+            try:
+                bulks.append(_submit_bulk_resend(chunk))
+            except (requests.RequestException, ValueError) as e:
+                for order, _ in chunk:
+                    _log_order_failure(order, e)
+                failed += len(chunk)
+        deadline = time.monotonic() + config.magento_bulk_timeout_secs
+        for bulk_uuid, chunk, statuses in bulks:
+            if bulk_uuid is not None:
+                try:
+                    statuses.update(_wait_for_bulk(bulk_uuid, statuses, deadline))
+                except (requests.RequestException, ValueError) as e:
+                    logger.warning(
+                        "Bulk resend " + bulk_uuid + " status unknown: " + repr(e)
+                    )
+            for operation_id, (order, attempts) in enumerate(chunk):
+                sent = statuses.get(operation_id) == BULK_OPERATION_COMPLETE
+                _write_outbox_record(
+                    _outbox_key("resend", order, attempts + 1),
+                    "resend",
+                    order,
+                    "done",
+                    sent,
+                )
+                _finish_order(
+                    order, attempts, "resent" if sent else "resend_failed"
+                )
+    flush_outbox()
+    return failed
+
+
+def _bulk_api_url(path) -> str:
+    """Build the URL of a Magento API path in the same store view as the
+    orders endpoint."""
+    config = get_config()
+    store_prefix = config.web_orders_api_endpoint.partition("/V1/")[0]
+    return config.web_domain + store_prefix + path
+
+
+def _submit_bulk_resend(chunk):
+    """Submit a chunk of resends as one bulk request. Returns its bulk UUID,
+    the chunk and the statuses of the operations Magento rejected outright,
+    keyed by their index in the chunk."""
+    response = _magento_request(
+        "post",
+        _bulk_api_url("/async/bulk/V1/orders/byId/emails"),
+        json=[{"id": order["entity_id"]} for order, _ in chunk],
+    )
+    if response.status_code not in (200, 202):
+        response.raise_for_status()
+    json_response = response.json()
+    statuses = {
+        item["id"]: BULK_OPERATION_REJECTED
+        for item in json_response.get("request_items") or []
+        if item.get("status") != "accepted"
+    }
+    logger.info(
+        "Submitted " + str(len(chunk)) + " resends as bulk "
+        + str(json_response.get("bulk_uuid"))
+    )
+    return json_response.get("bulk_uuid"), chunk, statuses
+
+
+def _wait_for_bulk(bulk_uuid, rejected, deadline) -> dict:
+    """Poll the bulk's status until none of its operations are still open,
+    or the deadline passes, returning the status of each by ID. Operations
+    in `rejected` keep their status."""
+    config = get_config()
+    url = _bulk_api_url("/V1/bulk/" + bulk_uuid + "/detailed-status")
+    while True:
+        response = _magento_request("get", url)
+        if response.status_code != 200:
+            response.raise_for_status()
+        statuses = {
+            operation["id"]: operation["status"]
+            for operation in response.json().get("operations_list") or []
+        } | rejected
+        if BULK_OPERATION_OPEN not in statuses.values():
+            return statuses
+        if time.monotonic() >= deadline:
+            logger.warning("Bulk resend " + bulk_uuid + " still running")
+            return statuses
+        time.sleep(config.magento_bulk_poll_secs)
+
+
 def _log_order_outcome(details) -> None:
     """Log the outcome of processing an order."""
     logger.info(details)
 
 
+# ASYNC ENGINE
+# The same pipeline as asyncio tasks on one thread with aiohttp, for
+# ENGINE=async. The state store, outbox, cache and metrics are shared with
+# the threaded functions above, and each store's config is carried into its
+# tasks by the context they are created in.
+
+
+class _AsyncResponse:
+    """An aiohttp response read into memory, with the parts of the requests
+    API the pipeline uses so that it is handled the same way."""
+
+    def __init__(self, status_code, headers, content, url):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.url = url
+
+    def __repr__(self):
+        return f"<Response [{self.status_code}]>"
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(
+                f"{self.status_code} Error for url: {self.url}", response=self
+            )
+
+
+def create_async_session() -> "aiohttp.ClientSession":
+    """Create the connection pooling aiohttp session shared by every store,
+    with at most MAX_CONCURRENCY_PER_HOST connections to any one host. It
+    must be created and closed within the running event loop."""
+    config = get_config()
+    connect_timeout, read_timeout = config.http_timeout
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=config.http_pool_connections * config.http_pool_maxsize,
+            limit_per_host=config.max_concurrency_per_host,
+        ),
+        timeout=aiohttp.ClientTimeout(
+            sock_connect=connect_timeout, sock_read=read_timeout
+        ),
+        trace_configs=[_build_trace_config()] if _trace_events is not None else None,
+    )
+
+
+def _build_trace_config() -> "aiohttp.TraceConfig":
+    """Build the trace config marking when each stage of a request happens
+    in its trace_request_ctx, for a profiled cycle's trace."""
+    trace_config = aiohttp.TraceConfig()
+
+    def mark(stage):
+        async def callback(session, context, params):
+            if context.trace_request_ctx is not None:
+                context.trace_request_ctx[stage] = time.perf_counter()
+
+        return callback
+
+    for signal_name, stage in [
+        ("on_request_start", "request_start"),
+        ("on_dns_resolvehost_start", "dns_start"),
+        ("on_dns_resolvehost_end", "dns_end"),
+        ("on_connection_create_start", "connect_start"),
+        ("on_connection_create_end", "connect_end"),
+        # Sent once the response headers are in.
+        ("on_request_end", "first_byte"),
+    ]:
+        getattr(trace_config, signal_name).append(mark(stage))
+    return trace_config
+
+
+async def _http_request_async(session, method, url, **kwargs):
+    """Send a request through the session and read its response."""
+    config = get_config()
+    if config.replay_file:
+        record = _next_replay_record(method, url, kwargs.get("params"))
+        await asyncio.sleep(_replay_delay(record))
+        return _AsyncResponse(record["status"], {}, record["body"].encode(), url)
+    started = time.perf_counter()
+    if _trace_events is not None:
+        response = await _trace_request_async(session, method, url, **kwargs)
+    else:
+        async with session.request(method.upper(), url, **kwargs) as raw:
+            content = await raw.read()
+            response = _AsyncResponse(raw.status, raw.headers, content, url)
+    if config.record_file:
+        _record_response(
+            method,
+            url,
+            kwargs.get("params"),
+            response,
+            time.perf_counter() - started,
+        )
+    return response
+
+
+async def _trace_request_async(session, method, url, **kwargs):
+    """Send a request like _http_request_async(), adding it to the cycle's
+    trace with its status, size, and DNS, connect (including TLS) and time
+    to first byte timings for any stages it went through."""
+    started = time.perf_counter()
+    stages = {}
+    args = {}
+    try:
+        async with session.request(
+            method.upper(), url, trace_request_ctx=stages, **kwargs
+        ) as response:
+            content = await response.read()
+            args = {"status": response.status, "bytes": len(content)}
+            return _AsyncResponse(response.status, response.headers, content, url)
+    finally:
+        for timing, start, end in [
+            ("dns_ms", "dns_start", "dns_end"),
+            ("connect_ms", "connect_start", "connect_end"),
+            ("ttfb_ms", "request_start", "first_byte"),
+        ]:
+            if start in stages and end in stages:
+                args[timing] = (stages[end] - stages[start]) * 1000
+        _add_trace_event(
+            method.upper() + " " + _url_template(url), "http", started, **args
+        )
+
+
+async def _magento_request_async(session, method, url, **kwargs):
+    """Send an authenticated request to the Magento API, rate limited,
+    retried and behind the circuit breaker like _magento_request()."""
+    config = get_config()
+    headers = {
+        name: value
+        for name, value in config.web_headers.items()
+        if value is not None
+    }
+    max_retries = config.magento_max_retries
+    for attempt in range(max_retries + 1):
+        _check_magento_circuit()
+        while wait_secs := _try_take_magento_token():
+            await asyncio.sleep(wait_secs)
+        last_attempt = attempt == max_retries
+        try:
+            response = await _http_request_async(
+                session, method, url, headers=headers, **kwargs
+            )
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            _record_magento_result(False)
+            if last_attempt or not _can_retry_error(method, e):
+                raise
+            logger.warning("Magento request failed: " + repr(e))
+            await asyncio.sleep(_retry_delay(attempt))
+            continue
+        if response.status_code != 429 and response.status_code < 500:
+            _record_magento_result(True)
+            return response
+        _record_magento_result(False)
+        if last_attempt or not _can_retry_response(method, response):
+            return response
+        logger.warning(
+            "Magento responded " + str(response.status_code) + ", retrying"
+        )
+        await asyncio.sleep(_retry_delay(attempt, response))
+    return response
+
+
+async def fetch_unsent_orders_async(session, watermark=None) -> list:
+    """Fetch the unsent orders from Magento in one request."""
+    config = get_config()
+    WEB_ORDER_EP = config.web_domain + config.web_orders_api_endpoint
+    with _time_phase("fetch_unsent_orders"):
+        raw_order_response = await _magento_request_async(
+            session,
+            "get",
+            WEB_ORDER_EP,
+            params=_build_order_criteria(watermark=watermark),
+        )
+    json_response = raw_order_response.json()
+    _check_order_response(json_response)
+    _increment_metric("orders_fetched", len(json_response["items"]))
+    return _parse_orders(json_response["items"])
+
+
+async def fetch_unsent_orders_paged_async(session, page_size=None, watermark=None):
+    """Yield the unsent orders a page at a time, walking the pages by entity
+    ID like fetch_unsent_orders_paged(). As soon as a page arrives the next
+    one is fetched while its orders are processed."""
+    if page_size is None:
+        page_size = get_config().order_page_size or DEFAULT_ORDER_PAGE_SIZE
+    if page_size < 1:
+        raise ValueError("Page size must be at least 1")
+    json_response = await _fetch_order_page_async(
+        session, page_size, None, watermark
+    )
+    _check_order_response(json_response)
+    next_page = None
+    try:
+        while True:
+            items = _parse_orders(json_response.get("items") or [])
+            after_entity_id = _next_page_after(
+                items, page_size, json_response.get("total_count", 0)
+            )
+            del json_response
+            if after_entity_id is not None:
+                next_page = asyncio.create_task(
+                    _fetch_order_page_async(
+                        session, page_size, after_entity_id, watermark
+                    )
+                )
+            for order in items:
+                yield order
+            if next_page is None:
+                return
+            json_response = await next_page
+            next_page = None
+    finally:
+        if next_page is not None:
+            next_page.cancel()
+
+
+async def _fetch_order_page_async(session, page_size, after_entity_id, watermark):
+    """Fetch one page of unsent orders."""
+    config = get_config()
+    WEB_ORDER_EP = config.web_domain + config.web_orders_api_endpoint
+    with _time_phase("fetch_unsent_orders"):
+        raw_order_response = await _magento_request_async(
+            session,
+            "get",
+            WEB_ORDER_EP,
+            params=_build_order_criteria(page_size, after_entity_id, watermark),
+        )
+        json_response = raw_order_response.json()
+    _increment_metric("orders_fetched", len(json_response.get("items") or []))
+    return json_response
+
+
+async def process_orders_async(session, orders, max_workers=None) -> int:
+    """Process the orders, from a list or an async iterator, as concurrent
+    tasks with at most max_workers (MAX_CONCURRENCY) at once. No more orders
+    are taken until a task finishes, so a paged fetch isn't drained into
+    memory ahead of them. Returns the number of orders which failed."""
+    if max_workers is None:
+        max_workers = get_config().max_concurrency
+    semaphore = asyncio.Semaphore(max_workers)
+    tasks = set()
+    failed = 0
+
+    async def process(order):
+        nonlocal failed
+        try:
+            await _process_order_async(session, order)
+        except Exception as e:
+            _log_order_failure(order, e)
+            failed += 1
+        finally:
+            semaphore.release()
+
+    # Orders are leased when sharding, which blocks on the lease backend.
+    sharded = get_config().shard_count > 1
+    async for order in _iterate_async(orders):
+        if not await _run_blocking(
+            _order_needs_processing, order, blocks=sharded
+        ):
+            continue
+        await semaphore.acquire()
+        task = asyncio.create_task(process(order))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    await asyncio.gather(*tasks)
+    # The bulk API is polled for a while, so do it off the event loop.
+    failed += await asyncio.to_thread(flush_bulk_resends)
+    # Send whatever escalations are still waiting to be batched.
+    await flush_escalations_async(session)
+    return failed + _take_escalation_failures()
+
+
+async def _iterate_async(orders):
+    """Iterate over a list or an async iterator of orders."""
+    if hasattr(orders, "__aiter__"):
+        async for order in orders:
+            yield order
+    else:
+        for order in orders:
+            yield order
+
+
+async def _run_blocking(function, *args, blocks=True):
+    """Run a function which blocks on the state store, outbox, order cache or
+    leases in a thread, so it doesn't hold up every other task on the event
+    loop, or straight away if it won't block this time."""
+    if not blocks:
+        return function(*args)
+    return await asyncio.to_thread(function, *args)
+
+
+async def _process_order_async(session, order) -> None:
+    """Resend or escalate a single unsent order and log the outcome."""
+    config = get_config()
+    uses_state_store = bool(config.state_store_file)
+    _log_order(order)
+    attempts = await _run_blocking(
+        _check_resend_attempts, order, blocks=uses_state_store
+    )
+    if attempts >= config.max_email_attempts and config.webhook_batching:
+        # The outcome is logged once the batch has been sent.
+        await _queue_escalation_async(session, order)
+        return
+    elif attempts >= config.max_email_attempts:
+        await _run_outbox_action_async(session, "alert", order)
+        await _run_outbox_action_async(session, "email_sales", order)
+        outcome = "escalated"
+    elif config.magento_bulk_resend:
+        await _run_blocking(
+            _queue_bulk_resend,
+            order,
+            attempts,
+            blocks=bool(config.outbox_file) or uses_state_store,
+        )
+        return
+    else:
+        sent = await _run_outbox_action_async(
+            session, "resend", order, attempts + 1
+        )
+        outcome = "resent" if sent else "resend_failed"
+    await _run_blocking(
+        _finish_order, order, attempts, outcome, blocks=uses_state_store
+    )
+
+
+async def _run_outbox_action_async(session, action, order, attempt=None):
+    """Run the async version of the action like _run_outbox_action()."""
+    run_action = globals()[OUTBOX_ACTIONS[action] + "_async"]
+    if not get_config().outbox_file:
+        return await run_action(session, order)
+    key = _outbox_key(action, order, attempt)
+    if await asyncio.to_thread(_outbox_is_done, key):
+        logger.info(
+            f"Order {order.get('increment_id')} {action} already done, skipping"
+        )
+        return _outbox_done[key]
+    await asyncio.to_thread(_write_outbox_record, key, action, order, "intended")
+    result = await run_action(session, order)
+    await asyncio.to_thread(
+        _write_outbox_record, key, action, order, "done", result
+    )
+    return result
+
+
+@_timed("resend_order_with_magento")
+async def _resend_order_with_magento_async(session, order) -> bool:
+    """Using the Magento API, request for the order email to be resent."""
+    if "entity_id" not in order:
+        raise ValueError("No entity ID present on order")
+    config = get_config()
+    WEB_ORDER_EMAIL_API_ENDPOINT = (
+        config.web_domain
+        + config.web_order_api_endpoint
+        + str(order["entity_id"])
+        + "/emails"
+    )
+    response = await _magento_request_async(
+        session, "post", WEB_ORDER_EMAIL_API_ENDPOINT
+    )
+    logger.info("Magento resending email: %s", response)
+    if response.status_code != 200:
+        response.raise_for_status()
+    return response.json() == "true"
+
+
+@_timed("alert_admin")
+async def _alert_admin_async(session, order) -> None:
+    """Alert the admin that the order is being manually sent to sales."""
+    if "entity_id" not in order or "increment_id" not in order:
+        raise ValueError("Invalid order object")
+    await _http_request_async(
+        session,
+        "post",
+        get_config().alert_webhook_url,
+        json=_build_alert_payload(order),
+    )
+
+
+@_timed("email_order_to_sales")
+async def _email_order_to_sales_async(session, order) -> None:
+    """Email the order details to the sales inbox manually."""
+    if "entity_id" not in order:
+        raise ValueError("No entity ID present on order.")
+    order_payload = await _fetch_sales_payload_async(session, order)
+    webhook_response = await _http_request_async(
+        session, "post", get_config().email_webhook_url, json=order_payload
+    )
+    if webhook_response.status_code != 200:
+        webhook_response.raise_for_status()
+
+
+async def _fetch_sales_payload_async(session, order) -> dict:
+    """Fetch the full order from Magento (or the cache) and build the payload
+    to email to sales."""
+    config = get_config()
+    cache_key = _order_cache_key(order)
+    # The cache is loaded from its file on first use.
+    uses_cache_file = bool(config.order_cache_size and config.order_cache_file)
+    full_order = await _run_blocking(
+        _get_cached_full_order, cache_key, blocks=uses_cache_file
+    )
+    if full_order is None:
+        api_response = await _magento_request_async(
+            session,
+            "get",
+            config.web_domain
+            + config.web_order_api_endpoint
+            + str(order["entity_id"]),
+            params={"fields": config.sales_order_fields},
+        )
+        if api_response.status_code != 200:
+            api_response.raise_for_status()
+        full_order = api_response.json()
+        await _run_blocking(
+            _cache_full_order, cache_key, full_order, blocks=uses_cache_file
+        )
+    return _build_sales_payload(full_order)
+
+
+async def _queue_escalation_async(session, order) -> None:
+    """Queue an escalated order to be sent in the next batch, like
+    _queue_escalation()."""
+    uses_outbox = bool(get_config().outbox_file)
+    if await _run_blocking(_escalation_done, order, blocks=uses_outbox):
+        return
+    order_payload = await _fetch_sales_payload_async(session, order)
+    if await _run_blocking(
+        _add_to_escalation_batch, order, order_payload, blocks=uses_outbox
+    ):
+        await flush_escalations_async(session)
+
+
+async def flush_escalations_async(session) -> int:
+    """Send the store's queued escalations like flush_escalations()."""
+    config = get_config()
+    with _escalation_batch_lock:
+        batch = _escalation_batches.pop(config.store, [])
+    if not batch:
+        return 0
+    try:
+        alert_payloads = [_build_alert_payload(order) for order, _ in batch]
+        await _post_batch_async(
+            session,
+            config.alert_webhook_url,
+            _build_escalation_digest(alert_payloads),
+            alert_payloads,
+        )
+        order_payloads = [order_payload for _, order_payload in batch]
+        await _post_batch_async(
+            session,
+            config.email_webhook_url,
+            {"orders": order_payloads},
+            order_payloads,
+        )
+    except Exception as e:
+        _fail_escalation_batch(batch, e)
+        return 0
+    await _run_blocking(
+        _finish_escalation_batch,
+        batch,
+        blocks=bool(config.outbox_file or config.state_store_file),
+    )
+    return len(batch)
+
+
+async def _post_batch_async(session, url, batch_payload, payloads) -> None:
+    """Post a batch to a webhook like _post_batch()."""
+    webhook_response = await _http_request_async(
+        session, "post", url, json=batch_payload
+    )
+    if webhook_response.status_code == 200:
+        return
+    if not 400 <= webhook_response.status_code < 500:
+        webhook_response.raise_for_status()
+    logger.info(
+        "Batch rejected by " + url + " with status "
+        + str(webhook_response.status_code) + ", sending orders one by one"
+    )
+    for payload in payloads:
+        webhook_response = await _http_request_async(
+            session, "post", url, json=payload
+        )
+        if webhook_response.status_code != 200:
+            webhook_response.raise_for_status()
+
+
+async def _poll_stores_async(store_configs) -> list:
+    """Poll every store at once over one shared session, kept open between
+    cycles by the daemon, returning the error each store's cycle failed with,
+    or None."""
+    if _async_runner is not None:
+        return await _gather_stores_async(_get_async_session(), store_configs)
+    async with create_async_session() as session:
+        return await _gather_stores_async(session, store_configs)
+
+
+async def _gather_stores_async(session, store_configs) -> list:
+    """Poll each store as its own task, returning what each one returns."""
+    tasks = []
+    for store_config in store_configs:
+        # The task keeps the store's config from the context it is created
+        # in.
+        with use_config(store_config):
+            tasks.append(asyncio.create_task(_poll_store_async(session)))
+    return await asyncio.gather(*tasks)
+
+
+def _get_async_session() -> "aiohttp.ClientSession":
+    """Get the session the daemon keeps between cycles, creating it on first
+    use. It must be called within the daemon's event loop."""
+    global _async_session
+    if _async_session is None or _async_session.closed:
+        _async_session = create_async_session()
+    return _async_session
+
+
+def _run_async(coroutine):
+    """Run the coroutine to completion on the daemon's event loop, or on a
+    new one outside the daemon."""
+    if _async_runner is None:
+        return asyncio.run(coroutine)
+    return _async_runner.run(coroutine)
+
+
+def open_async_engine() -> None:
+    """Keep one event loop, and the session created on it, for every async
+    cycle until close_async_engine(), so connections stay open between
+    cycles. Cycles must not run at once."""
+    global _async_runner
+    if _async_runner is None:
+        _async_runner = asyncio.Runner()
+
+
+def close_async_engine() -> None:
+    """Close the session and event loop kept between async cycles."""
+    global _async_runner, _async_session
+    if _async_runner is None:
+        return
+    if _async_session is not None:
+        _async_runner.run(_async_session.close())
+        _async_session = None
+    _async_runner.close()
+    _async_runner = None
+
+
+async def _poll_store_async(session):
+    """Fetch and process the unsent orders of the store in use, like
+    _poll_store(). Errors are returned rather than raised, as NoOrdersFound
+    would otherwise stop the event loop."""
+    config = get_config()
+    try:
+        if config.store not in _outbox_replayed:
+            await asyncio.to_thread(replay_outbox)
+        watermark = load_watermark() if config.incremental_polling else None
+        if config.order_page_size:
+            unsent_orders = fetch_unsent_orders_paged_async(
+                session, watermark=watermark
+            )
+        else:
+            unsent_orders = await fetch_unsent_orders_async(
+                session, watermark=watermark
+            )
+        if config.shard_count > 1:
+            unsent_orders = _owned_orders_async(unsent_orders)
+        if not config.incremental_polling:
+            await process_orders_async(session, unsent_orders)
+            return None
+        seen = {}
+        failed = await process_orders_async(
+            session, _track_watermark_async(unsent_orders, seen)
+        )
+        if failed == 0 and seen:
+            save_watermark(seen)
+    except (Exception, NoOrdersFound) as e:
+        return e
+    return None
+
+
+async def _owned_orders_async(orders):
+    """Pass through the orders in this instance's shards."""
+    async for order in _iterate_async(orders):
+        if _owns_order(order):
+            yield order
+
+
+async def _track_watermark_async(orders, watermark):
+    """Pass orders through like _track_watermark()."""
+    async for order in _iterate_async(orders):
+        _advance_watermark(order, watermark)
+        yield order
+
+
+@_configurable
+def run_cycle() -> None:
+    """Fetch and process the unsent orders in the current time window, or
+    since the watermark when polling incrementally. With STORES set, every
+    store is polled at once, sharing the time window and DST lookup. With
+    PROFILE_DIR set, the cycle is profiled."""
+    config = get_config()
+    if config.shard_count > 1 and not claim_shards():
+        logger.info("No shards free, skipping this cycle")
+        return
+    with _profile_cycle() if config.profile_dir else nullcontext():
+        refresh_sync_period()
+        check_daylight_savings_time()
+        try:
+            if config.engine == "async":
+                errors = _run_async(_poll_stores_async(config.store_configs))
+                for store_config, error in zip(config.store_configs, errors):
+                    if error is not None and not config.stores:
+                        raise error
+                    _log_store_failure(store_config, error)
+            elif config.stores:
+                _poll_stores(config.store_configs)
+            else:
+                _poll_store()
+        finally:
+            flush_outbox()
+            save_order_cache()
+            close_recording()
+            _set_metric("last_cycle_timestamp", time.time())
+            write_metrics_textfile()
+
+
+def _poll_stores(store_configs) -> None:
+    """Poll each store from its own thread. A store which fails, or has no
+    orders, doesn't stop the others."""
+    with ThreadPoolExecutor(
+        max_workers=len(store_configs),
+        thread_name_prefix="store",
+        initializer=_start_worker_thread,
+        initargs=(get_config(),),
+    ) as executor:
+        futures = {
+            executor.submit(_poll_store, config=store_config): store_config
+            for store_config in store_configs
+        }
+        for future in as_completed(futures):
+            _log_store_failure(futures[future], future.exception())
+
+
+def _log_store_failure(store_config, error) -> None:
+    """Log a store's cycle failing, unless it just had no orders."""
+    if error is None or isinstance(error, NoOrdersFound):
+        return
+    with use_config(store_config):
+        logger.error("Store cycle failed: " + repr(error))
+
+
+@_configurable
+def _poll_store() -> None:
+    """Fetch and process the unsent orders of the store in use."""
+    config = get_config()
+    if config.store not in _outbox_replayed:
+        replay_outbox()
+    watermark = load_watermark() if config.incremental_polling else None
+    if config.order_page_size:
+        unsent_orders = fetch_unsent_orders_paged(watermark=watermark)
+    else:
+        unsent_orders = fetch_unsent_orders(watermark=watermark)
+    if config.shard_count > 1:
+        unsent_orders = filter(_owns_order, unsent_orders)
+    if not config.incremental_polling:
+        process_orders(unsent_orders)
+        return
+    seen = {}
+    failed = process_orders(_track_watermark(unsent_orders, seen))
+    # Only move the watermark on once every order has been handled so that
+    # failed orders are fetched again next cycle.
+    if failed == 0 and seen:
+        save_watermark(seen)
+
+
+def load_watermark():
+    """Load the newest order 'updated_at' and 'entity_id' handled by the last
+    successful cycle, or None if there hasn't been one."""
+    try:
+        with open(get_config().watermark_file) as watermark_file:
+            watermark = json.load(watermark_file)
+        if "updated_at" in watermark and "entity_id" in watermark:
+            return watermark
+    except (OSError, ValueError, TypeError):
+        pass
+    return None
+
+
+def save_watermark(watermark) -> None:
+    """Atomically persist the watermark for the next cycle."""
+    watermark_file_name = get_config().watermark_file
+    temp_file = watermark_file_name + ".tmp"
+    with open(temp_file, "w") as watermark_file:
+        json.dump(
+            {
+                "updated_at": watermark["updated_at"],
+                "entity_id": watermark["entity_id"],
+            },
+            watermark_file,
+        )
+    os.replace(temp_file, watermark_file_name)
+
+
+def _track_watermark(orders, watermark):
+    """Pass orders through, recording the newest 'updated_at' (with the
+    'entity_id' breaking ties) into the watermark dict."""
+    for order in orders:
+        _advance_watermark(order, watermark)
+        yield order
+
+
+def _advance_watermark(order, watermark) -> None:
+    """Move the watermark dict on to the order if it is newer."""
+    if "updated_at" in order:
+        latest = (order["updated_at"], order["entity_id"])
+        if not watermark or latest > (
+            watermark["updated_at"],
+            watermark["entity_id"],
+        ):
+            watermark["updated_at"], watermark["entity_id"] = latest
+
+
+def start_receiver(port=None) -> ThreadingHTTPServer:
+    """Receive order events from Magento or a webhook relay over HTTP from a
+    background thread. Each event is a JSON object, or a list of them, with
+    the order's "entity_id" and, when polling several stores, its "store".
+    Orders are queued to be checked once placed, and dropped from the queue
+    once their email is sent."""
+    config = get_config()
+    if port is None:
+        port = config.receiver_port
+
+    class ReceiverHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            event = RECEIVER_EVENTS.get(urlsplit(self.path).path)
+            if event is None:
+                self.send_error(404)
+                return
+            if config.receiver_token and not hmac.compare_digest(
+                self.headers.get("Authorization", ""),
+                "Bearer " + config.receiver_token,
+            ):
+                self.send_error(401)
+                return
+            length = int(self.headers.get("Content-Length") or 0)
+            try:
+                events = json.loads(self.rfile.read(length))
+                with use_config(config):
+                    accepted = receive_order_events(event, events)
+            except ValueError as e:
+                self.send_error(400, str(e))
+                return
+            body = json.dumps({"accepted": accepted}).encode()
+            self.send_response(202)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((config.receiver_host, port), ReceiverHandler)
+    Thread(target=server.serve_forever, name="receiver", daemon=True).start()
+    logger.info("Receiving order events on port " + str(server.server_address[1]))
+    return server
+
+
+def receive_order_events(event, events) -> int:
+    """Queue or cancel the checks of the orders in "order_placed" or
+    "email_sent" events, raising ValueError if any are invalid. Returns the
+    number of events accepted."""
+    config = get_config()
+    if not isinstance(events, list):
+        events = [events]
+    checks = []
+    for order_event in events:
+        if not isinstance(order_event, dict):
+            raise ValueError("Events must be JSON objects")
+        try:
+            entity_id = int(order_event["entity_id"])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("Events need the order's entity_id")
+        store = order_event.get("store", "")
+        if store not in (config.stores or ("",)):
+            raise ValueError("Unknown store: " + str(store))
+        checks.append((store, entity_id))
+    if event == "email_sent":
+        with _order_checks_lock:
+            for key in checks:
+                _order_checks.pop(key, None)
+    else:
+        _queue_order_checks(checks)
+    _increment_metric("order_events_received", len(checks), event=event)
+    return len(checks)
+
+
+def _queue_order_checks(checks) -> None:
+    """Queue each (store, entity ID) to be checked after the delay, unless
+    it is already queued."""
+    due_at = time.monotonic() + get_config().receiver_check_delay_secs
+    with _order_checks_lock:
+        for key in checks:
+            _order_checks.setdefault(key, due_at)
+
+
+def cancel_order_check(entity_id) -> None:
+    """Stop an order of the store in use from being checked."""
+    with _order_checks_lock:
+        _order_checks.pop((get_config().store, entity_id), None)
+
+
+@_configurable
+def run_due_order_checks(now=None) -> int:
+    """Fetch and process the orders whose check is due, with one search per
+    store. Orders which couldn't be checked are queued to be tried again
+    after another delay. Returns the number of orders checked."""
+    config = get_config()
+    if now is None:
+        now = time.monotonic()
+    due = {}
+    with _order_checks_lock:
+        for key, due_at in list(_order_checks.items()):
+            if due_at <= now:
+                del _order_checks[key]
+                due.setdefault(key[0], []).append(key[1])
+    for store_config in config.store_configs:
+        entity_ids = due.get(store_config.store)
+        if not entity_ids:
+            continue
+        with use_config(store_config):
+            try:
+                process_orders(fetch_orders_by_id(entity_ids))
+            except Exception as e:
+                logger.error("Order checks failed: " + repr(e))
+                _queue_order_checks(
+                    (store_config.store, entity_id) for entity_id in entity_ids
+                )
+    if due:
+        flush_outbox()
+    return sum(len(entity_ids) for entity_ids in due.values())
+
+
+def fetch_orders_by_id(entity_ids) -> list:
+    """Fetch the orders with the given entity IDs, a page at a time."""
+    config = get_config()
+    WEB_ORDER_EP = config.web_domain + config.web_orders_api_endpoint
+    orders = []
+    for start in range(0, len(entity_ids), DEFAULT_ORDER_PAGE_SIZE):
+        page_ids = entity_ids[start : start + DEFAULT_ORDER_PAGE_SIZE]
+        with _time_phase("fetch_unsent_orders"):
+            raw_order_response = _magento_request(
+                "get",
+                WEB_ORDER_EP,
+                params=_build_order_criteria(
+                    len(page_ids), entity_ids=page_ids
+                ),
+            )
+            if raw_order_response.status_code != 200:
+                raw_order_response.raise_for_status()
+            items = raw_order_response.json().get("items") or []
+        _increment_metric("orders_fetched", len(items))
+        orders += _parse_orders(items)
+    return orders
+
+
+def _run_order_checks(stop_event) -> None:
+    """Keep checking the orders which are due until stopped. Checks wait for
+    a running cycle so the same order is never processed twice at once."""
+    while not stop_event.wait(ORDER_CHECK_INTERVAL_SECS):
+        try:
+            with _cycle_lock:
+                run_due_order_checks()
+        except Exception:
+            logger.exception("Order checks failed")
+
+
+def _run_scheduled_cycle() -> None:
+    """Run a daemon cycle unless the previous one is still running."""
+    if not _cycle_lock.acquire(blocking=False):
+        logger.warning("Previous cycle is still running, skipping this cycle")
+        return
+    try:
+        run_cycle()
+    except NoOrdersFound:
+        pass
+    except Exception:
+        logger.exception("Cycle failed")
+    finally:
+        _cycle_lock.release()
+
+
+@_configurable
+def run_once() -> None:
+    """Run a single cycle, as from cron, then give up this instance's leases.
+    Each run has its own worker ID unless WORKER_ID is set, so leases left
+    behind would hold its shards from the next run until they lapse."""
+    try:
+        run_cycle()
+    finally:
+        release_shards()
+
+
+@_configurable
+def run_daemon(poll_interval=None, jitter=None, stop_event=None) -> None:
+    """Keep running cycles every poll interval (plus jitter) until stopped,
+    reusing the same connections, handlers and state between cycles."""
+    config = get_config()
+    # Check every store's settings before starting.
+    config.store_configs
+    if poll_interval is None:
+        poll_interval = config.daemon_poll_secs
+    if jitter is None:
+        jitter = config.daemon_jitter_secs
+    if stop_event is None:
+        stop_event = Event()
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signal_number, lambda *_: stop_event.set())
+    logger.info(
+        "Starting daemon, polling every " + str(poll_interval) + " seconds"
+    )
+    metrics_server = start_metrics_server() if config.metrics_port else None
+    if config.engine == "async":
+        open_async_engine()
+    receiver = None
+    if config.receiver_port:
+        receiver = start_receiver()
+        Thread(
+            target=contextvars.copy_context().run,
+            args=(_run_order_checks, stop_event),
+            name="order-checks",
+            daemon=True,
+        ).start()
+    cycle = None
+    while not stop_event.is_set():
+        # Each cycle runs with the config in use here.
+        cycle = Thread(
+            target=contextvars.copy_context().run,
+            args=(_run_scheduled_cycle,),
+            name="cycle",
+            daemon=True,
+        )
+        cycle.start()
+        stop_event.wait(poll_interval + random.uniform(0, jitter))
+    if cycle is not None:
+        cycle.join()
+    close_async_engine()
+    if metrics_server is not None:
+        metrics_server.shutdown()
+    if receiver is not None:
+        receiver.shutdown()
+    release_shards()
+    close_recording()
+    logger.info("Daemon stopped")
+
+
 if __name__ == "__main__":
-    check_daylight_savings_time()
-    unsent_orders = fetch_unsent_orders()
-    process_orders(unsent_orders)
+    parser = argparse.ArgumentParser(
+        description="Resend or escalate unsent Magento order emails."
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="keep running and poll Magento every DAEMON_POLL_SECS",
+    )
+    args = parser.parse_args()
+    setup_logging()
+    if args.daemon:
+        run_daemon()
+    else:
+        run_once()
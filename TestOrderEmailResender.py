@@ -1,11 +1,24 @@
+import asyncio
+import dataclasses
 from datetime import datetime
 from faker import Faker
+import functools
+import gzip
+import io
+import json
+from MockMagentoServer import ALERT_PATH, EMAIL_PATH, ORDERS_PATH, MockMagentoServer
 import OrderEmailResender
 import os
+import pendulum
+import pstats
 import random
 import requests
+import tempfile
+import threading
+import time
 import unittest
-from unittest.mock import MagicMock, Mock
+from unittest.mock import MagicMock, Mock, patch
+import urllib3
 
 fake = Faker("en_GB")
 
@@ -30,17 +43,85 @@ class MockResponse:
 
 
 class TestOrderEmailResender(unittest.TestCase):
+    def setUp(self):
+        # Retry Magento straight away and don't let failures from one test
+        # open the circuit breaker for the next.
+        self.configure(magento_retry_backoff_secs=0)
+        OrderEmailResender.reset_magento_circuit()
+
+    def configure(self, **settings):
+        """Use a copy of the config with the settings changed for the rest
+        of the test."""
+        config = dataclasses.replace(
+            OrderEmailResender.get_config(), **settings
+        )
+        self.enterContext(OrderEmailResender.use_config(config))
+        return config
+
+    def send_real_requests(self):
+        """Undo other tests mocking out the session methods for the rest of
+        the test, so requests reach a MockMagentoServer."""
+        for method in ("get", "post"):
+            self.enterContext(
+                patch.object(
+                    requests.Session,
+                    method,
+                    functools.partialmethod(requests.Session.request, method),
+                )
+            )
+
+    def _mock_order_pages(self, total_count, page_size):
+        """Mock the orders and the search responses paging through them,
+        each counting the orders from that page on like Magento does."""
+        mock_orders = [
+            {
+                "entity_id": entity_id,
+                "increment_id": "60000" + str(entity_id),
+                "status": "processing",
+            }
+            for entity_id in range(10_000, 10_000 + total_count)
+        ]
+        mock_pages = [
+            MockResponse(
+                {
+                    "items": mock_orders[i : i + page_size],
+                    "total_count": total_count - i,
+                },
+                200,
+            )
+            for i in range(0, total_count, page_size)
+        ]
+        return mock_orders, mock_pages
+
     def test_check_daylight_savings_time(self):
-        """Test checking daylight savings time and how the function
-        handles API availability or response changes.
+        """Test checking daylight savings time locally and how the optional
+        Time API verification handles availability, response changes and
+        caching.
 
         Assumption made;
         1. This test will be run during business hours where checking for overlap
             of days won't be necessary.
         """
         DT_FORMAT = "%Y-%m-%d %H:%M:%S"
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self.configure(
+            dst_cache_file=os.path.join(cache_dir.name, "dst_cache.json")
+        )
+
+        # Test DST is calculated without calling the Time API
+        self.configure(dst_verify_remote=False)
+        requests.Session.get = MagicMock()
+        OrderEmailResender.check_daylight_savings_time()
+        sync_period_day = datetime.strptime(
+            OrderEmailResender.SYNC_PERIOD_TIME_STR, DT_FORMAT
+        ).date()
+        self.assertEqual(sync_period_day, datetime.today().date())
+        requests.Session.get.assert_not_called()
+
         # Test API returns expected data
-        requests.get = MagicMock(
+        self.configure(dst_verify_remote=True)
+        requests.Session.get = MagicMock(
             return_value=MockResponse({"isDayLightSavingActive": True}, 200)
         )
         OrderEmailResender.check_daylight_savings_time()
@@ -48,10 +129,23 @@ class TestOrderEmailResender(unittest.TestCase):
             OrderEmailResender.SYNC_PERIOD_TIME_STR, DT_FORMAT
         ).date()
         self.assertEqual(sync_period_day, datetime.today().date())
-        requests.get.assert_called()
+        requests.Session.get.assert_called_once()
+
+        # Test the API result is cached for the rest of the day
+        requests.Session.get = MagicMock()
+        self.assertTrue(
+            OrderEmailResender._fetch_remote_daylight_savings_time()
+        )
+        requests.Session.get.assert_not_called()
+        os.remove(OrderEmailResender.DST_CACHE_FILE)
 
         # Test API returns unexpected data
-        requests.get = MagicMock(return_value=MockResponse({"foo": "bar"}, 200))
+        requests.Session.get = MagicMock(
+            return_value=MockResponse({"foo": "bar"}, 200)
+        )
+        self.assertIsNone(
+            OrderEmailResender._fetch_remote_daylight_savings_time()
+        )
         OrderEmailResender.check_daylight_savings_time()
         sync_period_day = datetime.strptime(
             OrderEmailResender.SYNC_PERIOD_TIME_STR, DT_FORMAT
@@ -60,13 +154,15 @@ class TestOrderEmailResender(unittest.TestCase):
             sync_period_day,
             datetime.today().date(),
         )
-        requests.get.assert_called()
+        requests.Session.get.assert_called()
 
         # Test API is unavailable
-        requests.get = Mock(return_value=MockResponse({}, 500))
-        requests.get.side_effect = requests.exceptions.ConnectionError()
-        with self.assertRaises(requests.exceptions.ConnectionError):
-            OrderEmailResender.check_daylight_savings_time()
+        requests.Session.get = Mock(return_value=MockResponse({}, 500))
+        requests.Session.get.side_effect = requests.exceptions.ConnectionError()
+        self.assertIsNone(
+            OrderEmailResender._fetch_remote_daylight_savings_time()
+        )
+        OrderEmailResender.check_daylight_savings_time()
         sync_period_day = datetime.strptime(
             OrderEmailResender.SYNC_PERIOD_TIME_STR, DT_FORMAT
         ).date()
@@ -74,7 +170,7 @@ class TestOrderEmailResender(unittest.TestCase):
             sync_period_day,
             datetime.today().date(),
         )
-        requests.get.assert_called()
+        requests.Session.get.assert_called()
 
     def test_fetch_unsent_orders(self):
         """Test fetching unsent orders from the Magento API."""
@@ -102,12 +198,12 @@ class TestOrderEmailResender(unittest.TestCase):
         mock_unsent_order_json["total_count"] = len(
             mock_unsent_order_json["items"]
         )
-        requests.get = MagicMock(
+        requests.Session.get = MagicMock(
             return_value=MockResponse(mock_unsent_order_json, 200)
         )
         unsent_orders = OrderEmailResender.fetch_unsent_orders()
         self.assertIsInstance(unsent_orders, list)
-        requests.get.assert_called()
+        requests.Session.get.assert_called()
 
         # Test API returns data without orders
         mock_json_responses = [
@@ -117,18 +213,1958 @@ class TestOrderEmailResender(unittest.TestCase):
         ]
         for expected_response in mock_json_responses:
             with self.assertRaises(SystemExit) as e:
-                requests.get = MagicMock(
+                requests.Session.get = MagicMock(
                     return_value=MockResponse(expected_response, 200)
                 )
                 OrderEmailResender.fetch_unsent_orders()
                 self.assertEqual(e.exception.code, 0)
 
         # Test API unavailable
-        requests.get = Mock(return_value=MockResponse({}, 500))
-        requests.get.side_effect = requests.exceptions.ConnectionError()
+        requests.Session.get = Mock(return_value=MockResponse({}, 500))
+        requests.Session.get.side_effect = requests.exceptions.ConnectionError()
         with self.assertRaises(requests.exceptions.ConnectionError):
             OrderEmailResender.fetch_unsent_orders()
-        requests.get.assert_called()
+        requests.Session.get.assert_called()
+
+    def test_fetch_unsent_orders_paged(self):
+        """Test fetching unsent orders from the Magento API a page at a
+        time."""
+        page_size = 10
+        after = "searchCriteria[filter_groups][{}][filters][0]".format(
+            3 if OrderEmailResender.get_config().server_side_filter else 1
+        )
+        # Including totals which are an exact multiple of the page size.
+        for total_count in (5, 10, 20, 23, 45):
+            with self.subTest(total_count=total_count):
+                mock_orders, mock_pages = self._mock_order_pages(
+                    total_count, page_size
+                )
+
+                # Test every page is requested and every order is yielded
+                requests.Session.get = MagicMock(side_effect=mock_pages)
+                unsent_orders = OrderEmailResender.fetch_unsent_orders_paged(
+                    page_size
+                )
+                self.assertNotIsInstance(unsent_orders, list)
+                requests.Session.get.assert_not_called()
+                self.assertEqual(list(unsent_orders), mock_orders)
+                self.assertEqual(
+                    requests.Session.get.call_count, len(mock_pages)
+                )
+                # Test each page is the first page after the last order seen,
+                # so orders dropping out of the results don't shift the pages
+                calls = requests.Session.get.call_args_list
+                for page_number, call in enumerate(calls):
+                    params = call.kwargs["params"]
+                    self.assertEqual(
+                        params["searchCriteria[pageSize]"], page_size
+                    )
+                    self.assertEqual(params["searchCriteria[currentPage]"], 1)
+                    self.assertEqual(
+                        params["searchCriteria[sortOrders][0][field]"],
+                        "entity_id",
+                    )
+                    if page_number == 0:
+                        self.assertNotIn(after + "[field]", params)
+                        continue
+                    self.assertEqual(params[after + "[field]"], "entity_id")
+                    self.assertEqual(params[after + "[condition_type]"], "gt")
+                    self.assertEqual(
+                        params[after + "[value]"],
+                        mock_orders[page_number * page_size - 1]["entity_id"],
+                    )
+
+        mock_orders, mock_pages = self._mock_order_pages(23, page_size)
+        # Test the first page is available before later pages are fetched
+        requests.Session.get = MagicMock(side_effect=mock_pages)
+        unsent_orders = OrderEmailResender.fetch_unsent_orders_paged(
+            page_size
+        )
+        self.assertEqual(next(unsent_orders), mock_orders[0])
+        requests.Session.get.assert_called_once()
+
+        # Test API returns data without orders
+        requests.Session.get = MagicMock(
+            return_value=MockResponse({"items": [], "total_count": 0}, 200)
+        )
+        with self.assertRaises(SystemExit):
+            list(OrderEmailResender.fetch_unsent_orders_paged(page_size))
+
+        # Test invalid page size
+        with self.assertRaises(ValueError):
+            list(OrderEmailResender.fetch_unsent_orders_paged(0))
+
+    def test_fetch_orders_by_id(self):
+        """Test fetching orders by entity ID only filters by the IDs."""
+        mock_orders, mock_pages = self._mock_order_pages(3, 10)
+        requests.Session.get = MagicMock(side_effect=mock_pages)
+        entity_ids = [order["entity_id"] for order in mock_orders]
+        self.assertEqual(
+            OrderEmailResender.fetch_orders_by_id(entity_ids), mock_orders
+        )
+        params = requests.Session.get.call_args.kwargs["params"]
+        self.assertEqual(
+            params["searchCriteria[filter_groups][0][filters][0][value]"],
+            ",".join(str(entity_id) for entity_id in entity_ids),
+        )
+        self.assertNotIn("gt", params.values())
+
+    def test_build_order_criteria(self):
+        """Test the order search criteria with and without Magento doing
+        the email_sent and status filtering."""
+        # Test only the created_at window is filtered client-side
+        self.configure(server_side_filter=False)
+        params = OrderEmailResender._build_order_criteria()
+        self.assertEqual(
+            params["searchCriteria[filter_groups][0][filters][0][field]"],
+            "created_at",
+        )
+        self.assertFalse(
+            any("[filter_groups][1]" in param for param in params)
+        )
+
+        # Test email_sent is 0 OR null, AND status is not a skipped status
+        self.configure(server_side_filter=True)
+        params = OrderEmailResender._build_order_criteria()
+        group = "searchCriteria[filter_groups][1][filters]"
+        self.assertEqual(params[group + "[0][field]"], "email_sent")
+        self.assertEqual(params[group + "[0][value]"], 0)
+        self.assertEqual(params[group + "[0][condition_type]"], "eq")
+        self.assertEqual(params[group + "[1][field]"], "email_sent")
+        self.assertEqual(params[group + "[1][condition_type]"], "null")
+        group = "searchCriteria[filter_groups][2][filters]"
+        self.assertEqual(params[group + "[0][field]"], "status")
+        self.assertEqual(
+            params[group + "[0][value]"], "canceled,pending_payment"
+        )
+        self.assertEqual(params[group + "[0][condition_type]"], "nin")
+
+    def test_process_orders_concurrently(self):
+        """Test processing orders in a thread pool, skipping orders which
+        don't need processing and logging every outcome even when an order
+        fails."""
+        PREFIX = OrderEmailResender.COMMENT_PREFIX
+        max_attempts = OrderEmailResender.MAX_EMAIL_ATTEMPTS
+        orders = [
+            {
+                "entity_id": entity_id,
+                "increment_id": "60000" + str(entity_id),
+                "status": "processing",
+                "status_histories": [],
+            }
+            for entity_id in range(10_000, 10_020)
+        ]
+        orders[0]["email_sent"] = 1
+        orders[1]["status"] = "canceled"
+        orders[2]["status_histories"] = [
+            {"comment": PREFIX + f" Attempt #{i}"}
+            for i in range(1, max_attempts + 1)
+        ]
+        failing_entity_id = orders[3]["entity_id"]
+
+        def resend(order):
+            if order["entity_id"] == failing_entity_id:
+                raise requests.HTTPError("500 Server Error")
+            return True
+
+        with patch.object(
+            OrderEmailResender, "_resend_order_with_magento", side_effect=resend
+        ) as mock_resend, patch.object(
+            OrderEmailResender, "_alert_admin"
+        ) as mock_alert, patch.object(
+            OrderEmailResender, "_email_order_to_sales"
+        ) as mock_email, patch.object(
+            OrderEmailResender, "_log_order_outcome"
+        ) as mock_log:
+            OrderEmailResender.process_orders(iter(orders), max_workers=4)
+
+        self.assertEqual(mock_resend.call_count, len(orders) - 3)
+        mock_alert.assert_called_once_with(orders[2])
+        mock_email.assert_called_once_with(orders[2])
+        outcomes = [call.args[0] for call in mock_log.call_args_list]
+        self.assertEqual(len(outcomes), len(orders) - 2)
+        for order in orders[2:]:
+            self.assertEqual(
+                sum(order["increment_id"] in o for o in outcomes), 1
+            )
+        self.assertTrue(
+            any(
+                orders[3]["increment_id"] in o and "could not be processed" in o
+                for o in outcomes
+            )
+        )
+
+    def test_host_limit(self):
+        """Test the number of concurrent requests to one host is bounded."""
+        limit = OrderEmailResender.MAX_CONCURRENCY_PER_HOST
+        active = []
+        peak = []
+        lock = threading.Lock()
+
+        def request(url):
+            with OrderEmailResender._host_limit(url):
+                with lock:
+                    active.append(url)
+                    peak.append(len(active))
+                time.sleep(0.01)
+                with lock:
+                    active.remove(url)
+
+        threads = [
+            threading.Thread(
+                target=request, args=("https://limited.example/orders",)
+            )
+            for _ in range(limit * 3)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertLessEqual(max(peak), limit)
+
+    def test_get_http_session(self):
+        """Test the shared HTTP sessions are reused, pooled and only send
+        the Magento headers to Magento."""
+        magento = OrderEmailResender.get_http_session("magento")
+        external = OrderEmailResender.get_http_session("external")
+        self.assertIs(OrderEmailResender.get_http_session("magento"), magento)
+        self.assertIsNot(magento, external)
+        for name, value in OrderEmailResender.WEB_HEADERS.items():
+            if value is not None:
+                self.assertEqual(magento.headers[name], value)
+                self.assertNotIn(name, external.headers)
+        adapter = magento.get_adapter("https://my-api-domain.co.uk")
+        self.assertEqual(
+            adapter._pool_maxsize, OrderEmailResender.HTTP_POOL_MAXSIZE
+        )
+
+    def test_refresh_sync_period(self):
+        """Test the sync period is recomputed from the current time."""
+        OrderEmailResender.SYNC_PERIOD_TIME_STR = "2000-01-01 00:00:00"
+        OrderEmailResender.refresh_sync_period()
+        expected = OrderEmailResender.time_now.subtract(
+            minutes=int(OrderEmailResender.ORDER_AGE_MINS)
+        )
+        self.assertEqual(
+            OrderEmailResender.SYNC_PERIOD_TIME_STR,
+            expected.to_datetime_string(),
+        )
+
+    def test_run_daemon(self):
+        """Test the daemon keeps running cycles until stopped, survives a
+        failing cycle and skips a cycle while the previous one is running."""
+        stop_event = threading.Event()
+        cycles = []
+
+        def cycle():
+            cycles.append(time.monotonic())
+            if len(cycles) == 1:
+                raise OrderEmailResender.NoOrdersFound(0)
+            if len(cycles) == 2:
+                raise requests.exceptions.ConnectionError()
+            if len(cycles) >= 3:
+                stop_event.set()
+
+        with patch.object(OrderEmailResender, "run_cycle", side_effect=cycle):
+            OrderEmailResender.run_daemon(
+                poll_interval=0.01, jitter=0, stop_event=stop_event
+            )
+        self.assertGreaterEqual(len(cycles), 3)
+
+        # Test a cycle is skipped while the previous one is still running
+        release = threading.Event()
+        with patch.object(
+            OrderEmailResender, "run_cycle", side_effect=release.wait
+        ) as mock_cycle:
+            running = threading.Thread(
+                target=OrderEmailResender._run_scheduled_cycle
+            )
+            running.start()
+            while not mock_cycle.called:
+                time.sleep(0.001)
+            with self.assertLogs(OrderEmailResender.logger, "WARNING"):
+                OrderEmailResender._run_scheduled_cycle()
+            release.set()
+            running.join()
+        mock_cycle.assert_called_once()
+
+    @unittest.skipIf(
+        OrderEmailResender.aiohttp is None, "the async engine needs aiohttp"
+    )
+    def test_run_daemon_async(self):
+        """Test the daemon runs every async cycle over one session, so its
+        connections stay open, and closes it when stopped."""
+        server = self.enterContext(
+            MockMagentoServer(
+                order_count=10,
+                comment_prefix=OrderEmailResender.COMMENT_PREFIX,
+                max_email_attempts=OrderEmailResender.MAX_EMAIL_ATTEMPTS,
+            )
+        )
+        self.send_real_requests()
+        self.configure(
+            engine="async",
+            magento_rate_limit=0,
+            order_page_size=None,
+            state_store_file=None,
+            outbox_file=None,
+            order_cache_size=0,
+            incremental_polling=False,
+            metrics_port=0,
+            receiver_port=0,
+            web_domain=server.url,
+            web_orders_api_endpoint=ORDERS_PATH,
+            web_order_api_endpoint=ORDERS_PATH + "/",
+            alert_webhook_url=server.url + ALERT_PATH,
+            email_webhook_url=server.url + EMAIL_PATH,
+        )
+        stop_event = threading.Event()
+        run_cycle = OrderEmailResender.run_cycle
+        create_async_session = OrderEmailResender.create_async_session
+        sessions = []
+
+        def cycle():
+            try:
+                run_cycle()
+            finally:
+                if server.request_counts["search_orders"] >= 3:
+                    stop_event.set()
+
+        def create_session():
+            sessions.append(create_async_session())
+            return sessions[-1]
+
+        with patch.object(
+            OrderEmailResender, "run_cycle", side_effect=cycle
+        ), patch.object(
+            OrderEmailResender, "create_async_session", side_effect=create_session
+        ), self.assertLogs(level="INFO"):
+            OrderEmailResender.run_daemon(
+                poll_interval=0.01, jitter=0, stop_event=stop_event
+            )
+        self.assertGreaterEqual(server.request_counts["search_orders"], 3)
+        self.assertEqual(len(sessions), 1)
+        self.assertTrue(sessions[0].closed)
+        self.assertIsNone(OrderEmailResender._async_runner)
+
+    def test_receiver(self):
+        """Test order events are received over HTTP and the placed orders
+        are checked with one search once their delay has passed, unless
+        their email has been sent."""
+        self.configure(
+            receiver_token="secret",
+            receiver_check_delay_secs=60,
+            stores=(),
+            store="",
+        )
+        self.addCleanup(OrderEmailResender._order_checks.clear)
+        server = OrderEmailResender.start_receiver(port=0)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = f"http://127.0.0.1:{server.server_address[1]}/events/"
+        auth = {"Authorization": "Bearer secret"}
+
+        # Test events need the token, a known event and valid orders
+        response = requests.post(url + "order-placed", json={"entity_id": 1})
+        self.assertEqual(response.status_code, 401)
+        for event, body, status in [
+            ("order-placed", {"entity_id": 1}, 202),
+            ("order-placed", [{"entity_id": 2}, {"entity_id": "3"}], 202),
+            ("order-placed", {"increment_id": "600000004"}, 400),
+            ("order-placed", {"entity_id": 4, "store": "trade"}, 400),
+            ("order-cancelled", {"entity_id": 1}, 404),
+            ("email-sent", {"entity_id": 3}, 202),
+        ]:
+            response = requests.post(url + event, json=body, headers=auth)
+            self.assertEqual(response.status_code, status, body)
+        self.assertEqual(
+            sorted(OrderEmailResender._order_checks), [("", 1), ("", 2)]
+        )
+
+        # Test nothing is checked before the delay has passed
+        self.assertEqual(OrderEmailResender.run_due_order_checks(), 0)
+
+        # Test the due orders are fetched in one search and processed
+        items = [
+            {"entity_id": entity_id, "status": "processing", "email_sent": 0}
+            for entity_id in (1, 2)
+        ]
+        requests.Session.get = MagicMock(
+            return_value=MockResponse({"items": items, "total_count": 2}, 200)
+        )
+        later = time.monotonic() + 61
+        with patch.object(
+            OrderEmailResender, "process_orders"
+        ) as mock_process:
+            self.assertEqual(
+                OrderEmailResender.run_due_order_checks(now=later), 2
+            )
+        params = requests.Session.get.call_args.kwargs["params"]
+        self.assertEqual(
+            params["searchCriteria[filter_groups][0][filters][0][value]"], "1,2"
+        )
+        self.assertEqual(
+            params["searchCriteria[filter_groups][0][filters][0][condition_type]"],
+            "in",
+        )
+        (orders,) = mock_process.call_args.args
+        self.assertEqual([order.entity_id for order in orders], [1, 2])
+        self.assertEqual(OrderEmailResender._order_checks, {})
+
+        # Test orders are checked again later when Magento can't be reached
+        OrderEmailResender.receive_order_events(
+            "order_placed", {"entity_id": 5}
+        )
+        requests.Session.get = MagicMock(
+            side_effect=requests.exceptions.ConnectionError()
+        )
+        with self.assertLogs(OrderEmailResender.logger, "ERROR"):
+            OrderEmailResender.run_due_order_checks(now=later)
+        self.assertEqual(list(OrderEmailResender._order_checks), [("", 5)])
+
+    def test_incremental_polling(self):
+        """Test polling for orders updated since the watermark and only
+        moving the watermark on after a successful cycle."""
+        watermark_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(watermark_dir.cleanup)
+        config = self.configure(
+            incremental_polling=True,
+            order_page_size=None,
+            watermark_file=os.path.join(watermark_dir.name, "watermark.json"),
+            state_store_file=os.path.join(watermark_dir.name, "order_state.db"),
+        )
+        self.addCleanup(OrderEmailResender.close_state_store)
+        OrderEmailResender.close_state_store()
+        lookback = OrderEmailResender.WATERMARK_LOOKBACK_MINS
+
+        def process_all(orders):
+            list(orders)
+            return 0
+
+        def fail_all(orders):
+            return len(list(orders))
+
+        # Test the first cycle uses the created_at window
+        self.assertIsNone(OrderEmailResender.load_watermark())
+        params = OrderEmailResender._build_order_criteria()
+        self.assertEqual(
+            params["searchCriteria[filter_groups][0][filters][0][field]"],
+            "created_at",
+        )
+
+        # Test the watermark is saved from the newest order after a cycle
+        orders = [
+            {"entity_id": 3, "updated_at": "2024-05-01 10:00:00"},
+            {"entity_id": 1, "updated_at": "2024-05-01 10:30:00"},
+            {"entity_id": 2, "updated_at": "2024-05-01 10:30:00"},
+        ]
+        with patch.object(
+            OrderEmailResender, "fetch_unsent_orders", return_value=orders
+        ) as mock_fetch, patch.object(
+            OrderEmailResender,
+            "process_orders",
+            side_effect=process_all,
+        ):
+            OrderEmailResender.run_cycle()
+        mock_fetch.assert_called_once_with(watermark=None)
+        watermark = OrderEmailResender.load_watermark()
+        self.assertEqual(
+            watermark, {"updated_at": "2024-05-01 10:30:00", "entity_id": 2}
+        )
+
+        # Test the next cycle searches by updated_at less the lookback
+        params = OrderEmailResender._build_order_criteria(watermark=watermark)
+        self.assertEqual(
+            params["searchCriteria[filter_groups][0][filters][0][field]"],
+            "updated_at",
+        )
+        self.assertEqual(
+            params["searchCriteria[filter_groups][0][filters][0][value]"],
+            pendulum.parse("2024-05-01 10:30:00")
+            .subtract(minutes=lookback)
+            .to_datetime_string(),
+        )
+
+        # Test an order resent but never updated is searched for again by
+        # ID, until it is escalated, as a resend may not change 'updated_at'
+        pending = "searchCriteria[filter_groups][0][filters][1]"
+        self.assertNotIn(pending + "[field]", params)
+        self.assertNotIn(pending + "[field]", params)
+        stale_order = {
+            "entity_id": 7,
+            "increment_id": "600000007",
+            "updated_at": "2024-05-01 09:00:00",
+        }
+        for _ in range(2):
+            OrderEmailResender._record_order_outcome(
+                stale_order, "resent", resent=True
+            )
+            params = OrderEmailResender._build_order_criteria(
+                watermark=watermark
+            )
+            self.assertEqual(params[pending + "[field]"], "entity_id")
+            self.assertEqual(params[pending + "[value]"], "7")
+            self.assertEqual(params[pending + "[condition_type]"], "in")
+        OrderEmailResender._record_order_outcome(
+            stale_order, "escalated", escalated=True
+        )
+        params = OrderEmailResender._build_order_criteria(watermark=watermark)
+        self.assertNotIn(pending + "[field]", params)
+
+        # Test the pending orders can't be known without a state store
+        with self.assertRaisesRegex(
+            OrderEmailResender.ConfigError, "STATE_STORE_FILE"
+        ):
+            dataclasses.replace(config, state_store_file=None)
+
+        # Test the watermark isn't moved on when an order fails
+        newer_orders = [{"entity_id": 4, "updated_at": "2024-05-01 11:00:00"}]
+        with patch.object(
+            OrderEmailResender, "fetch_unsent_orders", return_value=newer_orders
+        ) as mock_fetch, patch.object(
+            OrderEmailResender,
+            "process_orders",
+            side_effect=fail_all,
+        ):
+            OrderEmailResender.run_cycle()
+        mock_fetch.assert_called_once_with(watermark=watermark)
+        self.assertEqual(OrderEmailResender.load_watermark(), watermark)
+
+    def test_state_store(self):
+        """Test recording resend attempts in the state store, and seeding it
+        from the order comments when the store is missing."""
+        PREFIX = OrderEmailResender.COMMENT_PREFIX
+        store_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(store_dir.cleanup)
+        self.configure(
+            state_store_file=os.path.join(store_dir.name, "order_state.db")
+        )
+        self.addCleanup(OrderEmailResender.close_state_store)
+        OrderEmailResender.close_state_store()
+        test_order_obj = {
+            "entity_id": random.randint(10_000, 99_999),
+            "increment_id": "60000" + str(random.randint(10_000, 99_999)),
+            "status": "processing",
+            "status_histories": [
+                {"comment": PREFIX + " Attempt #1"},
+                {"comment": PREFIX + " Attempt #2"},
+            ],
+        }
+
+        # Test a missing store is reconciled from the order comments
+        params = OrderEmailResender._build_order_criteria()
+        self.assertEqual(params["fields"], OrderEmailResender.WEB_ORDER_FIELDS)
+        attempts = OrderEmailResender._check_resend_attempts(test_order_obj)
+        self.assertEqual(attempts, 2)
+        self.assertEqual(
+            OrderEmailResender.get_stored_resend_attempts(
+                test_order_obj["entity_id"]
+            ),
+            2,
+        )
+
+        # Test resend attempts and escalations are recorded
+        OrderEmailResender._record_order_outcome(
+            test_order_obj, "resent", resent=True
+        )
+        OrderEmailResender._record_order_outcome(
+            test_order_obj, "escalated", escalated=True
+        )
+        row = (
+            OrderEmailResender.get_state_store()
+            .execute(
+                "SELECT resend_attempts, last_outcome, escalated_at"
+                " FROM orders WHERE entity_id = ?",
+                (test_order_obj["entity_id"],),
+            )
+            .fetchone()
+        )
+        self.assertEqual(row[0], 3)
+        self.assertEqual(row[1], "escalated")
+        self.assertIsNotNone(row[2])
+
+        # Test an existing store is used without fetching the comments
+        OrderEmailResender.close_state_store()
+        params = OrderEmailResender._build_order_criteria()
+        self.assertEqual(
+            params["fields"],
+            OrderEmailResender.WEB_ORDER_FIELDS_WITHOUT_HISTORIES,
+        )
+        del test_order_obj["status_histories"]
+        attempts = OrderEmailResender._check_resend_attempts(test_order_obj)
+        self.assertEqual(attempts, 3)
+
+        # Test an order the store hasn't seen has no attempts
+        new_order_obj = {"entity_id": test_order_obj["entity_id"] + 1}
+        attempts = OrderEmailResender._check_resend_attempts(new_order_obj)
+        self.assertEqual(attempts, 0)
+
+        # Test a store new to the state store is reconciled on its own
+        self.configure(store="trade")
+        self.assertTrue(OrderEmailResender._needs_status_histories())
+        self.assertIsNone(
+            OrderEmailResender.get_stored_resend_attempts(
+                test_order_obj["entity_id"]
+            )
+        )
+
+    def test_full_order_cache(self):
+        """Test full orders are cached by entity ID and last update, expire
+        after the TTL, are evicted when the cache is full and persist between
+        runs."""
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self.addCleanup(OrderEmailResender.clear_order_cache)
+        self.configure(
+            order_cache_size=2,
+            order_cache_ttl_secs=60,
+            order_cache_file=os.path.join(cache_dir.name, "cache.json"),
+        )
+        OrderEmailResender.clear_order_cache()
+        orders = [
+            {"entity_id": entity_id, "updated_at": "2024-05-01 10:00:00"}
+            for entity_id in range(1, 4)
+        ]
+        keys = [OrderEmailResender._order_cache_key(o) for o in orders]
+
+        # Test a cached order is returned until its order is updated
+        OrderEmailResender._cache_full_order(keys[0], {"entity_id": 1})
+        self.assertEqual(
+            OrderEmailResender._get_cached_full_order(keys[0]), {"entity_id": 1}
+        )
+        updated_order = dict(orders[0], updated_at="2024-05-01 11:00:00")
+        self.assertIsNone(
+            OrderEmailResender._get_cached_full_order(
+                OrderEmailResender._order_cache_key(updated_order)
+            )
+        )
+
+        # Test the least recently used order is evicted
+        OrderEmailResender._cache_full_order(keys[1], {"entity_id": 2})
+        OrderEmailResender._get_cached_full_order(keys[0])
+        OrderEmailResender._cache_full_order(keys[2], {"entity_id": 3})
+        self.assertIsNone(OrderEmailResender._get_cached_full_order(keys[1]))
+        self.assertIsNotNone(OrderEmailResender._get_cached_full_order(keys[0]))
+
+        # Test the cache persists between runs
+        OrderEmailResender.save_order_cache()
+        OrderEmailResender.clear_order_cache()
+        self.assertEqual(
+            OrderEmailResender._get_cached_full_order(keys[2]), {"entity_id": 3}
+        )
+
+        # Test cached orders expire
+        self.configure(order_cache_ttl_secs=-1)
+        self.assertIsNone(OrderEmailResender._get_cached_full_order(keys[2]))
+
+    def test_sales_order_fields_projection(self):
+        """Test the 'fields' projection for escalation emails requests every
+        field in the sales payload field map and nothing else."""
+
+        def parse_projection(projection):
+            tree = {}
+            stack = [tree]
+            key = ""
+            for char in projection + ",":
+                if char in ",[]" and key:
+                    stack[-1][key] = {}
+                    last_key, key = key, ""
+                else:
+                    key += char if char not in ",[]" else ""
+                if char == "[":
+                    stack.append(stack[-1][last_key])
+                elif char == "]":
+                    stack.pop()
+            return tree
+
+        def apply_projection(value, tree):
+            # Magento applies a projection to each element of a list.
+            if isinstance(value, list):
+                return [apply_projection(v, tree) for v in value]
+            if not tree or not isinstance(value, dict):
+                return value
+            return {
+                k: apply_projection(value[k], tree[k])
+                for k in tree
+                if k in value
+            }
+
+        comment_field = os.getenv("WEB_ORDER_COMMENT_FIELD")
+        full_order = {
+            "customer_name": fake.company(),
+            "increment_id": "60000" + str(random.randint(10_000, 99_999)),
+            "billing_address": {"city": fake.city()},
+            "payment": {"method": "Card", "additional_information": ["x"]},
+            "items": [
+                {"sku": "A", "name": "A fake item", "product_type": "simple"}
+            ],
+            "extension_attributes": {
+                "shipping_assignments": [
+                    {
+                        "items": [{"sku": "A"}],
+                        "shipping": {
+                            "address": {"city": fake.city()},
+                            "method": "Standard shipping",
+                            "total": {"shipping_amount": 9.99},
+                        },
+                    }
+                ],
+                "payment_additional_info": [{"key": "x"}],
+            },
+            "subtotal": 10.0,
+            "grand_total": 19.99,
+            "status_histories": [{"comment": "Not needed by sales"}],
+            comment_field: "Please knock on the red door.",
+        }
+
+        # Test the projected order builds the same payload as the full order
+        projection = OrderEmailResender._build_fields_projection(
+            OrderEmailResender.SALES_PAYLOAD_FIELDS
+        )
+        projected_order = apply_projection(
+            full_order, parse_projection(projection)
+        )
+        self.assertEqual(
+            OrderEmailResender._build_sales_payload(projected_order),
+            OrderEmailResender._build_sales_payload(full_order),
+        )
+        self.assertNotIn("status_histories", projected_order)
+        self.assertNotIn(
+            "payment_additional_info", projected_order["extension_attributes"]
+        )
+
+        # Test the sales item fields narrow the items
+        projection = OrderEmailResender._build_fields_projection(
+            OrderEmailResender.SALES_PAYLOAD_FIELDS, ["sku", "name"]
+        )
+        projected_order = apply_projection(
+            full_order, parse_projection(projection)
+        )
+        self.assertEqual(
+            projected_order["items"], [{"sku": "A", "name": "A fake item"}]
+        )
+
+    def test_batched_escalations(self):
+        """Test escalated orders are sent to admin and sales in batches, with
+        a fallback to one request per order for receivers that reject
+        batches."""
+        ALERT_WEBHOOK_URL = os.getenv("ALERT_WEBHOOK_URL")
+        EMAIL_WEBHOOK_URL = os.getenv("EMAIL_WEBHOOK_URL")
+        self.configure(
+            webhook_batching=True,
+            webhook_batch_size=3,
+            webhook_batch_max_secs=60,
+        )
+        orders = [
+            {
+                "entity_id": entity_id,
+                "increment_id": "60000" + str(entity_id),
+                "status": "processing",
+            }
+            for entity_id in range(10_000, 10_004)
+        ]
+
+        def sales_payload(order):
+            return {"increment_id": order["increment_id"]}
+
+        # Test escalations are sent when the batch is full and at the end,
+        # and each order's outcome is only logged once its batch is sent
+        requests.Session.post = Mock(
+            return_value=MockResponse({"message": "success"}, 200)
+        )
+        with patch.object(
+            OrderEmailResender, "_check_resend_attempts", return_value=99
+        ), patch.object(
+            OrderEmailResender,
+            "_fetch_sales_payload",
+            side_effect=sales_payload,
+        ), self.assertLogs(level="INFO") as logs:
+            self.assertEqual(
+                OrderEmailResender.process_orders(orders, max_workers=1), 0
+            )
+        sent_batches = [
+            index
+            for index, line in enumerate(logs.output)
+            if "Sent a batch" in line
+        ]
+        self.assertEqual(len(sent_batches), 2)
+        for order in orders:
+            outcome = next(
+                index
+                for index, line in enumerate(logs.output)
+                if order["increment_id"] + " exceeded resend attempts" in line
+            )
+            self.assertGreater(
+                outcome, sent_batches[0 if order in orders[:3] else 1]
+            )
+        calls = requests.Session.post.call_args_list
+        self.assertEqual(
+            [call.args[0] for call in calls],
+            [ALERT_WEBHOOK_URL, EMAIL_WEBHOOK_URL] * 2,
+        )
+        digest = calls[0].kwargs["json"]
+        self.assertEqual(
+            [o["entity_id"] for o in digest["orders"]],
+            [o["entity_id"] for o in orders[:3]],
+        )
+        self.assertEqual(
+            calls[1].kwargs["json"],
+            {"orders": [sales_payload(o) for o in orders[:3]]},
+        )
+        self.assertEqual(
+            calls[3].kwargs["json"], {"orders": [sales_payload(orders[3])]}
+        )
+
+        # Test a receiver which rejects batches is sent each order instead
+        requests.Session.post = Mock(
+            side_effect=lambda url, json, timeout: MockResponse(
+                {}, 400 if "orders" in json else 200
+            )
+        )
+        with patch.object(
+            OrderEmailResender,
+            "_fetch_sales_payload",
+            side_effect=sales_payload,
+        ):
+            for order in orders[:2]:
+                OrderEmailResender._queue_escalation(order)
+            self.assertEqual(OrderEmailResender.flush_escalations(), 2)
+        posted = [
+            (call.args[0], call.kwargs["json"])
+            for call in requests.Session.post.call_args_list
+        ]
+        for order in orders[:2]:
+            self.assertIn(
+                (
+                    ALERT_WEBHOOK_URL,
+                    OrderEmailResender._build_alert_payload(order),
+                ),
+                posted,
+            )
+            self.assertIn((EMAIL_WEBHOOK_URL, sales_payload(order)), posted)
+
+        # Test a server error from the receiver fails every order in the
+        # batch, including a batch filled while processing, without
+        # recording them as escalated
+        requests.Session.post = Mock(return_value=MockResponse({}, 500))
+        with patch.object(
+            OrderEmailResender, "_check_resend_attempts", return_value=99
+        ), patch.object(
+            OrderEmailResender,
+            "_fetch_sales_payload",
+            side_effect=sales_payload,
+        ), patch.object(
+            OrderEmailResender, "_record_order_outcome"
+        ) as record_outcome, self.assertLogs(level="INFO") as logs:
+            self.assertEqual(
+                OrderEmailResender.process_orders(orders, max_workers=1),
+                len(orders),
+            )
+        record_outcome.assert_not_called()
+        self.assertEqual(
+            len([line for line in logs.output if "could not be processed" in line]),
+            len(orders),
+        )
+
+    def test_magento_request_resilience(self):
+        """Test Magento requests are retried on throttling, server errors and
+        connection failures, unless a repeated resend could email twice, rate
+        limited, and stopped by the circuit breaker after repeated
+        failures."""
+        url = "https://my-api-domain.co.uk/rest/default/V1/orders"
+        self.configure(
+            magento_max_retries=2,
+            magento_circuit_threshold=4,
+            magento_circuit_reset_secs=60,
+            magento_rate_limit=0,
+        )
+
+        # Test throttling and connection failures are retried until success
+        requests.Session.get = Mock(
+            side_effect=[
+                MockResponse({}, 429),
+                requests.exceptions.ConnectionError(),
+                MockResponse({"total_count": 0}, 200),
+            ]
+        )
+        response = OrderEmailResender._magento_request("get", url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(requests.Session.get.call_count, 3)
+
+        # Test client errors aren't retried
+        requests.Session.get = Mock(return_value=MockResponse({}, 404))
+        response = OrderEmailResender._magento_request("get", url)
+        self.assertEqual(response.status_code, 404)
+        requests.Session.get.assert_called_once()
+
+        # Test a resend which may have reached Magento isn't repeated, as it
+        # could email the customer twice, unless it never got there
+        for failure in [
+            requests.exceptions.ReadTimeout(),
+            requests.exceptions.ConnectionError(
+                urllib3.exceptions.ProtocolError("Connection aborted.")
+            ),
+            MockResponse({}, 502),
+            MockResponse({}, 503),
+        ]:
+            OrderEmailResender.reset_magento_circuit()
+            requests.Session.post = Mock(
+                side_effect=[failure, MockResponse("true", 200)]
+            )
+            if isinstance(failure, Exception):
+                with self.assertRaises(type(failure)):
+                    OrderEmailResender._magento_request("post", url)
+            else:
+                response = OrderEmailResender._magento_request("post", url)
+                self.assertEqual(response.status_code, failure.status_code)
+            requests.Session.post.assert_called_once()
+        unavailable = MockResponse({}, 503)
+        unavailable.headers = {"Retry-After": "0"}
+        for failure in [
+            requests.exceptions.ConnectTimeout(),
+            requests.exceptions.ConnectionError(
+                urllib3.exceptions.MaxRetryError(
+                    None,
+                    url,
+                    urllib3.exceptions.NewConnectionError(
+                        None, "Connection refused"
+                    ),
+                )
+            ),
+            MockResponse({}, 429),
+            unavailable,
+        ]:
+            OrderEmailResender.reset_magento_circuit()
+            requests.Session.post = Mock(
+                side_effect=[failure, MockResponse("true", 200)]
+            )
+            response = OrderEmailResender._magento_request("post", url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(requests.Session.post.call_count, 2)
+        requests.Session.get = Mock(
+            side_effect=[
+                requests.exceptions.ReadTimeout(),
+                MockResponse({}, 502),
+                MockResponse({}, 200),
+            ]
+        )
+        response = OrderEmailResender._magento_request("get", url)
+        self.assertEqual(response.status_code, 200)
+        OrderEmailResender.reset_magento_circuit()
+
+        # Test the circuit breaker opens after repeated failures
+        requests.Session.get = Mock(return_value=MockResponse({}, 503))
+        response = OrderEmailResender._magento_request("get", url)
+        self.assertEqual(response.status_code, 503)
+        with self.assertRaises(OrderEmailResender.MagentoUnavailable):
+            OrderEmailResender._magento_request("get", url)
+        self.assertEqual(requests.Session.get.call_count, 4)
+
+        # Test the circuit breaker lets requests through after the reset time
+        self.configure(magento_circuit_reset_secs=0)
+        requests.Session.get = Mock(return_value=MockResponse({}, 200))
+        OrderEmailResender._magento_request("get", url)
+        self.configure(magento_circuit_reset_secs=60)
+        OrderEmailResender._magento_request("get", url)
+        self.assertEqual(requests.Session.get.call_count, 2)
+
+        # Test requests are rate limited once the burst is used up
+        self.configure(magento_rate_limit=50)
+        OrderEmailResender.reset_magento_circuit()
+        burst = int(OrderEmailResender.MAGENTO_RATE_BURST)
+        started = time.monotonic()
+        for _ in range(burst + 5):
+            OrderEmailResender._magento_request("get", url)
+        self.assertGreaterEqual(time.monotonic() - started, 4 / 50)
+
+    def test_outbox(self):
+        """Test actions in the outbox are only carried out once, and that
+        actions intended before a crash are replayed on startup."""
+        outbox_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(outbox_dir.cleanup)
+        self.configure(
+            outbox_file=os.path.join(outbox_dir.name, "outbox.jsonl")
+        )
+        self.addCleanup(OrderEmailResender.close_outbox)
+        OrderEmailResender.close_outbox()
+        order = {
+            "entity_id": random.randint(10_000, 99_999),
+            "increment_id": "60000" + str(random.randint(10_000, 99_999)),
+            "status": "processing",
+            "status_histories": [],
+        }
+
+        # Test a done action isn't repeated and its result is remembered
+        with patch.object(
+            OrderEmailResender, "_resend_order_with_magento", return_value=True
+        ) as mock_resend:
+            for _ in range(2):
+                sent = OrderEmailResender._run_outbox_action("resend", order, 1)
+                self.assertTrue(sent)
+            mock_resend.assert_called_once_with(order)
+            OrderEmailResender._run_outbox_action("resend", order, 2)
+            self.assertEqual(mock_resend.call_count, 2)
+
+        # Test an action which was intended when the process died is replayed
+        key = OrderEmailResender._outbox_key("email_sales", order)
+        OrderEmailResender._write_outbox_record(
+            key, "email_sales", order, "intended"
+        )
+        OrderEmailResender.close_outbox()
+        with open(OrderEmailResender.OUTBOX_FILE, "a") as outbox:
+            outbox.write('{"key": "partly written')
+        with patch.object(
+            OrderEmailResender, "_email_order_to_sales", return_value=None
+        ) as mock_email:
+            self.assertEqual(OrderEmailResender.replay_outbox(), 1)
+            self.assertEqual(OrderEmailResender.replay_outbox(), 0)
+        mock_email.assert_called_once_with(
+            {
+                "entity_id": order["entity_id"],
+                "increment_id": order["increment_id"],
+            }
+        )
+
+        # Test a resend intended when the process died is only replayed for
+        # an order Magento still shows as unsent, and its outcome recorded
+        sent_order = dict(order, entity_id=order["entity_id"] + 1)
+        for resend_order in (order, sent_order):
+            OrderEmailResender._write_outbox_record(
+                OrderEmailResender._outbox_key("resend", resend_order, 3),
+                "resend",
+                resend_order,
+                "intended",
+            )
+        OrderEmailResender.close_outbox()
+        magento_orders = [
+            dict(order, email_sent=0),
+            dict(sent_order, email_sent=1),
+        ]
+        with patch.object(
+            OrderEmailResender, "fetch_orders_by_id", return_value=magento_orders
+        ) as mock_fetch, patch.object(
+            OrderEmailResender, "_resend_order_with_magento", return_value=True
+        ) as mock_resend, patch.object(
+            OrderEmailResender, "_record_order_outcome"
+        ) as mock_record, self.assertLogs(level="INFO") as logs:
+            self.assertEqual(OrderEmailResender.replay_outbox(), 1)
+        mock_fetch.assert_called_once_with(
+            [order["entity_id"], sent_order["entity_id"]]
+        )
+        mock_resend.assert_called_once_with(
+            {
+                "entity_id": order["entity_id"],
+                "increment_id": order["increment_id"],
+            }
+        )
+        mock_record.assert_called_once()
+        self.assertEqual(mock_record.call_args.args[1], "resent")
+        self.assertTrue(
+            any("This is attempt number 3" in line for line in logs.output)
+        )
+        self.assertTrue(
+            OrderEmailResender._outbox_is_done(
+                OrderEmailResender._outbox_key("resend", sent_order, 3)
+            )
+        )
+
+        # Test resends are left for the next poll if Magento can't be asked
+        OrderEmailResender._write_outbox_record(
+            OrderEmailResender._outbox_key("resend", order, 4),
+            "resend",
+            order,
+            "intended",
+        )
+        OrderEmailResender.close_outbox()
+        with patch.object(
+            OrderEmailResender,
+            "fetch_orders_by_id",
+            side_effect=requests.ConnectionError(),
+        ), patch.object(
+            OrderEmailResender, "_resend_order_with_magento"
+        ) as mock_resend, self.assertLogs(level="ERROR"):
+            self.assertEqual(OrderEmailResender.replay_outbox(), 0)
+        mock_resend.assert_not_called()
+
+        # Test the outbox survives a restart
+        OrderEmailResender.close_outbox()
+        self.assertTrue(OrderEmailResender._outbox_is_done(key))
+        with patch.object(
+            OrderEmailResender, "_alert_admin", return_value=None
+        ) as mock_alert, patch.object(
+            OrderEmailResender, "_email_order_to_sales", return_value=None
+        ) as mock_email, patch.object(
+            OrderEmailResender, "_check_resend_attempts", return_value=99
+        ):
+            OrderEmailResender.process_orders([order], max_workers=1)
+        mock_alert.assert_called_once_with(order)
+        mock_email.assert_not_called()
+
+        # Test intended actions expire with the retention period
+        self.assertNotEqual(OrderEmailResender._outbox_pending, {})
+        OrderEmailResender.close_outbox()
+        with patch.object(
+            OrderEmailResender.time,
+            "time",
+            return_value=time.time()
+            + OrderEmailResender.OUTBOX_RETENTION_DAYS * 24 * 60 * 60
+            + 1,
+        ):
+            OrderEmailResender._open_outbox()
+        self.assertEqual(OrderEmailResender._outbox_pending, {})
+
+    def test_shared_handles(self):
+        """Test the handles shared by the whole process can't be used by a
+        config with different settings until they are closed."""
+        handle_dir = self.enterContext(tempfile.TemporaryDirectory())
+        handles = {
+            "state_store_file": (
+                OrderEmailResender.get_state_store,
+                OrderEmailResender.close_state_store,
+            ),
+            "outbox_file": (
+                OrderEmailResender._open_outbox,
+                OrderEmailResender.close_outbox,
+            ),
+            "lease_file": (
+                OrderEmailResender.get_lease_backend,
+                OrderEmailResender.release_shards,
+            ),
+            "order_cache_file": (
+                lambda: OrderEmailResender._cache_full_order("key", {}),
+                OrderEmailResender.clear_order_cache,
+            ),
+        }
+        for setting, (open_handle, close_handle) in handles.items():
+            with self.subTest(setting):
+                self.addCleanup(close_handle)
+                close_handle()
+                first = self.configure(
+                    order_cache_size=8,
+                    **{setting: os.path.join(handle_dir, setting + ".first")},
+                )
+                second = dataclasses.replace(
+                    first,
+                    **{setting: os.path.join(handle_dir, setting + ".second")},
+                )
+                open_handle()
+                open_handle()
+                with OrderEmailResender.use_config(second):
+                    with self.assertRaisesRegex(
+                        OrderEmailResender.ConfigError, setting.upper()
+                    ):
+                        open_handle()
+                    # Test the handle can be reopened once it is closed
+                    close_handle()
+                    open_handle()
+                close_handle()
+
+    def test_metrics(self):
+        """Test orders and phase latencies are counted, and the metrics are
+        rendered for Prometheus over HTTP and to a textfile."""
+        prefix = OrderEmailResender.METRICS_PREFIX
+
+        def metric(name, **labels):
+            labels = ",".join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+            line_start = prefix + name + ("{" + labels + "}" if labels else "")
+            for line in OrderEmailResender.render_metrics().splitlines():
+                if line.startswith(line_start + " "):
+                    return float(line.split(" ")[1])
+            return 0.0
+
+        orders = [
+            {"entity_id": 1, "increment_id": "1", "status": "processing"},
+            {"entity_id": 2, "increment_id": "2", "status": "canceled"},
+            {
+                "entity_id": 3,
+                "increment_id": "3",
+                "status": "processing",
+                "email_sent": 1,
+            },
+        ]
+        before = {
+            "processed": metric("orders_processed"),
+            "resent": metric("orders_resent"),
+            "skipped": metric("orders_skipped", reason="status"),
+            "resends": metric(
+                "phase_seconds_count", phase="resend_order_with_magento"
+            ),
+        }
+        requests.Session.post = Mock(return_value=MockResponse("true", 200))
+        OrderEmailResender.process_orders(orders, max_workers=1)
+        self.assertEqual(metric("orders_processed"), before["processed"] + 1)
+        self.assertEqual(metric("orders_resent"), before["resent"] + 1)
+        self.assertEqual(
+            metric("orders_skipped", reason="status"), before["skipped"] + 1
+        )
+        self.assertEqual(
+            metric("phase_seconds_count", phase="resend_order_with_magento"),
+            before["resends"] + 1,
+        )
+        self.assertIn(
+            f"# TYPE {prefix}phase_seconds histogram",
+            OrderEmailResender.render_metrics(),
+        )
+
+        # Test escalation phases are timed too
+        alerts = metric("phase_seconds_count", phase="alert_admin")
+        requests.Session.post = Mock(
+            return_value=MockResponse({"message": "success"}, 200)
+        )
+        OrderEmailResender._alert_admin(orders[0])
+        self.assertEqual(
+            metric("phase_seconds_count", phase="alert_admin"), alerts + 1
+        )
+
+        # Test the metrics are served over HTTP
+        server = OrderEmailResender.start_metrics_server(port=0)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        response = requests.request(
+            "GET", f"http://127.0.0.1:{server.server_address[1]}/metrics"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(prefix + "orders_resent", response.text)
+
+        # Test the metrics are written to a textfile
+        metrics_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(metrics_dir.cleanup)
+        self.configure(
+            metrics_textfile=os.path.join(
+                metrics_dir.name, "order_email_resender.prom"
+            )
+        )
+        OrderEmailResender.write_metrics_textfile()
+        with open(OrderEmailResender.METRICS_TEXTFILE) as metrics_file:
+            self.assertIn(prefix + "orders_resent", metrics_file.read())
+
+    def test_config(self):
+        """Test the config is read and validated from the environment once,
+        and that another config can be passed in to be used instead."""
+        environ = {
+            "MAX_EMAIL_ATTEMPTS": "3",
+            "COMMENT_PREFIX": "Order email resend attempted.",
+            "WEB_DOMAIN": "https://other-api-domain.co.uk",
+            "WEB_ORDERS_API_ENDPOINT": "/rest/default/V1/orders",
+            "WEB_ORDER_API_ENDPOINT": "/rest/default/V1/orders/",
+            "ALERT_WEBHOOK_URL": "https://ingesting-webhook-host.ffd/alert",
+            "EMAIL_WEBHOOK_URL": "https://ingesting-webhook-host.ffd/email",
+            "WEB_ORDER_COMMENT_FIELD": "order_comment",
+            "WEB_AUTH_HEADER_VALUE": "Bearer other",
+            "ORDER_PAGE_SIZE": "0",
+            "SERVER_SIDE_FILTER": "true",
+            "HTTP_READ_TIMEOUT": "10",
+            "SALES_ITEM_FIELDS": "sku,name",
+        }
+
+        # Test the settings are parsed, with defaults for those left unset
+        config = OrderEmailResender.Config.from_env(environ)
+        self.assertEqual(config.max_email_attempts, 3)
+        self.assertTrue(config.server_side_filter)
+        self.assertIsNone(config.order_page_size)
+        self.assertEqual(config.http_timeout, (5.0, 10.0))
+        self.assertEqual(config.sales_item_fields, ("sku", "name"))
+        self.assertEqual(config.web_headers, {"Authorization": "Bearer other"})
+        self.assertEqual(config.order_cache_size, 256)
+
+        # Test missing and invalid settings are reported by name
+        for name, value in [
+            ("MAX_EMAIL_ATTEMPTS", ""),
+            ("MAX_EMAIL_ATTEMPTS", "three"),
+            ("MAX_EMAIL_ATTEMPTS", "0"),
+            ("SERVER_SIDE_FILTER", "yes"),
+            ("HTTP_CONNECT_TIMEOUT", "soon"),
+            ("ENGINE", "fibres"),
+            ("LOG_LEVEL", "LOUD"),
+            ("LOG_ORDERS", "some"),
+            ("LOG_ROTATE_WHEN", "fortnightly"),
+        ]:
+            with self.assertRaisesRegex(OrderEmailResender.ConfigError, name):
+                OrderEmailResender.Config.from_env(dict(environ, **{name: value}))
+
+        # Test the config passed in is used and read as the module settings
+        requests.Session.get = MagicMock(
+            return_value=MockResponse({"items": [{}], "total_count": 1}, 200)
+        )
+        OrderEmailResender.fetch_unsent_orders(config=config)
+        self.assertTrue(
+            requests.Session.get.call_args.args[0].startswith(config.web_domain)
+        )
+        self.assertNotEqual(OrderEmailResender.WEB_DOMAIN, config.web_domain)
+        with OrderEmailResender.use_config(config):
+            self.assertEqual(OrderEmailResender.WEB_DOMAIN, config.web_domain)
+
+    def test_multiple_stores(self):
+        """Test each store's settings override the shared ones, and that
+        every store is polled in a cycle even when one of them fails."""
+        environ = {
+            "STORE_TRADE_WEB_DOMAIN": "https://trade-api-domain.co.uk",
+            "STORE_TRADE_WEB_AUTH_HEADER_VALUE": "Bearer trade",
+            "STORE_TRADE_MAX_EMAIL_ATTEMPTS": "5",
+        }
+        watermark_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(watermark_dir.cleanup)
+        config = self.configure(
+            stores=("retail", "trade"),
+            incremental_polling=False,
+            order_page_size=None,
+            watermark_file=os.path.join(watermark_dir.name, "watermark.json"),
+        )
+
+        # Test a store's settings are overridden and its headers merged
+        trade = config.for_store("trade", environ)
+        self.assertEqual(trade.store, "trade")
+        self.assertEqual(trade.stores, ())
+        self.assertEqual(trade.web_domain, "https://trade-api-domain.co.uk")
+        self.assertEqual(trade.max_email_attempts, 5)
+        self.assertEqual(trade.web_headers["Authorization"], "Bearer trade")
+        self.assertEqual(
+            len(trade.web_headers), len(config.web_headers | {"Authorization": 1})
+        )
+        self.assertEqual(
+            trade.watermark_file,
+            os.path.join(watermark_dir.name, "watermark.trade.json"),
+        )
+        retail = config.for_store("retail", environ)
+        self.assertEqual(retail.web_domain, config.web_domain)
+
+        # Test settings shared by the whole process can't be set per store
+        with self.assertRaisesRegex(
+            OrderEmailResender.ConfigError, "STORE_TRADE_OUTBOX_FILE"
+        ):
+            config.for_store("trade", {"STORE_TRADE_OUTBOX_FILE": "x.jsonl"})
+
+        # Test every store is polled with its own config and a failing store
+        # doesn't stop the others
+        polled = []
+
+        def fetch(watermark=None):
+            store = OrderEmailResender.get_config().store
+            polled.append(store)
+            if store == "retail":
+                raise requests.ConnectionError("retail is down")
+            return [{"entity_id": 1}]
+
+        with patch.object(
+            OrderEmailResender, "fetch_unsent_orders", side_effect=fetch
+        ), patch.object(
+            OrderEmailResender, "process_orders", return_value=0
+        ) as mock_process, self.assertLogs(level="ERROR") as logs:
+            OrderEmailResender.run_cycle()
+        self.assertEqual(sorted(polled), ["retail", "trade"])
+        mock_process.assert_called_once_with([{"entity_id": 1}])
+        self.assertIn("retail is down", logs.output[0])
+
+        # Test orders are keyed per store in the outbox and order cache
+        order = {"entity_id": 1, "updated_at": "2024-05-01 10:00:00"}
+        with OrderEmailResender.use_config(trade):
+            self.assertTrue(
+                OrderEmailResender._outbox_key("escalate", order).startswith(
+                    "trade:"
+                )
+            )
+            self.assertTrue(
+                OrderEmailResender._order_cache_key(order).startswith("trade:")
+            )
+
+    @unittest.skipIf(
+        OrderEmailResender.aiohttp is None, "the async engine needs aiohttp"
+    )
+    def test_async_engine(self):
+        """Test the async engine resends and escalates the same orders as the
+        threaded one, with every page fetched and each store polled."""
+        for page_size in (None, 7):
+            server = self.enterContext(
+                MockMagentoServer(
+                    order_count=60,
+                    escalate_ratio=0.5,
+                    comment_prefix=OrderEmailResender.COMMENT_PREFIX,
+                    max_email_attempts=OrderEmailResender.MAX_EMAIL_ATTEMPTS,
+                )
+            )
+            unsent = [
+                order
+                for order in server.orders
+                if not order.get("email_sent")
+                and order["status"]
+                not in OrderEmailResender.SKIPPED_ORDER_STATUSES
+            ]
+            escalated = [
+                order
+                for order in unsent
+                if OrderEmailResender._count_comment_attempts(order)
+                >= OrderEmailResender.MAX_EMAIL_ATTEMPTS
+            ]
+            self.configure(
+                engine="async",
+                max_concurrency=8,
+                magento_rate_limit=0,
+                order_page_size=page_size,
+                state_store_file=None,
+                outbox_file=None,
+                order_cache_size=0,
+                incremental_polling=False,
+                server_side_filter=False,
+                web_domain=server.url,
+                web_orders_api_endpoint=ORDERS_PATH,
+                web_order_api_endpoint=ORDERS_PATH + "/",
+                alert_webhook_url=server.url + ALERT_PATH,
+                email_webhook_url=server.url + EMAIL_PATH,
+            )
+            with self.assertLogs(level="INFO") as logs:
+                OrderEmailResender.run_cycle()
+            self.assertEqual(
+                server.request_counts["search_orders"],
+                1 if page_size is None else -(-60 // page_size),
+            )
+            self.assertEqual(
+                server.request_counts["resend_email"],
+                len(unsent) - len(escalated),
+            )
+            self.assertEqual(server.request_counts["get_order"], len(escalated))
+            self.assertEqual(
+                server.request_counts["alert_webhook"], len(escalated)
+            )
+            self.assertEqual(
+                server.request_counts["email_webhook"], len(escalated)
+            )
+            outcomes = [line for line in logs.output if "Order 6" in line]
+            self.assertEqual(len(outcomes), len(unsent))
+
+        # Test a failing store doesn't stop the others
+        config = self.configure(stores=("retail", "trade"))
+        environ = {"STORE_RETAIL_WEB_DOMAIN": "http://127.0.0.1:9"}
+        with patch.dict(os.environ, environ), self.assertLogs(
+            level="ERROR"
+        ) as logs:
+            OrderEmailResender.run_cycle(config=config)
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn("Store cycle failed", logs.output[0])
+
+    @unittest.skipIf(
+        OrderEmailResender.aiohttp is None, "the async engine needs aiohttp"
+    )
+    def test_async_engine_blocking_calls(self):
+        """Test the async engine leases orders and uses the state store,
+        outbox and order cache from other threads, so they don't block the
+        event loop."""
+        server = self.enterContext(
+            MockMagentoServer(
+                order_count=20,
+                escalate_ratio=0.5,
+                comment_prefix=OrderEmailResender.COMMENT_PREFIX,
+                max_email_attempts=OrderEmailResender.MAX_EMAIL_ATTEMPTS,
+            )
+        )
+        handle_dir = self.enterContext(tempfile.TemporaryDirectory())
+        self.send_real_requests()
+        self.configure(
+            engine="async",
+            magento_rate_limit=0,
+            shard_count=2,
+            state_store_file=os.path.join(handle_dir, "order_state.db"),
+            outbox_file=os.path.join(handle_dir, "outbox.jsonl"),
+            order_cache_size=8,
+            order_cache_file=os.path.join(handle_dir, "order_cache.json"),
+            web_domain=server.url,
+            web_orders_api_endpoint=ORDERS_PATH,
+            web_order_api_endpoint=ORDERS_PATH + "/",
+            alert_webhook_url=server.url + ALERT_PATH,
+            email_webhook_url=server.url + EMAIL_PATH,
+        )
+        for close in (
+            OrderEmailResender.close_state_store,
+            OrderEmailResender.close_outbox,
+            OrderEmailResender.clear_order_cache,
+        ):
+            self.addCleanup(close)
+            close()
+        threads = {}
+
+        def called_from_thread(name, function):
+            def record_thread(*args, **kwargs):
+                threads.setdefault(name, set()).add(threading.get_ident())
+                return function(*args, **kwargs)
+
+            return record_thread
+
+        for name, function in (
+            ("_lease_order", lambda order: True),
+            ("_check_resend_attempts", OrderEmailResender._check_resend_attempts),
+            ("_record_order_outcome", OrderEmailResender._record_order_outcome),
+            ("_write_outbox_record", OrderEmailResender._write_outbox_record),
+            ("_get_cached_full_order", OrderEmailResender._get_cached_full_order),
+            ("_cache_full_order", OrderEmailResender._cache_full_order),
+        ):
+            self.enterContext(
+                patch.object(
+                    OrderEmailResender,
+                    name,
+                    side_effect=called_from_thread(name, function),
+                )
+            )
+
+        async def process_orders():
+            async with OrderEmailResender.create_async_session() as session:
+                return await OrderEmailResender.process_orders_async(
+                    session, server.orders
+                )
+
+        with self.assertLogs(level="INFO"):
+            self.assertEqual(asyncio.run(process_orders()), 0)
+        self.assertGreater(server.request_counts["resend_email"], 0)
+        self.assertGreater(server.request_counts["alert_webhook"], 0)
+        self.assertEqual(
+            sorted(threads),
+            [
+                "_cache_full_order",
+                "_check_resend_attempts",
+                "_get_cached_full_order",
+                "_lease_order",
+                "_record_order_outcome",
+                "_write_outbox_record",
+            ],
+        )
+        for name, idents in threads.items():
+            self.assertNotIn(threading.get_ident(), idents, name)
+
+    def test_server_side_filter_paging(self):
+        """Test paging through server-side filtered orders reaches every
+        unsent order, though each resend drops an order out of the filter."""
+        self.send_real_requests()
+        engines = ["threads"] + (["async"] if OrderEmailResender.aiohttp else [])
+        for engine in engines:
+            server = self.enterContext(
+                MockMagentoServer(
+                    order_count=60,
+                    escalate_ratio=0,
+                    comment_prefix=OrderEmailResender.COMMENT_PREFIX,
+                    max_email_attempts=OrderEmailResender.MAX_EMAIL_ATTEMPTS,
+                )
+            )
+            unsent = [
+                order
+                for order in server.orders
+                if not order.get("email_sent")
+                and order["status"]
+                not in OrderEmailResender.SKIPPED_ORDER_STATUSES
+            ]
+            self.configure(
+                engine=engine,
+                max_concurrency=8,
+                magento_rate_limit=0,
+                order_page_size=4,
+                state_store_file=None,
+                outbox_file=None,
+                order_cache_size=0,
+                incremental_polling=False,
+                server_side_filter=True,
+                web_domain=server.url,
+                web_orders_api_endpoint=ORDERS_PATH,
+                web_order_api_endpoint=ORDERS_PATH + "/",
+                alert_webhook_url=server.url + ALERT_PATH,
+                email_webhook_url=server.url + EMAIL_PATH,
+            )
+            with self.assertLogs(level="INFO"):
+                OrderEmailResender.run_cycle()
+            self.assertEqual(server.request_counts["resend_email"], len(unsent))
+            self.assertTrue(all(order["email_sent"] for order in unsent))
+
+    def test_bulk_resend(self):
+        """Test the resends of a cycle are submitted in bulk chunks and their
+        results collected and logged like single resends."""
+        server = self.enterContext(
+            MockMagentoServer(
+                order_count=60,
+                comment_prefix=OrderEmailResender.COMMENT_PREFIX,
+                max_email_attempts=OrderEmailResender.MAX_EMAIL_ATTEMPTS,
+            )
+        )
+        resent = [
+            order
+            for order in server.orders
+            if not order.get("email_sent")
+            and order["status"] not in OrderEmailResender.SKIPPED_ORDER_STATUSES
+            and OrderEmailResender._count_comment_attempts(order)
+            < OrderEmailResender.MAX_EMAIL_ATTEMPTS
+        ]
+        outbox_file = os.path.join(
+            self.enterContext(tempfile.TemporaryDirectory()), "outbox.jsonl"
+        )
+        self.configure(
+            magento_bulk_resend=True,
+            magento_bulk_chunk_size=10,
+            magento_rate_limit=0,
+            order_page_size=None,
+            state_store_file=None,
+            outbox_file=outbox_file,
+            order_cache_size=0,
+            incremental_polling=False,
+            server_side_filter=False,
+            web_domain=server.url,
+            web_orders_api_endpoint=ORDERS_PATH,
+            web_order_api_endpoint=ORDERS_PATH + "/",
+            alert_webhook_url=server.url + ALERT_PATH,
+            email_webhook_url=server.url + EMAIL_PATH,
+        )
+        self.addCleanup(OrderEmailResender.close_outbox)
+        OrderEmailResender.close_outbox()
+        self.send_real_requests()
+        with self.assertLogs(level="INFO") as logs:
+            OrderEmailResender.run_cycle()
+        self.assertEqual(server.request_counts["resend_email"], 0)
+        self.assertEqual(
+            server.request_counts["bulk_resend"], -(-len(resent) // 10)
+        )
+        self.assertEqual(
+            server.request_counts["bulk_status"], -(-len(resent) // 10)
+        )
+        outcomes = [line for line in logs.output if "sent for a resend" in line]
+        self.assertEqual(len(outcomes), len(resent))
+        self.assertIn("This is attempt number 1", outcomes[0])
+        # The outbox shows the resends done, so they aren't made again
+        order = OrderEmailResender.Order.from_json(resent[0])
+        OrderEmailResender._queue_bulk_resend(order, 0)
+        self.assertEqual(OrderEmailResender.flush_bulk_resends(), 0)
+        self.assertEqual(
+            server.request_counts["bulk_resend"], -(-len(resent) // 10)
+        )
+
+        # Test rejected and failed operations are logged as failed resends,
+        # and open ones are polled until they finish
+        self.configure(outbox_file=None, magento_bulk_poll_secs=0)
+        responses = [
+            MockResponse(
+                {
+                    "bulk_uuid": "abc",
+                    "request_items": [
+                        {"id": 0, "status": "accepted"},
+                        {"id": 1, "status": "rejected"},
+                        {"id": 2, "status": "accepted"},
+                    ],
+                },
+                202,
+            ),
+            MockResponse(
+                {"operations_list": [{"id": 0, "status": 4}, {"id": 2, "status": 2}]},
+                200,
+            ),
+            MockResponse(
+                {"operations_list": [{"id": 0, "status": 1}, {"id": 2, "status": 2}]},
+                200,
+            ),
+        ]
+        orders = [
+            OrderEmailResender.Order.from_json(
+                {"entity_id": entity_id, "increment_id": str(entity_id)}
+            )
+            for entity_id in (1, 2, 3)
+        ]
+        with patch.object(
+            OrderEmailResender, "_magento_request", side_effect=responses
+        ) as magento_request, self.assertLogs(level="INFO") as logs:
+            for order in orders:
+                OrderEmailResender._queue_bulk_resend(order, 1)
+            self.assertEqual(OrderEmailResender.flush_bulk_resends(), 0)
+        self.assertEqual(magento_request.call_count, 3)
+        self.assertEqual(
+            magento_request.call_args_list[0].kwargs["json"],
+            [{"id": 1}, {"id": 2}, {"id": 3}],
+        )
+        self.assertEqual(
+            magento_request.call_args_list[1].args[1],
+            server.url + "/rest/default/V1/bulk/abc/detailed-status",
+        )
+        outcomes = [line for line in logs.output if "Order " in line]
+        self.assertIn("Order 1 has been sent for a resend attempt", outcomes[0])
+        self.assertIn("Order 2 should have been resent", outcomes[1])
+        self.assertIn("Order 3 should have been resent", outcomes[2])
+        self.assertIn("This is attempt number 2", outcomes[0])
+
+    def test_sharding(self):
+        """Test instances split the shards between them, only process orders
+        in their shards which no other instance has leased, and take over the
+        shards of an instance which has stopped."""
+        lease_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(lease_dir.cleanup)
+        worker_a = self.configure(
+            shard_count=4,
+            worker_id="a",
+            lease_backend="sqlite",
+            lease_file=os.path.join(lease_dir.name, "leases.db"),
+            lease_ttl_secs=60,
+            order_page_size=None,
+            incremental_polling=False,
+            state_store_file=None,
+            outbox_file=None,
+        )
+        worker_b = dataclasses.replace(worker_a, worker_id="b")
+        self.addCleanup(OrderEmailResender.release_shards)
+
+        # Test a new instance gets a share once the others give theirs up
+        self.assertEqual(OrderEmailResender.claim_shards(), {0, 1, 2, 3})
+        with OrderEmailResender.use_config(worker_b):
+            self.assertEqual(OrderEmailResender.claim_shards(), set())
+        self.assertEqual(OrderEmailResender.claim_shards(), {0, 1})
+        with OrderEmailResender.use_config(worker_b):
+            self.assertEqual(OrderEmailResender.claim_shards(), {2, 3})
+
+        # Test only orders in the shards held, and not leased by another
+        # instance, are processed
+        orders = [
+            OrderEmailResender.Order.from_json(
+                {
+                    "entity_id": entity_id,
+                    "increment_id": str(entity_id),
+                    "status": "processing",
+                }
+            )
+            for entity_id in range(1, 21)
+        ]
+        owned = [
+            order
+            for order in orders
+            if OrderEmailResender._order_shard(order) in (0, 1)
+        ]
+        with OrderEmailResender.use_config(worker_b):
+            self.assertTrue(OrderEmailResender._lease_order(owned[0]))
+        self.assertEqual(OrderEmailResender.claim_shards(), {0, 1})
+        with patch.object(
+            OrderEmailResender, "fetch_unsent_orders", return_value=orders
+        ), patch.object(OrderEmailResender, "_process_order") as process_order:
+            OrderEmailResender._poll_store()
+        self.assertEqual(
+            [call.args[0] for call in process_order.call_args_list], owned[1:]
+        )
+        # The orders stay leased, so aren't taken by the other instance
+        with OrderEmailResender.use_config(worker_b):
+            self.assertFalse(OrderEmailResender._lease_order(owned[1]))
+
+        # Test a stopped instance's shards are taken over once its leases lapse
+        with patch.object(
+            OrderEmailResender.time, "time", return_value=time.time() + 61
+        ), OrderEmailResender.use_config(worker_b):
+            self.assertEqual(OrderEmailResender.claim_shards(), {0, 1, 2, 3})
+            OrderEmailResender.release_shards()
+
+        # Test a one-off run gives its shards up straight away when it ends
+        with patch.object(OrderEmailResender, "_poll_store"):
+            OrderEmailResender.run_once()
+        with OrderEmailResender.use_config(worker_b):
+            self.assertEqual(OrderEmailResender.claim_shards(), {0, 1, 2, 3})
+
+    def test_profile_cycle(self):
+        """Test a cycle is profiled, on every thread, and its phases and
+        requests traced only when PROFILE_DIR is set."""
+        self.send_real_requests()
+        engines = ["threads"] + (["async"] if OrderEmailResender.aiohttp else [])
+        for engine in engines:
+            server = self.enterContext(
+                MockMagentoServer(
+                    order_count=20,
+                    comment_prefix=OrderEmailResender.COMMENT_PREFIX,
+                    max_email_attempts=OrderEmailResender.MAX_EMAIL_ATTEMPTS,
+                )
+            )
+            profile_dir = self.enterContext(tempfile.TemporaryDirectory())
+            self.configure(
+                engine=engine,
+                profile_dir=profile_dir,
+                max_concurrency=4,
+                magento_rate_limit=0,
+                order_page_size=None,
+                state_store_file=None,
+                outbox_file=None,
+                order_cache_size=0,
+                incremental_polling=False,
+                server_side_filter=False,
+                web_domain=server.url,
+                web_orders_api_endpoint=ORDERS_PATH,
+                web_order_api_endpoint=ORDERS_PATH + "/",
+                alert_webhook_url=server.url + ALERT_PATH,
+                email_webhook_url=server.url + EMAIL_PATH,
+            )
+            with self.assertLogs(level="INFO"):
+                OrderEmailResender.run_cycle()
+            files = sorted(os.listdir(profile_dir))
+            self.assertEqual(len(files), 2)
+            self.assertTrue(files[0].endswith(".prof"))
+            self.assertTrue(files[1].endswith(".trace.json"))
+            stats = pstats.Stats(os.path.join(profile_dir, files[0]))
+            profiled = {function for _, _, function in stats.stats}
+            suffix = "_async" if engine == "async" else ""
+            self.assertIn("_process_order" + suffix, profiled)
+            self.assertIn("_resend_order_with_magento" + suffix, profiled)
+            with open(os.path.join(profile_dir, files[1])) as trace_file:
+                events = json.load(trace_file)["traceEvents"]
+            host = server.url.split("://")[1]
+            searches = [
+                event
+                for event in events
+                if event["name"] == "GET " + host + ORDERS_PATH
+            ]
+            self.assertEqual(len(searches), 1)
+            self.assertEqual(searches[0]["args"]["status"], 200)
+            self.assertGreater(searches[0]["args"]["bytes"], 0)
+            self.assertIn("ttfb_ms", searches[0]["args"])
+            resends = [
+                event
+                for event in events
+                if event["name"] == "POST " + host + ORDERS_PATH + "/{id}/emails"
+            ]
+            self.assertEqual(len(resends), server.request_counts["resend_email"])
+            if engine == "async":
+                self.assertIn("connect_ms", searches[0]["args"])
+            self.assertIn(
+                "fetch_unsent_orders", [event["name"] for event in events]
+            )
+
+        # Test nothing is profiled or traced otherwise
+        self.configure(profile_dir=None)
+        with self.assertLogs(level="INFO"):
+            OrderEmailResender.run_cycle()
+        self.assertIsNone(OrderEmailResender._trace_events)
+        self.assertIsNone(OrderEmailResender._profilers)
+
+    def test_record_and_replay(self):
+        """Test a cycle's responses are recorded without secrets, and that
+        replaying them processes the same orders without the network."""
+        server = MockMagentoServer(
+            order_count=30,
+            escalate_ratio=0.5,
+            comment_prefix=OrderEmailResender.COMMENT_PREFIX,
+            max_email_attempts=OrderEmailResender.MAX_EMAIL_ATTEMPTS,
+        )
+        record_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(record_dir.cleanup)
+        record_file = os.path.join(record_dir.name, "cycles.jsonl.gz")
+        self.addCleanup(OrderEmailResender.reset_replay)
+        settings = dict(
+            max_concurrency=4,
+            magento_rate_limit=0,
+            order_page_size=7,
+            state_store_file=None,
+            outbox_file=None,
+            order_cache_size=0,
+            incremental_polling=False,
+            server_side_filter=False,
+            web_orders_api_endpoint=ORDERS_PATH,
+            web_order_api_endpoint=ORDERS_PATH + "/",
+            web_headers={"Authorization": "Bearer secret-token"},
+        )
+        with server:
+            self.send_real_requests()
+            self.configure(
+                record_file=record_file,
+                web_domain=server.url,
+                alert_webhook_url=server.url + ALERT_PATH + "?key=secret-key",
+                email_webhook_url=server.url + EMAIL_PATH,
+                **settings,
+            )
+            with self.assertLogs(level="INFO") as logs:
+                OrderEmailResender.run_cycle()
+        recorded_outcomes = sorted(
+            line for line in logs.output if "This is attempt" in line
+            or "sent to sales" in line
+        )
+        self.assertEqual(
+            len(recorded_outcomes),
+            server.request_counts["resend_email"]
+            + server.request_counts["email_webhook"],
+        )
+        with gzip.open(record_file, "rt") as recording:
+            records = [json.loads(line) for line in recording]
+        self.assertEqual(len(records), sum(server.request_counts.values()))
+        self.assertNotIn(server.url, json.dumps(records))
+        self.assertNotIn("secret", json.dumps(records))
+        self.assertIn(
+            "POST {alert_webhook_url}", [record["template"] for record in records]
+        )
+
+        # Test the recording is replayed, with any network access failing
+        for method in ("get", "post"):
+            self.enterContext(
+                patch.object(requests.Session, method, side_effect=AssertionError)
+            )
+        for engine in ["threads"] + (["async"] if OrderEmailResender.aiohttp else []):
+            OrderEmailResender.reset_replay()
+            self.configure(
+                engine=engine,
+                record_file=None,
+                replay_file=record_file,
+                replay_speed=0,
+                web_domain="http://replay.invalid",
+                alert_webhook_url="http://replay.invalid/alert",
+                email_webhook_url="http://replay.invalid/email",
+                **settings,
+            )
+            with self.assertLogs(level="INFO") as logs:
+                OrderEmailResender.run_cycle()
+            replayed_outcomes = sorted(
+                line for line in logs.output if "This is attempt" in line
+                or "sent to sales" in line
+            )
+            self.assertEqual(replayed_outcomes, recorded_outcomes)
+
+        # Test requests which weren't recorded get the last response from the
+        # same endpoint, and are otherwise failed
+        response = OrderEmailResender._http_request(
+            None, "post", "http://replay.invalid" + ORDERS_PATH + "/999999/emails"
+        )
+        self.assertEqual(response.json(), "true")
+        with self.assertRaises(requests.ConnectionError):
+            OrderEmailResender._http_request(None, "get", "http://replay.invalid/")
+
+        with self.assertRaises(OrderEmailResender.ConfigError):
+            dataclasses.replace(
+                OrderEmailResender.get_config(), record_file=record_file
+            )
+
+    def test_order_record(self):
+        """Test orders are parsed into compact records as they are fetched,
+        with their resend attempts counted and their comments dropped."""
+        PREFIX = OrderEmailResender.COMMENT_PREFIX
+        item = {
+            "entity_id": 12,
+            "increment_id": "600000012",
+            "status": "processing",
+            "email_sent": None,
+            "updated_at": "2024-05-01 10:00:00",
+            "status_histories": [
+                {"comment": "Captured amount of £1,234.56 online."},
+                {"comment": PREFIX + " Attempt #1"},
+                {"comment": None},
+                {"comment": PREFIX + " Attempt #2"},
+            ],
+        }
+        requests.Session.get = MagicMock(
+            return_value=MockResponse({"items": [item], "total_count": 1}, 200)
+        )
+        (order,) = OrderEmailResender.fetch_unsent_orders()
+        self.assertIsInstance(order, OrderEmailResender.Order)
+        self.assertFalse(hasattr(order, "__dict__"))
+        self.assertEqual(order.comment_attempts, 2)
+        self.assertEqual(OrderEmailResender._check_resend_attempts(order), 2)
+
+        # Test the order reads like the fields of the dict it came from
+        self.assertEqual(order["increment_id"], "600000012")
+        self.assertNotIn("email_sent", order)
+        self.assertNotIn("status_histories", order)
+        self.assertEqual(
+            dict(order),
+            {
+                "entity_id": 12,
+                "increment_id": "600000012",
+                "status": "processing",
+                "updated_at": "2024-05-01 10:00:00",
+            },
+        )
+
+        # Test an order fetched without its comments has unknown attempts
+        del item["status_histories"]
+        order = OrderEmailResender.Order.from_json(item)
+        self.assertIsNone(order.comment_attempts)
+        self.assertEqual(OrderEmailResender._check_resend_attempts(order), 0)
 
     def test_check_resend_attempts(self):
         """Test checking how many attempts to resend have been made
@@ -191,14 +2227,15 @@ class TestOrderEmailResender(unittest.TestCase):
         }
 
         # Test successful alert sent
-        requests.post = Mock(
+        requests.Session.post = Mock(
             return_value=MockResponse({"message": "success"}, 200)
         )
         OrderEmailResender._alert_admin(test_order_obj)
         order_entity_id = test_order_obj["entity_id"]
         order_increment_id = test_order_obj["increment_id"]
-        requests.post.assert_called_once_with(
+        requests.Session.post.assert_called_once_with(
             ALERT_WEBHOOK_URL,
+            timeout=OrderEmailResender.HTTP_TIMEOUT,
             json={
                 "entity_id": order_entity_id,
                 "increment_id": order_increment_id,
@@ -208,10 +2245,11 @@ class TestOrderEmailResender(unittest.TestCase):
         )
 
         # Test alert webhook unavailable
-        requests.post = Mock(return_value=MockResponse({}, 500))
+        requests.Session.post = Mock(return_value=MockResponse({}, 500))
         OrderEmailResender._alert_admin(test_order_obj)
-        requests.post.assert_called_once_with(
+        requests.Session.post.assert_called_once_with(
             ALERT_WEBHOOK_URL,
+            timeout=OrderEmailResender.HTTP_TIMEOUT,
             json={
                 "entity_id": order_entity_id,
                 "increment_id": order_increment_id,
@@ -246,6 +2284,7 @@ class TestOrderEmailResender(unittest.TestCase):
         order_entity_id = str(test_order_obj["entity_id"])
 
         # Test successful API call for order details + successful webhook sent
+        OrderEmailResender.clear_order_cache()
         order_company_name = fake.company()
         mock_api_order = {
             "customer_name": order_company_name,
@@ -308,23 +2347,26 @@ class TestOrderEmailResender(unittest.TestCase):
                 "WEB_ORDER_COMMENT_FIELD"
             ): "Please knock on the red door rather than the blue.",
         }
-        requests.get = Mock(
+        requests.Session.get = Mock(
             return_value=MockResponse(
                 mock_api_order,
                 200,
             )
         )
-        requests.post = Mock(
+        requests.Session.post = Mock(
             return_value=MockResponse({"message": "success"}, 200)
         )
 
         OrderEmailResender._email_order_to_sales(test_order_obj)
 
-        requests.get.assert_called_once_with(
-            WEB_ORDER_API_ENDPOINT + order_entity_id
+        requests.Session.get.assert_called_once_with(
+            WEB_ORDER_API_ENDPOINT + order_entity_id,
+            params={"fields": OrderEmailResender.SALES_ORDER_FIELDS},
+            timeout=OrderEmailResender.HTTP_TIMEOUT,
         )
-        requests.post.assert_called_once_with(
+        requests.Session.post.assert_called_once_with(
             EMAIL_WEBHOOK_URL,
+            timeout=OrderEmailResender.HTTP_TIMEOUT,
             json={
                 "customer_name": order_company_name,
                 "increment_id": order_increment_id,
@@ -349,7 +2391,8 @@ class TestOrderEmailResender(unittest.TestCase):
         )
 
         # Test Unsuccessful API call for order details
-        requests.get = Mock(
+        OrderEmailResender.clear_order_cache()
+        requests.Session.get = Mock(
             return_value=MockResponse(
                 {
                     "message": "Example error.",
@@ -381,20 +2424,26 @@ class TestOrderEmailResender(unittest.TestCase):
         with self.assertRaises(requests.HTTPError):
             OrderEmailResender._email_order_to_sales(test_order_obj)
 
-        requests.get.assert_called_once_with(
-            WEB_ORDER_API_ENDPOINT + order_entity_id
+        requests.Session.get.assert_called_once_with(
+            WEB_ORDER_API_ENDPOINT + order_entity_id,
+            params={"fields": OrderEmailResender.SALES_ORDER_FIELDS},
+            timeout=OrderEmailResender.HTTP_TIMEOUT,
         )
 
         # Test successful API call for order details + webhook unavailable
-        requests.get = Mock(return_value=MockResponse(mock_api_order, 200))
-        requests.post = Mock(return_value=MockResponse({}, 500))
+        OrderEmailResender.clear_order_cache()
+        requests.Session.get = Mock(return_value=MockResponse(mock_api_order, 200))
+        requests.Session.post = Mock(return_value=MockResponse({}, 500))
         with self.assertRaises(requests.HTTPError):
             OrderEmailResender._email_order_to_sales(test_order_obj)
-        requests.get.assert_called_once_with(
-            WEB_ORDER_API_ENDPOINT + order_entity_id
+        requests.Session.get.assert_called_once_with(
+            WEB_ORDER_API_ENDPOINT + order_entity_id,
+            params={"fields": OrderEmailResender.SALES_ORDER_FIELDS},
+            timeout=OrderEmailResender.HTTP_TIMEOUT,
         )
-        requests.post.assert_called_once_with(
+        requests.Session.post.assert_called_once_with(
             EMAIL_WEBHOOK_URL,
+            timeout=OrderEmailResender.HTTP_TIMEOUT,
             json={
                 "customer_name": order_company_name,
                 "increment_id": order_increment_id,
@@ -431,24 +2480,99 @@ class TestOrderEmailResender(unittest.TestCase):
         order_arg = {"entity_id": order_entity_id}
 
         # Test successfull API call
-        requests.post = Mock(return_value=MockResponse("true", 200))
+        requests.Session.post = Mock(return_value=MockResponse("true", 200))
         result = OrderEmailResender._resend_order_with_magento(order_arg)
-        requests.post.assert_called_once_with(WEB_ORDER_EMAIL_API_ENDPOINT)
+        requests.Session.post.assert_called_once_with(
+            WEB_ORDER_EMAIL_API_ENDPOINT, timeout=OrderEmailResender.HTTP_TIMEOUT
+        )
         self.assertEqual(result, True)
 
         # Test successful API call but email not sent
-        requests.post = Mock(return_value=MockResponse("false", 200))
+        requests.Session.post = Mock(return_value=MockResponse("false", 200))
         result = OrderEmailResender._resend_order_with_magento(order_arg)
-        requests.post.assert_called_once_with(WEB_ORDER_EMAIL_API_ENDPOINT)
+        requests.Session.post.assert_called_once_with(
+            WEB_ORDER_EMAIL_API_ENDPOINT, timeout=OrderEmailResender.HTTP_TIMEOUT
+        )
         self.assertEqual(result, False)
 
-        # Test unsuccessfull API call
-        requests.post = Mock(return_value=MockResponse({}, 500))
+        # Test unsuccessfull API call, not retried as Magento may have sent
+        # the email before failing
+        requests.Session.post = Mock(return_value=MockResponse({}, 500))
         with self.assertRaises(requests.HTTPError):
             result = OrderEmailResender._resend_order_with_magento(order_arg)
-        requests.post.assert_called_once_with(WEB_ORDER_EMAIL_API_ENDPOINT)
+        requests.Session.post.assert_called_once_with(
+            WEB_ORDER_EMAIL_API_ENDPOINT, timeout=OrderEmailResender.HTTP_TIMEOUT
+        )
         self.assertEqual(result, False)
 
+    def test_setup_logging(self):
+        """Test logging through the queue to a rotated log file, with each
+        order logged in as much detail as configured."""
+        log_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(log_dir.cleanup)
+        log_file = os.path.join(log_dir.name, "resender.log")
+        config = self.configure(
+            log_file=log_file,
+            log_queue=True,
+            log_max_bytes=2000,
+            log_rotate_when=None,
+            log_backup_count=2,
+            store="trade",
+        )
+        root_logger = OrderEmailResender.logging.getLogger()
+        self.addCleanup(root_logger.setLevel, root_logger.level)
+        self.addCleanup(OrderEmailResender.stop_logging)
+        with patch("sys.stdout", new=io.StringIO()) as stdout:
+            OrderEmailResender.setup_logging(config)
+        order = {
+            "entity_id": 12,
+            "increment_id": "600000012",
+            "status": "processing",
+            "updated_at": "2024-05-01 10:00:00",
+            "status_histories": [
+                {"comment": "Captured online."},
+                {"comment": OrderEmailResender.COMMENT_PREFIX + " Attempt #1"},
+            ],
+        }
+
+        # Test the compact record is written by the background writer
+        OrderEmailResender._log_order(order)
+        OrderEmailResender.stop_logging()
+        with open(log_file) as log:
+            lines = log.readlines()
+        self.assertEqual(len(lines), 1)
+        self.assertIn("logger=OrderEmailResender store=trade", lines[0])
+        self.assertIn(
+            'msg="Processing order entity_id=12 increment_id=600000012'
+            " status=processing updated_at=2024-05-01 10:00:00"
+            ' comment_attempts=1"',
+            lines[0],
+        )
+        self.assertEqual(stdout.getvalue(), "".join(lines))
+
+        # Test the other levels of detail
+        with self.assertLogs(OrderEmailResender.logger) as logs:
+            self.configure(log_orders="full")
+            OrderEmailResender._log_order(order)
+            self.configure(log_orders="none")
+            OrderEmailResender._log_order(order)
+            OrderEmailResender.logger.info("done")
+        self.assertEqual(
+            logs.output,
+            [f"INFO:OrderEmailResender:{order}", "INFO:OrderEmailResender:done"],
+        )
+
+        # Test the log file is rotated once it is full
+        self.configure(log_orders="compact")
+        with patch("sys.stdout", new=io.StringIO()):
+            OrderEmailResender.setup_logging(config)
+        for _ in range(40):
+            OrderEmailResender._log_order(order)
+        OrderEmailResender.stop_logging()
+        self.assertTrue(os.path.exists(log_file + ".1"))
+        self.assertTrue(os.path.exists(log_file + ".2"))
+        self.assertFalse(os.path.exists(log_file + ".3"))
+
     def test_log_order_outcome(self):
         """Log the outcome of processing an order."""
         logger = OrderEmailResender.logger